@@ -0,0 +1,213 @@
+""" Throughput benchmark for pycloudbackup, no cloud account needed: backups go to the
+    local (directory) or memory backend, optionally slowed down to look like a real link.
+
+    Every dataset is timed stage by stage (walk, tar, compress, encrypt, upload,
+    download) and end to end (backup, restore), reported in MB/s and files/s so a
+    regression shows up as a number.
+
+ -- see README for the local/memory backend settings
+"""
+
+"""
+Sample command usage:
+    == Every dataset, in memory, default compression and encryption ==
+    python benchmark.py run
+
+    == Many small files only, on disk, over a simulated 100 Mbit/s 20ms link ==
+    python benchmark.py run --dataset small --destination local --latency-ms 20 --bandwidth-mbps 100
+
+    == Bigger datasets, results kept as JSON to compare runs ==
+    python benchmark.py run --scale 4 --output results.json
+"""
+import aaargh
+app = aaargh.App(description="Benchmarks pycloudbackup")
+
+import json, os, random, shutil, tempfile, time
+
+import pycloudbackup
+import filewalker
+
+PASSWORD = "benchmark"
+
+# name: (description, files, bytes per file, compressible, scaled) at scale 1,
+# --scale multiplies the files or their size.
+DATASETS = dict(
+    small=("many small files", 2000, 8 * 1024, True, "files"),
+    huge=("a few huge files", 2, 64 * 1024 * 1024, True, "size"),
+    random=("incompressible data", 1, 64 * 1024 * 1024, False, "size"),
+)
+
+class NullWriter(object):
+    """ write() end throwing the data away, counting it. """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+def text_block(rand, size):
+    """ Log-like lines, compressing about as well as real logs do. """
+    words = ["GET", "POST", "/index.html", "/api/v1/items", "200", "404", "500", "user", "session",
+             "timeout", "cache", "hit", "miss", "INFO", "WARN", "ERROR", "request", "took", "ms"]
+    lines, length = [], 0
+    while length < size:
+        line = "{:010d} {} {}\n".format(rand.randint(0, 10 ** 10),
+                                        " ".join(rand.choice(words) for _ in range(8)), rand.randint(0, 99999))
+        lines.append(line)
+        length += len(line)
+    return "".join(lines)[:size]
+
+def make_dataset(root, name, scale):
+    """ Creates dataset name under root, returns (path, files, bytes). """
+    description, count, size, compressible, scaled = DATASETS[name]
+    if scaled == "files":
+        count = max(1, int(count * scale))
+    else:
+        size = max(1, int(size * scale))
+    path = os.path.join(root, name)
+    rand = random.Random(name) # Same data run after run.
+    block = text_block(rand, min(size, 1024 * 1024)) if compressible else None
+    total = 0
+    for i in range(count):
+        directory = os.path.join(path, "d{:03d}".format(i / 100))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "f{:06d}.log".format(i)), "wb") as f:
+            written = 0
+            while written < size:
+                chunk = min(size - written, 1024 * 1024)
+                if compressible:
+                    offset = rand.randint(0, len(block) - 1)
+                    data = (block[offset:] + block[:offset])[:chunk]
+                else:
+                    data = os.urandom(chunk)
+                f.write(data)
+                written += chunk
+        total += size
+    return path, count, total
+
+def timed(results, stage, size, files, func, *args, **kwargs):
+    """ Runs func, recording its time and throughput under stage. """
+    start = time.time()
+    value = func(*args, **kwargs)
+    seconds = max(time.time() - start, 1e-6)
+    results.append(dict(stage=stage, seconds=seconds, mb=size / 1048576.0,
+                        mb_per_sec=size / 1048576.0 / seconds, files_per_sec=files / seconds if files else None))
+    return value
+
+def bench_dataset(path, files, size, conf, destination, compression, cipher):
+    """ Times every stage on the dataset at path, returns the result rows. """
+    results = []
+    scratch = tempfile.mkdtemp(prefix="bench-")
+    try:
+        def walk():
+            return sum(1 for _ in filewalker.walk_files(path + "/"))
+        timed(results, "walk", 0, files, walk)
+
+        tarred = tempfile.TemporaryFile(dir=scratch)
+        timed(results, "tar", size, files, pycloudbackup.tar_stage, None, tarred, path, os.path.basename(path))
+        tar_size = tarred.tell()
+        tarred.seek(0)
+
+        compressed = tempfile.TemporaryFile(dir=scratch)
+        timed(results, "compress", tar_size, 0, pycloudbackup.compress_stage, tarred, compressed, *compression)
+        compressed_size = compressed.tell()
+        compressed.seek(0)
+        tarred.close()
+
+        encrypted = tempfile.TemporaryFile(dir=scratch)
+        timed(results, "encrypt", compressed_size, 0, cipher.encrypt, compressed, encrypted, PASSWORD)
+        encrypted_size = encrypted.tell()
+        encrypted.seek(0)
+        compressed.close()
+
+        storage_backend = pycloudbackup.storage_backends[destination](conf)
+        segment_size = int(conf.get("segment_size_mb", pycloudbackup.DEFAULT_SEGMENT_SIZE_MB)) * 1024 * 1024
+        concurrency = int(conf.get("segment_concurrency", pycloudbackup.DEFAULT_SEGMENT_CONCURRENCY))
+        segment_pool = pycloudbackup.BackendPool(destination, conf, size=concurrency)
+        timed(results, "upload", encrypted_size, 0, pycloudbackup.upload_object, storage_backend, segment_pool,
+              "bench-object", encrypted, segment_size, concurrency)
+        encrypted.close()
+
+        download_concurrency = int(conf.get("download_concurrency", pycloudbackup.DEFAULT_DOWNLOAD_CONCURRENCY))
+        download_pool = pycloudbackup.BackendPool(destination, conf, size=download_concurrency)
+        timed(results, "download", encrypted_size, 0, pycloudbackup.parallel_download_to, download_pool,
+              "bench-object", NullWriter(), download_concurrency)
+        storage_backend.delete("bench-object")
+
+        result = timed(results, "backup", size, files, pycloudbackup.backup, path, destination=destination, conf=conf)
+        cwd = os.getcwd()
+        os.chdir(scratch)
+        try:
+            timed(results, "restore", size, files, pycloudbackup.restore, result["name"], destination=destination,
+                  conf=conf, password=PASSWORD)
+        finally:
+            os.chdir(cwd)
+        storage_backend.delete(result["name"])
+        results.append(dict(stage="ratio", stored=result["size"], original=size,
+                            ratio=float(result["size"]) / size if size else None))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+def print_results(name, results):
+    print "\n== {} ({}) ==".format(name, DATASETS[name][0])
+    print "{:<10} {:>10} {:>10} {:>12}".format("stage", "seconds", "MB/s", "files/s")
+    for row in results:
+        if row["stage"] == "ratio":
+            print "stored {} of {} bytes ({:.1%})".format(row["stored"], row["original"], row["ratio"] or 0)
+            continue
+        files_per_sec = "{:.1f}".format(row["files_per_sec"]) if row["files_per_sec"] else "-"
+        mb_per_sec = "{:.1f}".format(row["mb_per_sec"]) if row["mb"] else "-"
+        print "{:<10} {:>10.3f} {:>10} {:>12}".format(row["stage"], row["seconds"], mb_per_sec, files_per_sec)
+
+@app.cmd(help="Runs the benchmark.")
+@app.cmd_arg('--dataset', type=str, default="all", help="small|huge|random|all")
+@app.cmd_arg('--scale', type=float, default=1.0, help="Multiplies the number of small files and the size of the huge ones.")
+@app.cmd_arg('-d', '--destination', type=str, default="memory", help="memory|local")
+@app.cmd_arg('--workdir', type=str, default=None, help="Where datasets (and the local backend) live, a temporary directory by default.")
+@app.cmd_arg('--compression', type=str, default=None, help="Same values as pycloudbackup backup --compression.")
+@app.cmd_arg('--encryption', type=str, default=None, help="aes|beefish")
+@app.cmd_arg('--stream', action="store_true", default=False, help="Time backup and restore in streaming mode.")
+@app.cmd_arg('--latency-ms', type=float, default=0, help="Added to every request.")
+@app.cmd_arg('--bandwidth-mbps', type=float, default=0, help="Per connection limit, 0 for none.")
+@app.cmd_arg('-o', '--output', type=str, default=None, help="Also write the results to this file, as JSON.")
+def run(dataset="all", scale=1.0, destination="memory", workdir=None, compression=None, encryption=None,
+        stream=False, latency_ms=0, bandwidth_mbps=0, output=None):
+    names = sorted(DATASETS) if dataset == "all" else dataset.split(",")
+    for name in names:
+        if name not in DATASETS:
+            raise Exception("\n\nUnknown dataset {}, use one of {} or all".format(name, ", ".join(sorted(DATASETS))))
+    if destination not in ("memory", "local"):
+        raise Exception("\n\nThe benchmark only runs against the memory and local backends.")
+
+    root = workdir or tempfile.mkdtemp(prefix="pycloudbackup-bench-")
+    conf = dict(path=os.path.join(root, "store"), container="benchmark", catalog=os.path.join(root, "catalog"),
+                crypto_password=PASSWORD, stream=str(stream), latency_ms=latency_ms, bandwidth_mbps=bandwidth_mbps)
+    if compression:
+        conf["compression"] = compression
+    if encryption:
+        conf["encryption"] = encryption
+    compression = pycloudbackup.parse_codec(compression if compression and compression != "auto" else None)
+    cipher = pycloudbackup.parse_cipher(encryption)
+
+    report = dict(destination=destination, scale=scale, stream=stream, latency_ms=latency_ms,
+                  bandwidth_mbps=bandwidth_mbps, compression=compression[0].name, encryption=cipher.name, datasets={})
+    try:
+        for name in names:
+            path, files, size = make_dataset(os.path.join(root, "data"), name, scale)
+            report["datasets"][name] = results = bench_dataset(path, files, size, conf, destination, compression, cipher)
+            print_results(name, results)
+    finally:
+        if not workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+def main():
+    app.run()
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,16 @@ backup_age          = 3
 delete_afterwards   = True
 backup_source       = /backup/
 backup_password = test
+journal             = /etc/filewalker.conf.journal
+include             = *.log, *.gz
+exclude             = cache, re:^tmp/, size>10G
+incremental         = False
+workers             = 4
+max_inflight_mb     = 1024
+metrics_json        = /var/lib/filewalker/metrics.json
+metrics_textfile    = /var/lib/node_exporter/textfile/filewalker.prom
+pack_files_under_kb = 1024
+pack_size_mb        = 256
 
 [cloudfilesSettings]
 apiuser         = 
@@ -40,58 +50,71 @@ config = ConfigParser.SafeConfigParser()
 app = aaargh.App(description="Handles backups for stuff")
 
 
-import fnmatch, os, time
+import fnmatch, os, stat, time
 now = time.time()           # cur time
+try:
+    from scandir import scandir # pip install scandir, skips a stat per directory entry
+except ImportError:
+    scandir = None
 
 import pycloudbackup
+backend_pool = None         # authenticated cloudfiles connections, shared by the workers
+segment_pool = None         # connections for the segments of large files, shared by the workers
+dedup_store = None          # known dedup chunks, listed once per run
+journal = None              # crash-safe run journal, lets a restarted run resume
+index = None                # file-state index for incremental backups
+run_metrics = None          # per-stage timings of the run, see metrics_json/metrics_textfile
 
-def isdirectory(file):
-    """ Just helps to return if file is a directory or not """
-    try:
-        if os.path.isdir(file):
-            return True
-        else:
-            return False
-    except OSError as err:
-        print(err)
-
-def return_files_under_path(d):
-    """ Returns all files (no directories) within a particular directory tree. Just recurses through """
-    #return [os.path.join(d, f) for f in os.listdir(d)]  << This would just return all files under path,,, without recursing...
-    files = []
-    try:
+def scan_directory(d):
+    """ Yields (path, is_dir, stat) for the entries of d, stat is None for directories. """
+    if scandir is not None:
+        for entry in scandir(d):
+            try:
+                if entry.is_dir(): # Comes from the directory listing, no stat.
+                    yield entry.path, True, None
+                else:
+                    yield entry.path, False, entry.stat()
+            except OSError as err:
+                print(err)
+    else:
         for f in os.listdir(d):
             file = os.path.join(d, f)
-            if isdirectory(file): # < But we want to recurse.
-                files = files + return_files_under_path(file)
+            try:
+                st = os.stat(file)
+            except OSError as err:
+                print(err)
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                yield file, True, None
             else:
-                if len(file) != 0:
-                    files.append(file)
-    except OSError as err:
-        print(err)
-
-    return files
-
+                yield file, False, st
 
-def file_older_than(maxage,file):
-    """ Just determines if a file is older then config param. """
-    import time
+def walk_files(top, maxage=0, matcher=None):
+    """ Yields (path, stat) for every file under top at least maxage seconds old, as they are found.
+        Iterative, so only the directories still to visit are kept in memory, and every entry is statted once.
+        matcher (a pycloudbackup.FileMatcher) filters files, directories it excludes are not entered. """
     now = time.time()
-    try:
-        then = os.path.getmtime(file)
-        age  = now-then
-
-        if age >= maxage:
-            return True
-        else:
-            return False
-    except OSError as err:
-        print(err)
+    dirs = [top]
+    while dirs:
+        d = dirs.pop()
+        subdirs = []
+        try:
+            for file, is_dir, st in scan_directory(d):
+                relpath = file[len(top):].lstrip(os.sep)
+                if is_dir:
+                    if matcher is None or matcher.wants_dir(relpath):
+                        subdirs.append(file)
+                elif now - st.st_mtime >= maxage and (matcher is None or matcher.wants_file(relpath, st)):
+                    yield file, st
+        except OSError as err:
+            print(err)
+        dirs.extend(reversed(subdirs))
 
 @app.cmd(help="Backs everything up.")
 @app.cmd_arg('-c', '--configfile', type=str)
 @app.cmd_arg('-z', '--noop', type=str, default=None)
 def backup(configfile,noop):
+    global backend_pool, segment_pool, dedup_store, journal, index, run_metrics
     if not configfile:
         raise Exception("\n\nMissing -c option for config file.")
     else:
@@ -106,19 +129,155 @@ def backup(configfile,noop):
     if delete_afterwards == "True": delete_afterwards = True
     else: delete_afterwards = False
 
+    # Include/exclude rules, excluded directories are not walked at all.
+    include = exclude = None
+    if config.has_option("filewalker", "include"):
+        include = config.get("filewalker", "include")
+    if config.has_option("filewalker", "exclude"):
+        exclude = config.get("filewalker", "exclude")
+    matcher = pycloudbackup.FileMatcher(pycloudbackup.parse_rules(include), pycloudbackup.parse_rules(exclude))
+
+    workers = pycloudbackup.DEFAULT_WORKERS
+    if config.has_option("filewalker", "workers"):
+        workers = int(config.get("filewalker", "workers"))
+    max_inflight_mb = pycloudbackup.DEFAULT_MAX_INFLIGHT_MB
+    if config.has_option("filewalker", "max_inflight_mb"):
+        max_inflight_mb = int(config.get("filewalker", "max_inflight_mb"))
+
+    # The run journal lives beside the config unless told otherwise.
+    journal_path = os.path.expanduser(configfile) + ".journal"
+    if config.has_option("filewalker", "journal"):
+        journal_path = os.path.expanduser(config.get("filewalker", "journal"))
+
+    # Incremental mode only uploads files that changed since they were last backed up.
+    incremental = config.has_option("filewalker", "incremental") and config.get("filewalker", "incremental") == "True"
+    index_path = os.path.expanduser(configfile) + ".index"
+    if config.has_option("filewalker", "index"):
+        index_path = os.path.expanduser(config.get("filewalker", "index"))
+
+    # Files smaller than pack_files_under_kb are grouped into packs of about pack_size_mb.
+    pack_under = pack_size = 0
+    if config.has_option("filewalker", "pack_files_under_kb"):
+        pack_under = int(config.get("filewalker", "pack_files_under_kb")) * 1024
+    pack_size = pycloudbackup.DEFAULT_PACK_SIZE_MB * 1024 * 1024
+    if config.has_option("filewalker", "pack_size_mb"):
+        pack_size = int(config.get("filewalker", "pack_size_mb")) * 1024 * 1024
+    pack, pack_bytes = [], 0
+
+    # Per-stage timings and sizes of the run, as JSON and/or a Prometheus textfile.
+    metrics_json = metrics_textfile = None
+    if config.has_option("filewalker", "metrics_json"):
+        metrics_json = config.get("filewalker", "metrics_json")
+    if config.has_option("filewalker", "metrics_textfile"):
+        metrics_textfile = config.get("filewalker", "metrics_textfile")
+    run_metrics = pycloudbackup.RunMetrics()
+
     if noop:
         print "--noop detected, no actions being taken."
-    files = return_files_under_path(backup_source)
-    for file in files:
-        if noop and file_older_than(backup_age, file): # Just print out test operation.
-                print "Backup: " + file
-                if delete_afterwards:
-                    print "Delete: " + file
+    else:
+        journal = pycloudbackup.RunJournal(journal_path)
+    if incremental:
+        index = pycloudbackup.FileIndex(index_path)
+    backend_pool = pycloudbackup.BackendPool("cloudfiles", get_backup_constants(), size=workers)
+    segment_pool = pycloudbackup.BackendPool("cloudfiles", get_backup_constants(),
+                                             size=workers * segment_concurrency())
+    # Only used with dedup = True, chunks go up on the segment pool like large file segments.
+    dedup_store = pycloudbackup.DedupStore(backend_pool, segment_pool, segment_concurrency())
+    pool = pycloudbackup.WorkerPool(workers, max_inflight_mb * 1024 * 1024)
+    for file, st in walk_files(backup_source, backup_age, matcher):
+        if index and index.unchanged(file, st):
+            # Same size, mtime and inode as last backed up, not even read. Still deleted
+            # if a crash came between its upload and its delete.
+            if noop and delete_afterwards:
+                print "Delete: " + file
+            elif delete_afterwards:
+                pool.submit(delete_backed_up, 0, file)
+            continue
+        if noop: # Just print out test operation.
+            print "Backup: " + file
+            if delete_afterwards:
+                print "Delete: " + file
+        elif st.st_size < pack_under:
+            pack.append((file, st))
+            pack_bytes += st.st_size
+            if pack_bytes >= pack_size:
+                pool.submit(backup_pack_and_delete, pack_bytes, pack, delete_afterwards)
+                pack, pack_bytes = [], 0
         else:
-            if file_older_than(backup_age, file):
-                perform_backup(file)
-                if delete_afterwards:
-                    perform_delete(file)
+            pool.submit(backup_and_delete, st.st_size, file, st, delete_afterwards)
+    if pack:
+        pool.submit(backup_pack_and_delete, pack_bytes, pack, delete_afterwards)
+
+    failures = pool.join()
+    if not noop:
+        run_metrics.fail(len(failures))
+        run_metrics.write(metrics_json, metrics_textfile)
+    if failures:
+        raise Exception("\n\n%d file(s) or pack(s) failed to back up, they were not deleted. Run again to resume." % len(failures))
+    if journal:
+        journal.finish()
+
+def backup_and_delete(file, st, delete_afterwards):
+    """ Worker job: backs up a file, then deletes it only if the upload succeeded.
+        Files the journal shows as uploaded by an interrupted run are not sent again. """
+    digest = remote_name = None
+    if index:
+        digest = index.content_changed(file, st)
+        if digest is None: # Touched but same content as last backed up, only the delete is left.
+            if delete_afterwards:
+                delete_backed_up(file)
+            return
+    if journal.lookup(file, st) == "uploaded":
+        print "Already uploaded by the interrupted run: " + file
+    else:
+        journal.record(file, "queued", st)
+        result = perform_backup(file, on_state=lambda state: journal.record(file, state))
+        journal.record(file, "uploaded", remote_name=result["name"], checksum=result["md5"])
+        remote_name = result["name"]
+    if delete_afterwards:
+        delete_backed_up(file)
+    # Indexed last: a file indexed as backed up must also have been deleted.
+    if index:
+        index.update(file, st, digest, remote_name)
+
+def backup_pack_and_delete(files, delete_afterwards):
+    """ Worker job: backs up (file, stat) pairs as one pack. No file is deleted before the whole pack
+        and its index are stored, and then only the files that made it into the pack. """
+    todo, done = [], []
+    for file, st in files:
+        digest = None
+        if index:
+            digest = index.content_changed(file, st)
+            if digest is None: # Touched but same content as last backed up, only the delete is left.
+                done.append(file)
+                continue
+        if journal.lookup(file, st) == "uploaded":
+            print "Already uploaded by the interrupted run: " + file
+            done.append(file)
+        else:
+            journal.record(file, "queued", st)
+            todo.append((file, st, digest))
+    indexed = []
+    if todo:
+        result = perform_backup([file for file, st, digest in todo])
+        packed = set(result["members"])
+        for file, st, digest in todo:
+            if file in packed:
+                journal.record(file, "uploaded", remote_name=result["name"], checksum=result["md5"])
+                indexed.append((file, st, digest))
+                done.append(file)
+    if delete_afterwards:
+        for file in done:
+            delete_backed_up(file)
+    # Indexed last: a file indexed as backed up must also have been deleted.
+    if index:
+        for file, st, digest in indexed:
+            index.update(file, st, digest, result["name"])
+
+def delete_backed_up(file):
+    """ Worker job: deletes a file that is safely stored, recording it in the journal. """
+    perform_delete(file)
+    journal.record(file, "deleted")
 
 def perform_delete(file):
     """ Deletes a file, accepts 1 arguement: the file you wish to destroy """
@@ -127,13 +286,13 @@ def perform_delete(file):
     except OSError as err:
         print(err)
 
-def perform_backup(file):
+def get_backup_constants():
+    """ Builds the pycloudbackup conf dict out of the config file. """
     apiuser     = config.get("cloudfilesSettings", "apiuser")
     apikey      = config.get("cloudfilesSettings", "apikey")
     container   = config.get("cloudfilesSettings", "container")
     region_name = config.get("cloudfilesSettings", "region_name")
     crypto_password = config.get("filewalker", "backup_password")
-    """ Backups a file, accepts 1 arguement: the file you wish to backup """
 
     backup_constants = {"apiuser": apiuser,
                         "apikey": apikey,
@@ -141,7 +300,23 @@ def perform_backup(file):
                         "region_name": region_name,
                         "crypto_password": crypto_password }
 
-    pycloudbackup.backup(file, conf=backup_constants, destination="cloudfiles")
+    for option in ("stream", "dedup", "segment_size_mb", "segment_concurrency", "catalog", "compression",
+                   "encryption", "seekable", "download_concurrency", "progress"):
+        if config.has_option("filewalker", option):
+            backup_constants[option] = config.get("filewalker", option)
+    return backup_constants
+
+def segment_concurrency():
+    """ Segments uploaded at once per large file, each worker can be uploading one. """
+    if config.has_option("filewalker", "segment_concurrency"):
+        return int(config.get("filewalker", "segment_concurrency"))
+    return pycloudbackup.DEFAULT_SEGMENT_CONCURRENCY
+
+def perform_backup(file, on_state=None):
+    """ Backups a file, accepts 1 arguement: the file you wish to backup, or a list of files to pack """
+    return pycloudbackup.backup(file, conf=get_backup_constants(), destination="cloudfiles",
+                                backend_pool=backend_pool, segment_pool=segment_pool, dedup_store=dedup_store,
+                                on_state=on_state, run_metrics=run_metrics)
 
 
 @app.cmd(help="Restores --filename")
@@ -160,18 +335,7 @@ def restore(configfile,filename=None,cryptopass=None):
     print filename + " restored to CWD."
 
 def restore_file(file,crytopass):
-    apiuser     = config.get("cloudfilesSettings", "apiuser")
-    apikey      = config.get("cloudfilesSettings", "apikey")
-    container   = config.get("cloudfilesSettings", "container")
-    region_name = config.get("cloudfilesSettings", "region_name")
-    crypto_password = config.get("filewalker", "backup_password")
-    backup_constants = {"apiuser": apiuser,
-                        "apikey": apikey,
-                        "container": container,
-                        "region_name": region_name,
-                        "crypto_password": crypto_password }
-
-    pycloudbackup.restore(file, conf=backup_constants, destination="cloudfiles")
+    pycloudbackup.restore(file, conf=get_backup_constants(), destination="cloudfiles")
 
 def main():
     app.run()
@@ -2,6 +2,8 @@
 #  the script will terminate abnormally.
 
 # This wrapper will execute the script over and over again until exit status is 0.
+# pycloudbackup now retries failed requests itself (see README), keep this for
+#  whatever still makes the script exit.
 
 function retry() {
    nTrys=0
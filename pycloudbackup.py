@@ -17,49 +17,2561 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 import tarfile
 import tempfile
 import os
+import glob
+import fnmatch
+import re
 #import sys
 import ConfigParser
-from datetime import datetime
+import Queue
+import threading
+import time
+import itertools
+import hashlib
+import hmac
+import sqlite3
+import zlib
+import struct
+import binascii
+import collections
+import random
+import socket
+import httplib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from cStringIO import StringIO
+from datetime import datetime, timedelta
 from getpass import getpass
 import logging
 
 import boto
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
 import shelve
 import boto.glacier
 import boto.glacier.layer2
+import boto.glacier.utils
 from boto.glacier.exceptions import UnexpectedHTTPResponseError
+from boto.exception import BotoServerError, StorageDataError
 from beefish import decrypt, encrypt
 import aaargh
 import json
+from contextlib import contextmanager
 
 import cloudfiles
+from cloudfiles.errors import ResponseError, NoSuchObject
+
+# Optional compression codecs, see CODECS.
+import bz2
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Optional AES-GCM encryption, see CIPHERS. beefish is happy with pycrypto,
+# GCM needs pycryptodome.
+try:
+    from Crypto.Cipher import AES
+    if not hasattr(AES, "MODE_GCM"):
+        AES = None
+except ImportError:
+    AES = None
 
 DEFAULT_LOCATION = "us-east-1"
 DEFAULT_RACKSPACE_LOCATION = "dfw" # other options = ord, lon
 
-app = aaargh.App(description="Compress, encrypt and upload files directly to Rackspace Cloudfiles/Amazon S3/Glacier.")
+# Streaming pipeline tuning: every pipe between two stages holds at most
+# PIPE_MAX_CHUNKS * PIPE_CHUNK_SIZE bytes (4 MB by default).
+PIPE_CHUNK_SIZE = 64 * 1024
+PIPE_MAX_CHUNKS = 64
+PIPE_POLL_SECS = 0.5
+
+# Segmented uploads (Cloud Files large objects / S3 multipart), see upload_segmented.
+DEFAULT_SEGMENT_SIZE_MB = 64
+DEFAULT_SEGMENT_CONCURRENCY = 4
+SEGMENT_SPOOL_MEM = 8 * 1024 * 1024 # Segments bigger than this are spooled to disk
+SEGMENT_PREFIX = ".segments/"
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Per-request retries inside the backends, see retry_request and CircuitBreaker.
+REQUEST_RETRIES = 5
+RETRY_BASE_DELAY = 1 # seconds, doubled on every attempt, with full jitter
+RETRY_MAX_DELAY = 60
+RETRY_STATUSES = (408, 429) # plus every 5xx
+CIRCUIT_FAILURES = 5 # retryable failures in a row opening the circuit
+CIRCUIT_COOLDOWN = 30 # seconds requests are held once open, doubled while the outage lasts
+CIRCUIT_MAX_COOLDOWN = 300
+
+# Progress callbacks, see Progress.
+PROGRESS_INTERVAL = 2 # seconds between two reports
+PROGRESS_CALLBACKS = 100 # boto num_cb
+
+# Parallel ranged downloads, see parallel_download_to.
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+DOWNLOAD_RANGE_SIZE = 8 * 1024 * 1024
+TREE_HASH_CHUNK = 1024 * 1024 # Glacier tree hash leaves, parts are a power of two of these
+
+# Content-defined chunking dedup store, see DedupStore. Changing any of these
+# moves the chunk boundaries, so already stored chunks would stop matching.
+CDC_MIN_CHUNK = 256 * 1024
+CDC_AVG_BITS = 20 # ~1 MB average chunks
+CDC_MAX_CHUNK = 4 * 1024 * 1024
+CDC_CHUNK_PREFIX = "chunks/"
+CDC_LEASE_PREFIX = "leases/" # held by running dedup backups, see DedupStore.store
+DEDUP_GC_GRACE_HOURS = 24 # chunks younger than this are left alone by dedup-gc
+DEDUP_LEASE_HOURS = 48 # a lease older than this was left by a crashed backup
+CDC_MANIFEST_SUFFIX = ".cdc"
+CDC_GEAR = [int(hashlib.md5(chr(i)).hexdigest()[:8], 16) for i in range(256)]
+# Boundaries are searched CDC_SCAN_BLOCK bytes at a time, see gear_boundary. The
+# tables give byte n of the gear value of every byte, for str.translate.
+CDC_SCAN_BLOCK = 64 * 1024
+CDC_GEAR_TABLES = ["".join(chr(CDC_GEAR[i] >> (8 * n) & 0xFF) for i in range(256)) for n in range(4)]
+
+# Local catalog of remote objects, see RemoteCatalog.
+DEFAULT_CATALOG = "~/.pycloudbackup.catalog"
+LIST_PAGE_SIZE = 10000 # Cloud Files won't return more per listing request
+
+# Glacier inventory, see GlacierInventory. Changes are pushed to S3 as delta
+# objects once inventory_batch are pending, the deltas are folded into the
+# snapshot every INVENTORY_COMPACT_DELTAS pushes.
+DEFAULT_GLACIER_INVENTORY = "~/.pycloudbackup.glacier"
+DEFAULT_INVENTORY_BATCH = 1
+INVENTORY_COMPACT_DELTAS = 100
+
+# Glacier retrievals, see GlacierBackend.retrieve. Jobs take hours, polling
+# backs off up to GLACIER_POLL_MAX_SECS. Outputs are fetched in ranges.
+GLACIER_POLL_SECS = 60
+GLACIER_POLL_MAX_SECS = 900
+GLACIER_RANGE_SIZE = 64 * 1024 * 1024 # a multiple of 1 MB, so ranges come with a tree hash
+
+# Compression, see CODECS. auto stores files uncompressed when their first
+# AUTO_SAMPLE_SIZE bytes don't shrink by at least AUTO_MIN_SAVING.
+DEFAULT_COMPRESSION = "gzip"
+AUTO_SAMPLE_SIZE = 256 * 1024
+AUTO_MIN_SAVING = 0.1
+PGZIP_BLOCK_SIZE = 1024 * 1024 # pigz codec: input block deflated per thread
+
+# Small-file packing, see backup with a list of files. Each pack has a
+# sidecar index <pack>.idx mapping the original paths to their offset in it.
+PACK_PREFIX = "pack-"
+PACK_INDEX_SUFFIX = ".idx"
+DEFAULT_PACK_SIZE_MB = 256
+
+# Seekable archives, see SeekableWriter. The tar is cut in blocks compressed
+# and encrypted on their own, with a trailing index of blocks and members, so
+# restore --member only reads the byte ranges it needs.
+SEEKABLE_SUFFIX = ".tar.seek"
+SEEKABLE_MAGIC = "PCBSEEK"
+SEEKABLE_VERSION = 1
+SEEKABLE_BLOCK_SIZE = 1024 * 1024 # one aes record per block
+SEEKABLE_RANGE_SIZE = 8 * 1024 * 1024 # blocks fetched per ranged read
+SEEKABLE_HEADER = struct.Struct(">7sBH") # magic, version, length of the JSON header
+SEEKABLE_FRAME = struct.Struct(">BI") # kind, payload length
+SEEKABLE_FOOTER = struct.Struct(">QI8s8s7sB") # index offset and length, codec, cipher, magic, version
+SEEKABLE_BLOCK, SEEKABLE_INDEX = 0, 1
+
+# Encryption, see CIPHERS. The aes format derives its key once per run with
+# PBKDF2 (the iterations are stored in the header) and seals AES_CHUNK_SIZE
+# chunks independently, in parallel.
+DEFAULT_ENCRYPTION = "aes" if AES is not None else "beefish"
+AES_MAGIC = "PCBAES"
+AES_VERSION = 1
+AES_KDF_ITERATIONS = 100000
+AES_CHUNK_SIZE = 1024 * 1024
+AES_HEADER = struct.Struct(">6sBII16s8s") # magic, version, iterations, chunk size, salt, nonce prefix
+AES_RECORD = struct.Struct(">BI") # last chunk flag, ciphertext length
+AES_TAG_SIZE = 16
+
+# Concurrent multi-file backups, see WorkerPool.
+DEFAULT_WORKERS = 1
+DEFAULT_MAX_INFLIGHT_MB = 1024
+
+app = aaargh.App(description="Compress, encrypt and upload files directly to Rackspace Cloudfiles/Amazon S3/Glacier.")
+
+log = logging.getLogger(__name__)
+
+if not log.handlers:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+config = ConfigParser.SafeConfigParser()
+config.read(os.path.expanduser("~/.pycloudbackup.conf"))
+
+class glacier_shelve(object):
+    """
+    Context manager for shelve
+    """
+
+    def __enter__(self):
+        self.shelve = shelve.open(os.path.expanduser("~/.bakthat.db"))
+
+        return self.shelve
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shelve.close()
+
+
+class PipelineError(Exception):
+    """
+    Raised on one end of a BoundedPipe once the pipeline has been aborted.
+    """
+
+
+class ArchiveNotReady(PipelineError):
+    """
+    Raised by the download stage when the archive can't be fetched yet
+    (Glacier retrieval job still running).
+    """
+
+
+class BoundedPipe(object):
+    """
+    In-memory pipe connecting two pipeline stages running in different threads.
+    Writes are coalesced into PIPE_CHUNK_SIZE chunks and block once max_chunks
+    are waiting, so memory stays bounded whatever the size of the data. The
+    bytes written and the time each end spent blocked are kept for Metrics.
+    """
+    def __init__(self, max_chunks=PIPE_MAX_CHUNKS):
+        self.queue = Queue.Queue(max_chunks)
+        self.error = None
+        self.bytes = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+        self._wbuf = []
+        self._wlen = 0
+        self._rchunk = ""
+        self._rpos = 0
+        self._eof = False
+
+    def _check(self):
+        if isinstance(self.error, PipelineError):
+            raise self.error
+        if self.error is not None:
+            raise PipelineError("Pipeline aborted: {}".format(self.error))
+
+    def _put(self, item):
+        start = time.time()
+        while True:
+            self._check()
+            try:
+                self.queue.put(item, timeout=PIPE_POLL_SECS)
+                self.put_wait += time.time() - start
+                return
+            except Queue.Full:
+                pass
+
+    def _get(self):
+        start = time.time()
+        while True:
+            self._check()
+            try:
+                item = self.queue.get(timeout=PIPE_POLL_SECS)
+                self.get_wait += time.time() - start
+                return item
+            except Queue.Empty:
+                pass
+
+    def _flush(self):
+        if self._wbuf:
+            self._put("".join(self._wbuf))
+            self._wbuf = []
+            self._wlen = 0
+
+    def write(self, data):
+        if not data:
+            return
+        self.bytes += len(data)
+        self._wbuf.append(data)
+        self._wlen += len(data)
+        if self._wlen >= PIPE_CHUNK_SIZE:
+            self._flush()
+
+    def close(self):
+        """ Flush pending writes and signal end of stream to the reader. """
+        self._flush()
+        self._put(None)
+
+    def abort(self, error):
+        """ Fail the pipe, both ends raise PipelineError from now on. """
+        self.error = error
+
+    def read(self, size=-1):
+        """ Blocks until size bytes are available, returns less only at EOF. """
+        parts = []
+        wanted = size
+        while size < 0 or wanted > 0:
+            if self._rpos >= len(self._rchunk):
+                if self._eof:
+                    break
+                item = self._get()
+                if item is None:
+                    self._eof = True
+                    break
+                self._rchunk = item
+                self._rpos = 0
+            available = len(self._rchunk) - self._rpos
+            take = available if size < 0 else min(wanted, available)
+            parts.append(self._rchunk[self._rpos:self._rpos + take])
+            self._rpos += take
+            wanted -= take
+        return "".join(parts)
+
+
+class Pipeline(object):
+    """
+    Chain of stages, each running in its own thread and connected by
+    BoundedPipes. A stage is called as func(source, sink, *args), the first
+    stage gets source=None. The last stage's output is read from self.output.
+    """
+    def __init__(self):
+        self.pipes = []
+        self.threads = []
+        self.output = None
+        self.stages = []
+
+    def add(self, func, *args):
+        source = self.output
+        sink = BoundedPipe()
+        timing = [func.__name__.replace("_stage", ""), source, sink, time.time(), None]
+        self.stages.append(timing)
+
+        def stage():
+            try:
+                func(source, sink, *args)
+                sink.close()
+            except Exception as err:
+                log.error("Pipeline stage {} failed: {}".format(func.__name__, err))
+                self.abort(err)
+            finally:
+                timing[4] = time.time()
+
+        thread = threading.Thread(target=stage, name=func.__name__)
+        thread.daemon = True
+        thread.start()
+
+        self.pipes.append(sink)
+        self.threads.append(thread)
+        self.output = sink
+
+    def abort(self, error):
+        for pipe in self.pipes:
+            if pipe.error is None:
+                pipe.abort(error)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def record(self, metrics):
+        """ Add the wall time, busy time and bytes of every stage to metrics. """
+        for name, source, sink, start, end in self.stages:
+            waited = sink.put_wait + (source.get_wait if source else 0.0)
+            metrics.record(name, (end or time.time()) - start, source.bytes if source else None, sink.bytes, waited)
+
+
+class BackendPool(object):
+    """
+    Keeps up to size authenticated backends around for a whole run, so the
+    auth round-trip and the container/bucket lookup are paid once per worker
+    instead of once per file. A backend whose operation raised is dropped,
+    the next session() gets a fresh one.
+    """
+    def __init__(self, destination="cloudfiles", conf=None, size=1):
+        self.destination = destination
+        self.conf = conf
+        self.size = max(1, int(size))
+        self.created = 0
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+        self.remote_catalog = None
+
+    def acquire(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except Queue.Empty:
+                pass
+
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                break
+
+            try:
+                return self.idle.get(timeout=PIPE_POLL_SECS)
+            except Queue.Empty:
+                pass
+
+        try:
+            return storage_backends[self.destination](self.conf)
+        except:
+            self.discard()
+            raise
+
+    def release(self, backend):
+        self.idle.put(backend)
+
+    def discard(self):
+        with self.lock:
+            self.created -= 1
+
+    @contextmanager
+    def session(self):
+        backend = self.acquire()
+        try:
+            yield backend
+        except:
+            self.discard()
+            raise
+        self.release(backend)
+
+    def catalog(self):
+        """ The RemoteCatalog of this destination, opened once and shared by the workers. """
+        if self.remote_catalog is None:
+            with self.session() as storage_backend:
+                remote_catalog = open_catalog(storage_backend, self.destination, self.conf)
+            with self.lock:
+                if self.remote_catalog is None:
+                    self.remote_catalog = remote_catalog
+        return self.remote_catalog
+
+
+class WorkerPool(object):
+    """
+    Runs jobs on a fixed number of threads. submit() blocks while the sizes of
+    the jobs in flight add up to more than max_inflight_bytes, a single job
+    bigger than the budget still runs but alone. A failed job is logged and
+    recorded, it doesn't stop the other ones.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_MB * 1024 * 1024):
+        self.workers = max(1, int(workers))
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight = 0
+        self.failures = []
+        self.cond = threading.Condition()
+        self.queue = Queue.Queue(self.workers)
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="worker-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, size, *args):
+        """ Queue func(*args), size is the number of bytes it will handle. """
+        with self.cond:
+            while self.inflight and self.inflight + size > self.max_inflight_bytes:
+                self.cond.wait()
+            self.inflight += size
+        self.queue.put((func, size, args))
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            func, size, args = job
+            try:
+                func(*args)
+            except Exception as err:
+                log.error("{}{} failed: {}".format(func.__name__, args, err))
+                with self.cond:
+                    self.failures.append((args, err))
+            finally:
+                with self.cond:
+                    self.inflight -= size
+                    self.cond.notify_all()
+
+    def join(self):
+        """ Wait for every submitted job, returns the list of (args, error) failures. """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.failures
+
+
+class TransientError(Exception):
+    """
+    A request failed in a way worth retrying that the client library doesn't
+    report as a network error (a short read...), see retryable.
+    """
+
+
+def retryable(err):
+    """
+    Whether the request that raised err is worth replaying: network errors,
+    timeouts, throttling and server side errors. Anything else (missing
+    object, bad credentials, local errors) fails straight away.
+    """
+    if isinstance(err, (socket.error, httplib.HTTPException, StorageDataError, TransientError)):
+        return True
+    if isinstance(err, (ResponseError, BotoServerError)):
+        return err.status >= 500 or err.status in RETRY_STATUSES
+    return False
+
+
+def retry_delay(attempt):
+    """ Exponential backoff with full jitter, so workers don't retry in waves. """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def retry_request(breaker, what, func, rewind=None, retries=REQUEST_RETRIES):
+    """
+    Run func, one request, through breaker, replaying it up to retries times
+    on retryable errors with retry_delay backoff. rewind is called before
+    every replay, if it is None the request can't be replayed and the error
+    is raised, like CloudfilesBackend.reauth_on_401. Only this request is
+    replayed, its body is rewound, the pipeline feeding it carries on.
+    """
+    for attempt in range(retries + 1):
+        breaker.wait()
+        try:
+            result = func()
+        except Exception as err:
+            if not retryable(err):
+                breaker.answered(isinstance(err, (ResponseError, NoSuchObject, BotoServerError)))
+                raise
+            breaker.failed()
+            if rewind is None or attempt == retries:
+                raise
+            delay = retry_delay(attempt)
+            log.warn("{} failed ({}), retrying in {:.1f}s...".format(what, err, delay))
+            time.sleep(delay)
+            rewind()
+        else:
+            breaker.answered()
+            return result
+
+
+class CircuitBreaker(object):
+    """
+    Shared by the backends of one destination. After CIRCUIT_FAILURES
+    retryable failures in a row the circuit opens: every request waits in
+    wait() for the cooldown, pausing the whole worker pool instead of each
+    worker burning its retries against an outage. Then one request goes
+    through as a probe, its success closes the circuit, its failure opens
+    it again for twice as long.
+    """
+    def __init__(self, name, failures=CIRCUIT_FAILURES, cooldown=CIRCUIT_COOLDOWN):
+        self.name = name
+        self.threshold = failures
+        self.base_cooldown = self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = None # None while closed
+        self.probe = None # thread sending the probe request
+        self.cond = threading.Condition()
+
+    def wait(self):
+        """ Block while the circuit is open, or until this request is let through as the probe. """
+        with self.cond:
+            while self.opened_until is not None:
+                if self.probe is None and time.time() >= self.opened_until:
+                    self.probe = threading.current_thread()
+                    return
+                self.cond.wait(max(min(self.opened_until - time.time(), PIPE_POLL_SECS), 0.01))
+
+    def answered(self, reached=True):
+        """
+        The request got through, or failed in a way that says nothing about an
+        outage (reached False: a local error). A probe that got an answer
+        closes the circuit.
+        """
+        with self.cond:
+            probing = self.probe is threading.current_thread()
+            if probing:
+                self.probe = None
+            if reached:
+                if self.opened_until is not None:
+                    log.info("{}: requests are going through again, resuming".format(self.name))
+                self.failures = 0
+                self.opened_until = None
+                self.cooldown = self.base_cooldown
+            self.cond.notify_all()
+
+    def failed(self):
+        """ A retryable failure. """
+        with self.cond:
+            self.failures += 1
+            if self.probe is threading.current_thread():
+                self.probe = None
+                self.cooldown = min(self.cooldown * 2, CIRCUIT_MAX_COOLDOWN)
+                self.open()
+            elif self.opened_until is None and self.failures >= self.threshold:
+                self.open()
+            self.cond.notify_all()
+
+    def open(self):
+        log.warn("{}: {} failed requests in a row, pausing requests for {}s".format(self.name, self.failures,
+                                                                                  self.cooldown))
+        self.opened_until = time.time() + self.cooldown
+
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def circuit_breaker(destination):
+    """ The CircuitBreaker shared by every backend of destination in this process. """
+    with circuit_breakers_lock:
+        if destination not in circuit_breakers:
+            circuit_breakers[destination] = CircuitBreaker(destination)
+        return circuit_breakers[destination]
+
+
+class HashingFile(object):
+    """
+    Passes reads and writes through to fileobj, feeding the bytes to md5 and
+    sha256.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def write(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def checksums(self):
+        """ md5/sha256/size of what went through. """
+        return dict(md5=self.md5.hexdigest(), sha256=self.sha256.hexdigest(), size=self.size)
+
+
+class ProgressReader(object):
+    """ Passes reads through to fileobj, telling cb(transferred, total) as they go. """
+    def __init__(self, fileobj, cb, total=None):
+        self.fileobj = fileobj
+        self.cb = cb
+        self.total = total
+        self.transferred = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.transferred += len(data)
+        self.cb(self.transferred, self.total)
+        return data
+
+
+class ProgressWriter(object):
+    """ Same as ProgressReader for writes. """
+    def __init__(self, fileobj, cb, total=None):
+        self.fileobj = fileobj
+        self.cb = cb
+        self.total = total
+        self.transferred = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.transferred += len(data)
+        self.cb(self.transferred, self.total)
+
+
+class Progress(object):
+    """
+    Progress of one upload or download, fed by backend callbacks
+    cb(transferred, total), possibly from several threads at once (one
+    callback per segment or range). on_progress gets a
+    name/done/total/rate/eta dict at most every PROGRESS_INTERVAL seconds
+    and once more at the end. total and eta are None when the size isn't
+    known up front (streaming uploads).
+    """
+    def __init__(self, name, total, on_progress):
+        self.name = name
+        self.total = total
+        self.on_progress = on_progress
+        self.parts = {}
+        self.lock = threading.Lock()
+        self.start = self.reported = time.time()
+
+    def callback(self, part=None):
+        """
+        A cb(transferred, total) for one part of the transfer (the whole of it
+        by default), transferred counting from the start of the part.
+        """
+        def cb(transferred, total=None):
+            with self.lock:
+                self.parts[part] = transferred
+                if self.total is None and part is None and total:
+                    self.total = total # Whole object downloads know their size once started.
+            self.report()
+        return cb
+
+    def add(self, part, size):
+        """ part of size bytes is done. """
+        self.callback(part)(size)
+
+    def report(self, final=False):
+        now = time.time()
+        with self.lock:
+            if not final and now - self.reported < PROGRESS_INTERVAL:
+                return
+            self.reported = now
+            done = sum(self.parts.values())
+        rate = done / max(now - self.start, 1e-6)
+        eta = None
+        if self.total is not None and rate:
+            eta = max(self.total - done, 0) / rate
+        self.on_progress(dict(name=self.name, done=done, total=self.total, rate=rate, eta=eta))
+
+    def finish(self):
+        self.report(final=True)
+
+
+def log_progress(progress):
+    """ on_progress callback logging the progress dicts, used by --progress. """
+    message = "{}: {:.1f} MB at {:.1f} MB/s".format(progress["name"], progress["done"] / 1048576.0,
+                                                    progress["rate"] / 1048576.0)
+    if progress["total"]:
+        message += ", {:.0%} of {:.1f} MB".format(float(progress["done"]) / progress["total"],
+                                                  progress["total"] / 1048576.0)
+    if progress["eta"] is not None:
+        message += ", ETA {}".format(timedelta(seconds=int(progress["eta"])))
+    log.info(message)
+
+
+def new_progress(name, total, on_progress):
+    """ A Progress for name if there is someone to tell, else None. """
+    return Progress(name, total, on_progress) if on_progress else None
+
+
+class TimedWriter(object):
+    """ Passes writes through to fileobj, adding up the bytes and the time spent in them. """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        self.seconds = 0.0
+
+    def write(self, data):
+        start = time.time()
+        self.fileobj.write(data)
+        self.seconds += time.time() - start
+        self.size += len(data)
+
+    def close(self):
+        start = time.time()
+        self.fileobj.close()
+        self.seconds += time.time() - start
+
+
+class Metrics(object):
+    """
+    Wall time, busy time (not spent waiting on the neighbour stages of a
+    pipeline) and bytes in and out of each stage of one backup or restore.
+    Telling which stage is the busiest says if a run was disk, CPU or
+    network bound. Collected per run by RunMetrics.
+    """
+    def __init__(self, name, operation="backup"):
+        self.name = name
+        self.operation = operation
+        self.stages = collections.OrderedDict()
+        self.start = time.time()
+        self.seconds = None
+
+    def record(self, stage, seconds, bytes_in=None, bytes_out=None, waited=0.0):
+        totals = self.stages.setdefault(stage, dict(seconds=0.0, busy_seconds=0.0, bytes_in=None, bytes_out=None))
+        totals["seconds"] += seconds
+        totals["busy_seconds"] += max(seconds - waited, 0.0)
+        for key, value in (("bytes_in", bytes_in), ("bytes_out", bytes_out)):
+            if value is not None:
+                totals[key] = (totals[key] or 0) + value
+
+    @contextmanager
+    def timed(self, stage):
+        """ Times the block as stage, the block fills in bytes_in/bytes_out of the dict it gets. """
+        counts = dict(bytes_in=None, bytes_out=None)
+        start = time.time()
+        yield counts
+        self.record(stage, time.time() - start, **counts)
+
+    def finish(self):
+        self.seconds = time.time() - self.start
+        return self
+
+    def as_dict(self):
+        stages = [stage_summary(stage, totals) for stage, totals in self.stages.items()]
+        sizes = [stage["bytes_out"] for stage in stages if stage["bytes_out"] is not None]
+        # What went in is the first stage's output (the tar stream, or the download).
+        bytes_in = sizes[0] if sizes else None
+        bytes_out = sizes[-1] if sizes else None
+        return dict(name=self.name, operation=self.operation, seconds=self.seconds, bytes_in=bytes_in,
+                    bytes_out=bytes_out, ratio=ratio(bytes_out, bytes_in), stages=stages)
+
+
+def ratio(bytes_out, bytes_in):
+    if not bytes_in or bytes_out is None:
+        return None
+    return float(bytes_out) / bytes_in
+
+
+def stage_summary(stage, totals):
+    """ totals of stage with its compression ratio and throughput (of bytes in, else out) added. """
+    size = totals["bytes_in"] if totals["bytes_in"] is not None else totals["bytes_out"]
+    return dict(totals, stage=stage, ratio=ratio(totals["bytes_out"], totals["bytes_in"]),
+                mb_per_sec=size / 1048576.0 / totals["seconds"] if size is not None and totals["seconds"] else None)
+
+
+class RunMetrics(object):
+    """
+    Metrics of every backup (or restore) of a run, summed up by stage and
+    written as a JSON summary and as a Prometheus textfile collector file
+    (node_exporter --collector.textfile.directory). Both are replaced
+    atomically so readers never see half a file.
+    """
+    def __init__(self, operation="backup"):
+        self.operation = operation
+        self.lock = threading.Lock()
+        self.files = []
+        self.stages = collections.OrderedDict()
+        self.failures = 0
+        self.start = time.time()
+
+    def add(self, metrics):
+        summary = metrics.as_dict()
+        with self.lock:
+            self.files.append(summary)
+            for stage in summary["stages"]:
+                totals = self.stages.setdefault(stage["stage"], dict(seconds=0.0, busy_seconds=0.0,
+                                                                     bytes_in=None, bytes_out=None))
+                totals["seconds"] += stage["seconds"]
+                totals["busy_seconds"] += stage["busy_seconds"]
+                for key in ("bytes_in", "bytes_out"):
+                    if stage[key] is not None:
+                        totals[key] = (totals[key] or 0) + stage[key]
+
+    def fail(self, count=1):
+        with self.lock:
+            self.failures += count
+
+    def summary(self):
+        with self.lock:
+            files = list(self.files)
+            stages = [stage_summary(stage, totals) for stage, totals in self.stages.items()]
+        seconds = time.time() - self.start
+        bytes_in = sum(f["bytes_in"] or 0 for f in files)
+        bytes_out = sum(f["bytes_out"] or 0 for f in files)
+        return dict(operation=self.operation, started=self.start, seconds=seconds, files=len(files),
+                    failures=self.failures, bytes_in=bytes_in, bytes_out=bytes_out,
+                    ratio=ratio(bytes_out, bytes_in), mb_per_sec=bytes_in / 1048576.0 / seconds,
+                    files_per_sec=len(files) / seconds, stages=stages, per_file=files)
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.summary(), indent=2, sort_keys=True))
+
+    def write_textfile(self, path):
+        summary = self.summary()
+        labels = 'operation="{}"'.format(self.operation)
+        lines = []
+
+        def metric(name, text, samples):
+            lines.append("# HELP pycloudbackup_{} {}".format(name, text))
+            lines.append("# TYPE pycloudbackup_{} gauge".format(name))
+            for sample_labels, value in samples:
+                if value is not None:
+                    lines.append("pycloudbackup_{}{{{}}} {}".format(name, sample_labels, repr(float(value))))
+
+        metric("run_seconds", "Wall time of the last run.", [(labels, summary["seconds"])])
+        metric("run_files", "Files (or packs) processed by the last run.", [(labels, summary["files"])])
+        metric("run_failures", "Files (or packs) that failed in the last run.", [(labels, summary["failures"])])
+        metric("run_bytes_in", "Bytes read by the last run, before compression.", [(labels, summary["bytes_in"])])
+        metric("run_bytes_out", "Bytes stored (or restored) by the last run.", [(labels, summary["bytes_out"])])
+        metric("run_timestamp_seconds", "When the last run finished.", [(labels, time.time())])
+        for name, key, text in (("stage_seconds", "seconds", "Wall time spent in each stage."),
+                                ("stage_busy_seconds", "busy_seconds", "Time each stage was not waiting on its neighbours."),
+                                ("stage_bytes_in", "bytes_in", "Bytes into each stage."),
+                                ("stage_bytes_out", "bytes_out", "Bytes out of each stage.")):
+            metric(name, text, [('{},stage="{}"'.format(labels, stage["stage"]), stage[key])
+                                for stage in summary["stages"]])
+        write_atomically(path, "\n".join(lines) + "\n")
+
+    def write(self, json_path=None, textfile_path=None):
+        if json_path:
+            self.write_json(os.path.expanduser(json_path))
+        if textfile_path:
+            self.write_textfile(os.path.expanduser(textfile_path))
+
+
+def write_atomically(path, data):
+    """ Replace path with data, through a temporary file renamed over it. """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+class RunJournal(object):
+    """
+    Crash-safe record of a multi-file backup run, kept in SQLite. Every file
+    goes queued -> compressed -> uploaded -> deleted, with its remote name and
+    md5. If a run dies, the next one resumes it: files already uploaded are not
+    sent again, only their pending delete is done. A run that completes
+    without failures is closed and its rows dropped.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS runs (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               started REAL, finished REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                               run INTEGER, path TEXT, size INTEGER, mtime REAL,
+                               state TEXT, remote_name TEXT, checksum TEXT, updated REAL,
+                               PRIMARY KEY (run, path))""")
+        row = self.db.execute("SELECT id FROM runs WHERE finished IS NULL ORDER BY id DESC LIMIT 1").fetchone()
+        if row:
+            self.run = row[0]
+            log.info("Resuming unfinished backup run {} from {}".format(self.run, path))
+        else:
+            self.run = self.db.execute("INSERT INTO runs (started) VALUES (?)", (time.time(),)).lastrowid
+        self.db.commit()
+
+    def lookup(self, path, st):
+        """ State of path in this run, None if unknown or modified since. """
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, state FROM files WHERE run = ? AND path = ?",
+                                  (self.run, path)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime:
+            return None
+        return row[2]
+
+    def record(self, path, state, st=None, remote_name=None, checksum=None):
+        with self.lock:
+            if st is not None:
+                self.db.execute("INSERT OR REPLACE INTO files (run, path, size, mtime, state, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                                (self.run, path, st.st_size, st.st_mtime, state, time.time()))
+            else:
+                self.db.execute("""UPDATE files SET state = ?, updated = ?,
+                                       remote_name = COALESCE(?, remote_name), checksum = COALESCE(?, checksum)
+                                   WHERE run = ? AND path = ?""",
+                                (state, time.time(), remote_name, checksum, self.run, path))
+            self.db.commit()
+
+    def finish(self):
+        """ Close the run, the next one starts from scratch. """
+        with self.lock:
+            self.db.execute("UPDATE runs SET finished = ? WHERE id = ?", (time.time(), self.run))
+            self.db.execute("DELETE FROM files WHERE run = ?", (self.run,))
+            self.db.commit()
+
+
+def file_digest(path):
+    """ sha256 of a file's content, read in PIPE_CHUNK_SIZE blocks. """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(PIPE_CHUNK_SIZE)
+            if not data:
+                return digest.hexdigest()
+            digest.update(data)
+
+
+class FileIndex(object):
+    """
+    Local index of backed up files for incremental runs, kept in SQLite and
+    keyed by path: size, mtime, inode, sha256 and remote object name. A file
+    whose stat signature is unchanged is skipped without being read, the
+    content is only hashed when the signature changed (touched files with the
+    same content are not uploaded again either).
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                               path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER,
+                               hash TEXT, remote_name TEXT, updated REAL)""")
+        self.db.commit()
+
+    def get(self, path):
+        with self.lock:
+            return self.db.execute("SELECT size, mtime, inode, hash, remote_name FROM files WHERE path = ?",
+                                   (path,)).fetchone()
+
+    def unchanged(self, path, st):
+        """ True if the stat signature matches the index, nothing is read. """
+        row = self.get(path)
+        return row is not None and tuple(row[:3]) == (st.st_size, st.st_mtime, st.st_ino)
+
+    def content_changed(self, path, st):
+        """
+        Hash the file and return the digest if its content differs from the
+        indexed one. Returns None if it is the same, refreshing the stat signature.
+        """
+        row = self.get(path)
+        digest = file_digest(path)
+        if row is None or row[3] != digest:
+            return digest
+        self.update(path, st, digest, row[4])
+        return None
+
+    def update(self, path, st, digest, remote_name):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (path, st.st_size, st.st_mtime, st.st_ino, digest, remote_name, time.time()))
+            self.db.commit()
+
+
+class RemoteCatalog(object):
+    """
+    Local SQLite catalog of the objects stored in one container, bucket or
+    vault: name, size, hash and last_modified. Prefix lookups are a range
+    query on the name index, so they cost the same whatever the size of the
+    container. backup and delete keep it current, sync() refreshes it from the
+    remote listing, incrementally from the last name seen.
+    """
+    def __init__(self, path, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS objects (
+                               store TEXT, name TEXT, size INTEGER, hash TEXT,
+                               last_modified TEXT, seen REAL,
+                               PRIMARY KEY (store, name))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS syncs (
+                               store TEXT PRIMARY KEY, marker TEXT, synced REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS checksums (
+                               store TEXT, name TEXT, size INTEGER, md5 TEXT, sha256 TEXT,
+                               etag TEXT, uploaded REAL,
+                               PRIMARY KEY (store, name))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS members (
+                               store TEXT, path TEXT, pack TEXT, offset INTEGER, size INTEGER,
+                               PRIMARY KEY (store, path, pack))""")
+        self.db.commit()
+
+    def add(self, name, size=None, hash=None, last_modified=None):
+        if last_modified is None:
+            last_modified = datetime.utcnow().isoformat()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+                            (self.store, name, size, hash, last_modified, time.time()))
+            self.db.commit()
+
+    def remove(self, name):
+        with self.lock:
+            self.db.execute("DELETE FROM objects WHERE store = ? AND name = ?", (self.store, name))
+            self.db.execute("DELETE FROM members WHERE store = ? AND pack = ?", (self.store, name))
+            self.db.execute("DELETE FROM checksums WHERE store = ? AND name = ?", (self.store, name))
+            self.db.commit()
+
+    def record_upload(self, name, size, md5, sha256, etag):
+        """
+        Local manifest of what was uploaded: the checksums computed while the
+        object was produced and the ETag the server should report for it.
+        """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (self.store, name, size, md5, sha256, etag, time.time()))
+            self.db.commit()
+
+    def checksums(self, prefix=""):
+        """ {name: (size, md5, sha256, etag)} of the uploads recorded under prefix. """
+        sql = "SELECT name, size, md5, sha256, etag FROM checksums WHERE store = ? AND name >= ?"
+        args = [self.store, prefix]
+        if prefix:
+            sql += " AND name < ?"
+            args.append(prefix_upper_bound(prefix))
+        with self.lock:
+            return dict((row[0], row[1:]) for row in self.db.execute(sql, args))
+
+    def add_members(self, pack, members):
+        """ Record the (path, offset, size) members of a pack, as listed in its sidecar index. """
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)",
+                                [(self.store, path, pack, offset, size) for path, offset, size in members])
+            self.db.commit()
+
+    def find_member(self, path):
+        """ Newest pack holding the file path, None if no pack does. """
+        with self.lock:
+            row = self.db.execute("""SELECT pack FROM members WHERE store = ? AND path = ?
+                                     ORDER BY pack DESC LIMIT 1""", (self.store, path)).fetchone()
+        return row[0] if row else None
+
+    def load_pack_indexes(self, storage_backend):
+        """ Fetch the sidecar index of every pack not recorded yet, e.g. packs stored from another host. """
+        with self.lock:
+            known = set(row[0] for row in self.db.execute("SELECT DISTINCT pack FROM members WHERE store = ?",
+                                                          (self.store,)))
+        for name in self.names(PACK_PREFIX):
+            if name.endswith(PACK_INDEX_SUFFIX) and name[:-len(PACK_INDEX_SUFFIX)] not in known:
+                out = storage_backend.download(name)
+                if out is None:
+                    continue # Glacier, the retrieval job was only started.
+                pack_index = json.loads(out.read())
+                self.add_members(pack_index["pack"], pack_index["members"])
+
+    def prefix_query(self, columns, prefix, order="ASC", limit=-1):
+        """ Rows whose name starts with prefix, as a range scan of the primary key. """
+        sql = "SELECT {} FROM objects WHERE store = ? AND name >= ?".format(columns)
+        args = [self.store, prefix]
+        if prefix:
+            sql += " AND name < ?"
+            args.append(prefix_upper_bound(prefix))
+        sql += " ORDER BY name {} LIMIT ?".format(order)
+        args.append(limit)
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def names(self, prefix=""):
+        return [row[0] for row in self.prefix_query("name", prefix)]
+
+    def latest(self, prefix):
+        """ Last name starting with prefix in sort order, None if there is none. """
+        rows = self.prefix_query("name", prefix, "DESC", 1)
+        return rows[0][0] if rows else None
+
+    def synced(self):
+        """ (marker, time) of the last sync, None if never synced. """
+        with self.lock:
+            return self.db.execute("SELECT marker, synced FROM syncs WHERE store = ?", (self.store,)).fetchone()
+
+    def sync(self, storage_backend, full=False):
+        """
+        Page through the remote listing and record it. Incremental syncs start
+        after the last name seen, a full one relists everything and forgets
+        the objects that were deleted behind our back.
+        """
+        started = time.time()
+        last = self.synced()
+        marker = None if full or last is None else last[0]
+        count = 0
+        while True:
+            page = storage_backend.list_page(marker, LIST_PAGE_SIZE)
+            if not page:
+                break
+            marker = page[-1]["name"]
+            count += len(page)
+            with self.lock:
+                self.db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+                                    [(self.store, entry["name"], entry["size"], entry["hash"],
+                                      entry["last_modified"], started) for entry in page])
+                self.db.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)", (self.store, marker, started))
+                self.db.commit()
+        with self.lock:
+            if full:
+                self.db.execute("DELETE FROM objects WHERE store = ? AND seen < ?", (self.store, started))
+            self.db.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)", (self.store, marker, started))
+            self.db.commit()
+        log.info("Catalog of {} synced, {} objects listed".format(self.store, count))
+
+    def sync_prefix(self, storage_backend, prefix):
+        """
+        Relist just the names starting with prefix and record them. Unlike the
+        incremental sync this sees names sorting before the marker and
+        objects overwritten since, and forgets the ones deleted under prefix.
+        """
+        started = time.time()
+        rows = [(self.store, entry["name"], entry["size"], entry["hash"], entry["last_modified"], started)
+                for entry in paged_entries(storage_backend.list_page, prefix=prefix)]
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)", rows)
+            sql = "DELETE FROM objects WHERE store = ? AND seen < ? AND name >= ?"
+            args = [self.store, started, prefix]
+            if prefix:
+                sql += " AND name < ?"
+                args.append(prefix_upper_bound(prefix))
+            self.db.execute(sql, args)
+            self.db.commit()
+        log.info("Catalog of {} synced under {}, {} objects listed".format(self.store, prefix, len(rows)))
+
+
+PREDICATE_RULE = re.compile(r"^(size|age)\s*([<>])\s*(\d+)\s*([a-zA-Z]?)$")
+RULE_UNITS = dict(size=dict(b=1, k=1024, m=1024 ** 2, g=1024 ** 3, t=1024 ** 4),
+                  age=dict(s=1, m=60, h=3600, d=86400, w=7 * 86400))
+
+def parse_rules(value):
+    """
+    Rules out of a config value: one per line or comma separated. A re: rule
+    takes its whole line, so regexes can contain commas.
+    """
+    rules = []
+    for line in (value or "").splitlines():
+        line = line.strip()
+        if line.startswith("re:"):
+            rules.append(line)
+        else:
+            rules.extend(rule.strip() for rule in line.split(",") if rule.strip())
+    return rules
+
+
+class FileMatcher(object):
+    """
+    Include/exclude rules, compiled once into two regexes and a list of
+    predicates. A rule is a glob (matched against the file name, or against
+    the path relative to the walk root if it contains a /), re:<regex>
+    (searched in the relative path), or size/age bounds like size>10M or
+    age<7d (units b k m g t, s m h d w). A file is wanted if it matches one of
+    the include globs/regexes (when there are any), every include bound, and
+    no exclude rule. Directories matching an exclude glob/regex are pruned,
+    the walk doesn't even list them.
+    """
+    def __init__(self, include=(), exclude=()):
+        self.now = time.time()
+        self.include = self.compile(include)
+        self.exclude = self.compile(exclude)
+
+    def compile(self, rules):
+        """ (name regex, path regex, bounds) for rules, the regexes None if unused. """
+        names, paths, bounds = [], [], []
+        for rule in rules:
+            predicate = PREDICATE_RULE.match(rule)
+            if predicate:
+                kind, op, amount, unit = predicate.groups()
+                try:
+                    amount = int(amount) * RULE_UNITS[kind][(unit or dict(size="b", age="s")[kind]).lower()]
+                except KeyError:
+                    raise ValueError("Unknown unit in rule " + rule)
+                bounds.append((kind, op, amount))
+            elif rule.startswith("re:"):
+                paths.append("(?:{})".format(rule[3:]))
+            elif "/" in rule.rstrip("/"):
+                paths.append("^(?:{})".format(fnmatch.translate(rule.rstrip("/"))))
+            else:
+                names.append("(?:{})".format(fnmatch.translate(rule.rstrip("/"))))
+        return (re.compile("|".join(names)) if names else None,
+                re.compile("|".join(paths)) if paths else None,
+                bounds)
+
+    def names_match(self, compiled, relpath):
+        names, paths, bounds = compiled
+        return bool((names and names.match(os.path.basename(relpath))) or (paths and paths.search(relpath)))
+
+    def within(self, bound, st):
+        kind, op, amount = bound
+        value = st.st_size if kind == "size" else self.now - st.st_mtime
+        return value > amount if op == ">" else value < amount
+
+    def wants_dir(self, relpath):
+        """ False if an exclude rule matches the directory, with or without a trailing /. """
+        paths = self.exclude[1]
+        return not (self.names_match(self.exclude, relpath) or (paths and paths.search(relpath + "/")))
+
+    def wants_file(self, relpath, st):
+        names, paths, bounds = self.include
+        if (names or paths) and not self.names_match(self.include, relpath):
+            return False
+        if not all(self.within(bound, st) for bound in bounds):
+            return False
+        if self.names_match(self.exclude, relpath):
+            return False
+        return not any(self.within(bound, st) for bound in self.exclude[2])
+
+
+def prefix_upper_bound(prefix):
+    """ Smallest string sorting after every string starting with prefix. """
+    if isinstance(prefix, str):
+        prefix = prefix.decode("utf-8")
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+def open_catalog(storage_backend, destination, conf):
+    path = os.path.expanduser(get_setting(conf, destination, "catalog", DEFAULT_CATALOG))
+    return RemoteCatalog(path, "{}:{}".format(destination, storage_backend.container))
+
+
+def find_packed(remote_catalog, storage_backend, filename):
+    """
+    Newest pack holding the file filename (its original path), None if no
+    pack does. Sidecar indexes are fetched if the catalog doesn't know it.
+    """
+    pack = remote_catalog.find_member(filename)
+    if pack is None:
+        if remote_catalog.synced() is None:
+            remote_catalog.sync(storage_backend)
+        remote_catalog.load_pack_indexes(storage_backend)
+        pack = remote_catalog.find_member(filename)
+    return pack
+
+
+def find_backup(remote_catalog, storage_backend, filename):
+    """
+    Newest stored name starting with filename, looked up in the catalog. The
+    catalog is synced first if it never was, and the names under filename are
+    relisted if nothing matched: an incremental sync never sees names sorting
+    before its marker, such as those another host uploaded since.
+    """
+    if remote_catalog.synced() is None:
+        remote_catalog.sync(storage_backend)
+    key_name = remote_catalog.latest(filename)
+    if key_name is None:
+        remote_catalog.sync_prefix(storage_backend, filename)
+        key_name = remote_catalog.latest(filename)
+    if key_name and key_name.startswith(PACK_PREFIX) and key_name.endswith(PACK_INDEX_SUFFIX):
+        key_name = key_name[:-len(PACK_INDEX_SUFFIX)] # The pack, not its sidecar index.
+    return key_name
+
+
+def cdc_chunks(stream):
+    """
+    Cut stream into content-defined chunks with a gear rolling hash: a
+    boundary is where the top CDC_AVG_BITS bits of the hash are zero, so an
+    insert only changes the chunks around it and the rest still dedup.
+    """
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < CDC_MAX_CHUNK:
+            data = stream.read(CDC_MAX_CHUNK)
+            if not data:
+                eof = True
+            buf.extend(data)
+        if not buf:
+            return
+
+        # Nothing below CDC_MIN_CHUNK can be a boundary, don't even hash it.
+        cut = gear_boundary(buf, CDC_MIN_CHUNK, min(len(buf), CDC_MAX_CHUNK))
+        yield str(buf[:cut])
+        del buf[:cut]
+
+
+cdc_slot_masks = None
+
+def gear_slot_masks():
+    """ The constants of gear_boundary, one 64 bit slot per byte of a block. """
+    global cdc_slot_masks
+    if cdc_slot_masks is None:
+        boundary = ((1 << CDC_AVG_BITS) - 1) << (32 - CDC_AVG_BITS)
+        cdc_slot_masks = [int("{:016x}".format(value) * (CDC_SCAN_BLOCK + 31), 16)
+                          for value in (boundary, 0xFFFFFFFF, 1 << 32)]
+    return cdc_slot_masks
+
+
+def gear_boundary(buf, start, end):
+    """
+    Hash buf[start:end] a byte at a time, h = ((h << 1) + gear[byte]) &
+    0xFFFFFFFF, and return the index after the first byte leaving the top
+    CDC_AVG_BITS bits of h zero, end if none does. Done that way in Python
+    it runs at a few MB/s, so whole blocks are hashed at once as long
+    arithmetic: a byte is shifted out of h 32 bytes later, so with the gear
+    value of every byte in a 64 bit slot, h at every byte is the sum of 32
+    shifted copies of the block, which never overflows a slot.
+    """
+    boundary, low, carry = gear_slot_masks()
+    pos = start
+    while pos < end:
+        stop = min(pos + CDC_SCAN_BLOCK, end)
+        first = max(start, pos - 31) # The bytes before pos still in its hash.
+        # Slots laid out big endian, last byte first, so hex reads them as one long.
+        data = str(buf[first:stop])[::-1]
+        slots = bytearray(8 * len(data))
+        for n, table in enumerate(CDC_GEAR_TABLES):
+            slots[7 - n::8] = data.translate(table)
+        h = int(binascii.hexlify(slots), 16)
+        for shift in (1, 2, 4, 8, 16):
+            h += h << (shift * 65) # slot i += slot i - shift, times 2 ** shift
+        # Adding low only carries into bit 32 of the slots with boundary bits set.
+        hits = ((((h & boundary) + low) & carry) ^ carry) >> ((pos - first) * 64)
+        if hits:
+            index = ((hits & -hits).bit_length() - 33) // 64
+            if index < stop - pos:
+                return pos + index + 1
+        pos = stop
+    return end
+
+
+class DedupStore(object):
+    """
+    Deduplicating storage mode on top of any storage backend. The (uncompressed)
+    tar stream is cut into content-defined chunks, each one zlib compressed,
+    optionally encrypted, and stored once as chunks/<id>. The id is the
+    sha256 of the chunk, an HMAC keyed with the password when encrypting. A
+    backup is a small JSON manifest <name>.cdc[.aes|.enc] listing its chunks, so
+    upload and storage scale with what changed, not with the total size.
+    """
+    def __init__(self, backend_pool, segment_pool=None, concurrency=DEFAULT_SEGMENT_CONCURRENCY):
+        self.backend_pool = backend_pool
+        self.segment_pool = segment_pool or backend_pool
+        self.concurrency = concurrency
+        self.known = None
+        self.lock = threading.Lock()
+
+    def load_known(self):
+        """ Chunk ids already stored, listed once per store. """
+        with self.lock:
+            if self.known is None:
+                with self.backend_pool.session() as storage_backend:
+                    self.known = set(name[len(CDC_CHUNK_PREFIX):]
+                                     for name in storage_backend.ls(prefix=CDC_CHUNK_PREFIX))
+        return self.known
+
+    def chunk_id(self, chunk, password):
+        if password:
+            return hmac.new(password, chunk, hashlib.sha256).hexdigest()
+        return hashlib.sha256(chunk).hexdigest()
+
+    def put_chunk(self, chunks, index, chunk, password, cipher, queued):
+        """
+        WorkerPool job storing chunk number index unless it is already stored
+        or queued: its id lands in chunks[index], queued gets the ones this
+        backup uploads. Done here so the next chunks are cut meanwhile.
+        """
+        chunk_id = chunks[index] = self.chunk_id(chunk, password)
+        with self.lock:
+            if chunk_id in self.known or chunk_id in queued:
+                return
+            queued[chunk_id] = len(chunk)
+        payload = StringIO(zlib.compress(chunk, 6))
+        if password:
+            encrypted = StringIO()
+            cipher.encrypt(payload, encrypted, password)
+            payload = encrypted
+        payload.seek(0)
+        with self.segment_pool.session() as storage_backend:
+            etag = storage_backend.upload(CDC_CHUNK_PREFIX + chunk_id, payload)
+        check_etag(CDC_CHUNK_PREFIX + chunk_id, etag, hashlib.md5(payload.getvalue()).hexdigest())
+        with self.lock:
+            self.known.add(chunk_id)
+
+    def store(self, keyname, stream, password):
+        """
+        Chunk stream and store the new chunks, then the manifest. A lease
+        object is held meanwhile, garbage_collect keeps off while it exists:
+        the chunks aren't referenced by a manifest yet, and the ones this
+        backup reuses may be unreferenced leftovers.
+        """
+        lease = "{}{}.{}".format(CDC_LEASE_PREFIX, keyname, os.urandom(6).encode("hex"))
+        with self.backend_pool.session() as storage_backend:
+            storage_backend.upload(lease, StringIO(json.dumps(dict(name=keyname, started=time.time()))))
+        try:
+            return self.store_chunks(keyname, stream, password)
+        finally:
+            try:
+                with self.backend_pool.session() as storage_backend:
+                    storage_backend.delete(lease)
+            except Exception as err:
+                log.warn("Could not release {} ({}), dedup-gc ignores it once it is stale".format(lease, err))
+
+    def store_chunks(self, keyname, stream, password):
+        cipher = cipher_for_name(keyname)
+        self.load_known()
+        pool = WorkerPool(self.concurrency, self.concurrency * CDC_MAX_CHUNK)
+        chunks = []
+        queued = {}
+        size = 0
+        for chunk in cdc_chunks(stream):
+            if pool.failures:
+                break
+            chunks.append(None)
+            size += len(chunk)
+            pool.submit(self.put_chunk, len(chunk), chunks, len(chunks) - 1, chunk, password, cipher, queued)
+        failures = pool.join()
+        new_size = sum(queued.values())
+        if failures:
+            raise UploadError("{} chunk(s) of {} failed: {}".format(len(failures), keyname, failures[0][1]))
+
+        manifest = json.dumps(dict(version=1, size=size, compression="zlib",
+                                   encrypted=bool(password), chunks=chunks))
+        md5 = hashlib.md5(manifest).hexdigest()
+        with self.backend_pool.session() as storage_backend:
+            etag = storage_backend.upload(keyname, StringIO(manifest))
+        check_etag(keyname, etag, md5)
+        log.info("Stored {} chunks for {}, {} of {} bytes were new".format(len(chunks), keyname, new_size, size))
+        return dict(name=keyname, md5=md5, sha256=hashlib.sha256(manifest).hexdigest(), size=len(manifest), etag=md5,
+                    stored=new_size)
+
+    def restore_to(self, keyname, fileobj, password):
+        """ Write the original stream of a manifest to fileobj, checking every chunk. """
+        with self.backend_pool.session() as storage_backend:
+            manifest = StringIO()
+            storage_backend.download_to(keyname, manifest)
+            manifest = json.loads(manifest.getvalue())
+            for chunk_id in manifest["chunks"]:
+                payload = StringIO()
+                storage_backend.download_to(CDC_CHUNK_PREFIX + chunk_id, payload)
+                payload.seek(0)
+                if manifest["encrypted"]:
+                    # A chunk keeps the cipher of the backup that stored it first.
+                    decrypted = StringIO()
+                    chunk_cipher = CIPHERS["aes" if payload.getvalue().startswith(AES_MAGIC) else "beefish"]
+                    chunk_cipher.decrypt(payload, decrypted, password)
+                    payload = decrypted
+                chunk = zlib.decompress(payload.getvalue())
+                if self.chunk_id(chunk, password) != chunk_id:
+                    raise IOError("Chunk {} of {} is corrupted".format(chunk_id, keyname))
+                fileobj.write(chunk)
+
+    def garbage_collect(self, grace_hours=DEDUP_GC_GRACE_HOURS):
+        """
+        Delete the chunks no manifest references anymore. Nothing is deleted
+        while a backup holds a lease (see store), and chunks younger than
+        grace_hours are kept anyway.
+        """
+        cutoff = datetime.utcnow() - timedelta(hours=float(grace_hours))
+        remote_catalog = self.backend_pool.catalog()
+        with self.backend_pool.session() as storage_backend:
+            if self.held_leases(storage_backend):
+                return
+            referenced = set()
+            for name in storage_backend.ls():
+                if is_dedup_manifest(name):
+                    manifest = StringIO()
+                    storage_backend.download_to(name, manifest)
+                    referenced.update(json.loads(manifest.getvalue())["chunks"])
+            garbage = [entry["name"] for entry in paged_entries(storage_backend.list_page, prefix=CDC_CHUNK_PREFIX)
+                       if entry["name"][len(CDC_CHUNK_PREFIX):] not in referenced
+                       and not modified_after(entry, cutoff)]
+            # A backup started while the manifests were read.
+            if self.held_leases(storage_backend):
+                return
+            for name in garbage:
+                storage_backend.delete(name)
+                remote_catalog.remove(name)
+        log.info("Deleted {} unreferenced chunks".format(len(garbage)))
+        self.known = None
+
+    def held_leases(self, storage_backend):
+        """ True (and logged) if a running backup holds a lease. Stale ones, see DEDUP_LEASE_HOURS, are deleted. """
+        cutoff = datetime.utcnow() - timedelta(hours=DEDUP_LEASE_HOURS)
+        held = []
+        for entry in paged_entries(storage_backend.list_page, prefix=CDC_LEASE_PREFIX):
+            if modified_after(entry, cutoff):
+                held.append(entry["name"])
+            else:
+                log.info("Deleting stale lease {}".format(entry["name"]))
+                storage_backend.delete(entry["name"])
+        if held:
+            log.warn("Dedup backups are running ({}), not collecting chunks".format(", ".join(held)))
+        return bool(held)
+
+
+class UploadError(Exception):
+    """
+    Raised when a segmented upload could not be completed.
+    """
+
+
+def iter_segments(source, segment_size, tree_hash=False):
+    """
+    Cut source into (fileobj, size) segments spooled to memory, or disk past
+    SEGMENT_SPOOL_MEM. Always yields at least one, possibly empty, segment.
+    Each segment gets the md5 of its data (md5), and with tree_hash the sha256
+    of its data (linear_hash) and of each of its 1 MB chunks (chunk_hashes),
+    as Glacier wants them, all computed while it is spooled.
+    """
+    while True:
+        segment = tempfile.SpooledTemporaryFile(max_size=SEGMENT_SPOOL_MEM)
+        size = 0
+        md5 = hashlib.md5()
+        linear = hashlib.sha256()
+        chunk = hashlib.sha256()
+        chunk_hashes = []
+        while size < segment_size:
+            # Reads never straddle a tree hash chunk boundary.
+            data = source.read(min(PIPE_CHUNK_SIZE, segment_size - size, TREE_HASH_CHUNK - size % TREE_HASH_CHUNK))
+            if not data:
+                break
+            segment.write(data)
+            md5.update(data)
+            size += len(data)
+            if tree_hash:
+                linear.update(data)
+                chunk.update(data)
+                if size % TREE_HASH_CHUNK == 0:
+                    chunk_hashes.append(chunk.digest())
+                    chunk = hashlib.sha256()
+        if tree_hash:
+            if size % TREE_HASH_CHUNK:
+                chunk_hashes.append(chunk.digest())
+            segment.linear_hash = linear.hexdigest()
+            segment.chunk_hashes = chunk_hashes
+        segment.md5 = md5.hexdigest()
+        segment.seek(0)
+        yield segment, size
+        if size < segment_size:
+            return
+
+
+def upload_segment_job(segment_pool, handle, index, offset, segment, parts, progress=None):
+    """
+    WorkerPool job uploading one segment. The backend replays the segment's
+    request on its own (see retry_request), a failure here fails the upload.
+    """
+    upload_kwargs = {}
+    if progress:
+        upload_kwargs = dict(cb=progress.callback(index))
+    try:
+        with segment_pool.session() as storage_backend:
+            parts[index] = storage_backend.upload_segment(handle, index, offset, segment, **upload_kwargs)
+    finally:
+        segment.close()
+
+
+def upload_segmented(storage_backend, segment_pool, keyname, source, segment_size, concurrency, progress=None):
+    """
+    Upload source, seekable or not, in segments of segment_size bytes with up to
+    concurrency segments in flight (each on its own backend from segment_pool),
+    then join them with the backend's manifest/multipart completion. Anything
+    that fits in one segment gets a plain upload. Returns the same
+    (etag, expected) as upload_object.
+    """
+    upload_kwargs = {}
+    if progress:
+        upload_kwargs = dict(cb=progress.callback())
+    segments = iter_segments(source, segment_size, getattr(storage_backend, "tree_hash_segments", False))
+    first = next(segments)
+    second = next(segments, None)
+    if second is None or not second[1]:
+        etag = storage_backend.upload(keyname, first[0], **upload_kwargs)
+        first[0].close()
+        if second is not None:
+            second[0].close()
+        return etag, None
+
+    handle = storage_backend.begin_segmented(keyname, segment_size)
+    log.info("Uploading {} in segments of {} MB...".format(keyname, segment_size / (1024 * 1024)))
+    pool = WorkerPool(concurrency, concurrency * segment_size)
+    parts = {}
+    md5s = []
+    offset = 0
+    count = 0
+    try:
+        for index, (segment, size) in enumerate(itertools.chain([first, second], segments)):
+            if pool.failures or not size:
+                segment.close()
+                break
+            md5s.append(segment.md5)
+            pool.submit(upload_segment_job, size, segment_pool, handle, index, offset, segment, parts, progress)
+            offset += size
+            count += 1
+    except Exception:
+        pool.join()
+        storage_backend.abort_segmented(handle)
+        raise
+
+    failures = pool.join()
+    if failures:
+        storage_backend.abort_segmented(handle)
+        raise UploadError("{} segment(s) of {} failed: {}".format(len(failures), keyname, failures[0][1]))
+
+    etag = storage_backend.complete_segmented(handle, [parts.get(i) for i in range(count)], offset)
+    log.info("Uploaded {} segments ({} bytes) for {}".format(count, offset, keyname))
+    if not hasattr(storage_backend, "segmented_etag"):
+        return None, None
+    return etag, storage_backend.segmented_etag(md5s)
+
+
+def upload_object(storage_backend, segment_pool, keyname, source, segment_size, concurrency, progress=None):
+    """
+    Upload source with the best method the backend has: segmented when it
+    supports it and source is bigger than one segment, else a single upload.
+    Returns (etag, expected): the ETag the server reported (None if the
+    backend has none) and the one it should be for a segmented upload, None
+    meaning the md5 of the data. See check_etag. progress (a Progress) is
+    fed by the backend's upload callbacks.
+    """
+    upload_kwargs = {}
+    if progress:
+        upload_kwargs = dict(cb=progress.callback())
+    if hasattr(source, "seek"):
+        source.seek(0, 2)
+        size = source.tell()
+        source.seek(0)
+        if size <= segment_size or not hasattr(storage_backend, "begin_segmented"):
+            return storage_backend.upload(keyname, source, **upload_kwargs), None
+
+    if hasattr(storage_backend, "begin_segmented"):
+        return upload_segmented(storage_backend, segment_pool, keyname, source, segment_size, concurrency, progress)
+    return storage_backend.upload_stream(keyname, source, **upload_kwargs), None
+
+
+def http_range(offset, length):
+    """ Range header value for length bytes at offset, the last length bytes if offset is negative. """
+    if offset < 0:
+        return "bytes=-{}".format(length)
+    return "bytes={}-{}".format(offset, offset + length - 1)
+
+
+def whole_range(data, offset, length):
+    """ data read for http_range(offset, length), TransientError if it came back short so the GET is replayed. """
+    if offset >= 0 and len(data) != length:
+        raise TransientError("Short read, {} bytes instead of {}".format(len(data), length))
+    return data
+
+
+def check_etag(keyname, etag, expected):
+    """ Raise UploadError if the server's ETag for keyname isn't the one computed while uploading. """
+    if etag and expected and etag != expected:
+        raise UploadError("{} was corrupted in transit, the server has ETag {} instead of {}".format(
+            keyname, etag, expected))
+
+
+config_sections = dict(s3="aws", glacier="aws", cloudfiles="cf")
+
+def get_setting(conf, destination, name, default):
+    """
+    Optional setting from the conf dict when used as a module, else from the
+    destination's section in ~/.pycloudbackup.conf.
+    """
+    if conf is not None:
+        return conf.get(name, default)
+    try:
+        return config.get(config_sections.get(destination, destination), name)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
+
+
+def paged_listing(list_page, prefix=None, delimiter=None, limit=None, marker=None):
+    """
+    Generator behind every backend's ls(): yields names page by page as the
+    listing requests return, asking the server for no more than limit names.
+    """
+    for entry in paged_entries(list_page, prefix, delimiter, limit, marker):
+        yield entry["name"]
+
 
-log = logging.getLogger(__name__)
+def paged_entries(list_page, prefix=None, delimiter=None, limit=None, marker=None):
+    """ Same as paged_listing, yielding the name/size/hash/last_modified dicts. """
+    while limit is None or limit > 0:
+        page_size = LIST_PAGE_SIZE if limit is None else min(limit, LIST_PAGE_SIZE)
+        page = list_page(marker, page_size, prefix, delimiter)
+        if not page:
+            return
+        for entry in page:
+            yield entry
+        if limit is not None:
+            limit -= len(page)
+        marker = page[-1]["name"]
 
-if not log.handlers:
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 
-config = ConfigParser.SafeConfigParser()
-config.read(os.path.expanduser("~/.pycloudbackup.conf"))
+def modified_after(entry, cutoff):
+    """
+    Whether a listing entry was last modified after cutoff (a UTC datetime).
+    Every backend lists ISO 8601 UTC times, True when there is none to tell.
+    """
+    try:
+        return datetime.strptime(str(entry["last_modified"])[:19], "%Y-%m-%dT%H:%M:%S") > cutoff
+    except (TypeError, ValueError):
+        return True
 
-class glacier_shelve(object):
+
+class Codec(object):
     """
-    Context manager for shelve
+    A compression format: the suffix it gives stored names, and factories for
+    its compressor (compress()/flush() objects, like zlib's) and decompressor.
     """
+    def __init__(self, name, suffix, default_level=None, compressor=None, decompressor=None, requires=None):
+        self.name = name
+        self.suffix = suffix
+        self.default_level = default_level
+        self.compressor = compressor
+        self.decompressor = decompressor
+        self.requires = requires
 
-    def __enter__(self):
-        self.shelve = shelve.open(os.path.expanduser("~/.bakthat.db"))
+    def check(self):
+        if self.requires:
+            raise ValueError("The {} codec needs the {} module".format(self.name, self.requires))
 
-        return self.shelve
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.shelve.close()
+class LZ4Compressor(object):
+    """ lz4.frame compressor with the zlib style interface, the frame header goes with the first output. """
+    def __init__(self, level):
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        out = self.header + self.compressor.compress(data)
+        self.header = ""
+        return out
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+class ParallelGzipCompressor(object):
+    """
+    pigz style gzip compressor with the zlib compress()/flush() interface.
+    Input is cut in PGZIP_BLOCK_SIZE blocks deflated independently on a
+    thread pool (zlib releases the GIL), each one ending with a sync flush so
+    the raw deflate outputs join into one stream. The header and the crc32/size
+    trailer are written here: the result is a plain single member gzip file,
+    gunzip and restore read it like any other .tgz.
+    """
+    def __init__(self, level, threads=None):
+        threads = threads or multiprocessing.cpu_count()
+        self.level = level
+        self.pool = ThreadPool(threads)
+        self.max_pending = threads * 2 # bounds memory to a few blocks per thread
+        self.pending = collections.deque()
+        self.buffer = ""
+        self.crc = 0
+        self.size = 0
+        self.header = "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+    @staticmethod
+    def deflate(level, block, last):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def submit(self, block, last=False):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.pool.apply_async(self.deflate, (self.level, block, last)))
+
+    def collect(self, wait):
+        """ Compressed blocks in order: the finished ones, and all of them if wait. """
+        out = [self.header]
+        self.header = ""
+        while self.pending and (wait or len(self.pending) > self.max_pending or self.pending[0].ready()):
+            out.append(self.pending.popleft().get())
+        return "".join(out)
+
+    def compress(self, data):
+        self.buffer += data
+        while len(self.buffer) >= PGZIP_BLOCK_SIZE:
+            self.submit(self.buffer[:PGZIP_BLOCK_SIZE])
+            self.buffer = self.buffer[PGZIP_BLOCK_SIZE:]
+        return self.collect(False)
+
+    def flush(self):
+        self.submit(self.buffer, last=True)
+        self.buffer = ""
+        try:
+            out = self.collect(True)
+        finally:
+            self.close()
+        return out + struct.pack("<II", self.crc & 0xffffffff, self.size & 0xffffffff)
+
+    def close(self):
+        """ Stop the threads, dropping the blocks still queued. flush() does it, callers that abort must. """
+        self.pool.terminate()
+
+
+CODECS = dict(
+    none=Codec("none", ".tar"),
+    # tarfile's w:gz used level 9, it stays the default so archives don't change.
+    gzip=Codec("gzip", ".tgz", 9,
+               lambda level: zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+               lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    # Same output format as gzip, compressed on every core.
+    pigz=Codec("pigz", ".tgz", 6, ParallelGzipCompressor, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    bz2=Codec("bz2", ".tar.bz2", 9, bz2.BZ2Compressor, bz2.BZ2Decompressor),
+    xz=Codec("xz", ".tar.xz", 6, requires=lzma is None and "lzma (backports.lzma)"),
+    zstd=Codec("zstd", ".tar.zst", 3, requires=zstandard is None and "zstandard"),
+    lz4=Codec("lz4", ".tar.lz4", 0, requires=lz4 is None and "lz4"),
+)
+if lzma is not None:
+    CODECS["xz"].compressor = lambda level: lzma.LZMACompressor(preset=level)
+    CODECS["xz"].decompressor = lzma.LZMADecompressor
+if zstandard is not None:
+    CODECS["zstd"].compressor = lambda level: zstandard.ZstdCompressor(level=level).compressobj()
+    CODECS["zstd"].decompressor = lambda: zstandard.ZstdDecompressor().decompressobj()
+if lz4 is not None:
+    CODECS["lz4"].compressor = LZ4Compressor
+    CODECS["lz4"].decompressor = lz4.frame.LZ4FrameDecompressor
+
+
+def parse_codec(value):
+    """ (codec, level) out of none, gzip, gzip:6, zstd:19... """
+    name, _, level = (value or DEFAULT_COMPRESSION).partition(":")
+    if name not in CODECS:
+        raise ValueError("Unknown compression {}, use one of {} or auto".format(name, ", ".join(sorted(CODECS))))
+    codec = CODECS[name]
+    codec.check()
+    return codec, int(level) if level else codec.default_level
+
+
+def choose_codec(filename, value):
+    """
+    The codec for backing up filename. auto compresses a sample of the file
+    and skips compression if it doesn't pay (already compressed data),
+    anything else is passed to parse_codec.
+    """
+    if value != "auto":
+        return parse_codec(value)
+    if not isinstance(filename, list) and os.path.isfile(filename):
+        with open(filename, "rb") as f:
+            sample = f.read(AUTO_SAMPLE_SIZE)
+        if sample and len(zlib.compress(sample, 1)) > len(sample) * (1 - AUTO_MIN_SAVING):
+            log.info("{} doesn't compress, storing it uncompressed".format(filename))
+            return parse_codec("none")
+    return parse_codec(DEFAULT_COMPRESSION)
+
+
+def codec_for_name(keyname):
+    """ The codec of a stored name, from its suffix. Unknown suffixes are gzip, like every old backup. """
+    cipher = cipher_for_name(keyname)
+    if cipher:
+        keyname = keyname[:-len(cipher.suffix)]
+    for codec in sorted(CODECS.values(), key=lambda codec: (-len(codec.suffix), codec.name)):
+        if keyname.endswith(codec.suffix):
+            return codec
+    return CODECS["gzip"]
+
+
+class CompressingWriter(object):
+    """ write() end that compresses into fileobj, close() writes the codec trailer. """
+    def __init__(self, fileobj, codec, level):
+        self.fileobj = fileobj
+        self.compressor = codec.compressor(level) if codec.compressor else None
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if data:
+            self.fileobj.write(data)
+
+    def close(self):
+        try:
+            if self.compressor is not None:
+                self.fileobj.write(self.compressor.flush())
+        finally:
+            self.release()
+
+    def release(self):
+        """ Free the compressor (the threads of ParallelGzipCompressor) without a trailer, for aborted writes. """
+        if hasattr(self.compressor, "close"):
+            self.compressor.close()
+
+
+class DecompressingReader(object):
+    """ read() end decompressing fileobj. """
+    def __init__(self, fileobj, codec):
+        self.fileobj = fileobj
+        self.decompressor = codec.decompressor() if codec.decompressor else None
+        self.buffer = ""
+        self.eof = False
+
+    def read(self, size=-1):
+        if self.decompressor is None:
+            return self.fileobj.read(size)
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.fileobj.read(PIPE_CHUNK_SIZE)
+            if data:
+                self.buffer += self.decompressor.decompress(data)
+            else:
+                self.eof = True
+                if hasattr(self.decompressor, "flush"):
+                    self.buffer += self.decompressor.flush()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class Cipher(object):
+    """
+    An encryption format: the suffix it gives stored names, and its
+    encrypt/decrypt(source, sink, password) functions. Both stream, sink
+    only needs write().
+    """
+    def __init__(self, name, suffix, encrypt=None, decrypt=None, requires=None):
+        self.name = name
+        self.suffix = suffix
+        self.encrypt = encrypt
+        self.decrypt = decrypt
+        self.requires = requires
+
+    def check(self):
+        if self.requires:
+            raise ValueError("The {} encryption needs the {} module".format(self.name, self.requires))
+
+
+def beefish_decrypt(source, sink, password):
+    """ beefish.decrypt, fine with a sink that can't seek. """
+    out = TruncatingWriter(sink)
+    decrypt(source, out, password)
+    out.flush()
+
+
+aes_keys = {}
+aes_salt = os.urandom(16) # one salt, and so one PBKDF2 run, per process
+
+def aes_key(password, salt, iterations):
+    """ The AES-256 key for password, derived once per salt. """
+    key = aes_keys.get((password, salt, iterations))
+    if key is None:
+        key = aes_keys[password, salt, iterations] = hashlib.pbkdf2_hmac("sha256", password, salt, iterations, 32)
+    return key
+
+
+def aes_seal(key, header, index, chunk, last):
+    """ One encrypted record: flag, length, ciphertext and tag. The header and last flag are authenticated. """
+    cipher = AES.new(key, AES.MODE_GCM, nonce=header[-8:] + struct.pack(">I", index))
+    cipher.update(header + chr(last))
+    data, tag = cipher.encrypt_and_digest(chunk)
+    return AES_RECORD.pack(last, len(data)) + data + tag
+
+
+def aes_open(key, header, index, data, last):
+    """ The chunk of one record, IOError if it was tampered with or the password is wrong. """
+    cipher = AES.new(key, AES.MODE_GCM, nonce=header[-8:] + struct.pack(">I", index))
+    cipher.update(header + chr(last))
+    try:
+        return cipher.decrypt_and_verify(data[:-AES_TAG_SIZE], data[-AES_TAG_SIZE:])
+    except ValueError:
+        raise IOError("Chunk {} failed authentication, wrong password or corrupted data".format(index))
+
+
+record_pool = None
+record_pool_lock = threading.Lock()
+
+def shared_record_pool():
+    """
+    The thread pool of parallel_records, one per process: seekable blocks and
+    dedup chunks are encrypted a few records at a time from many threads.
+    """
+    global record_pool
+    with record_pool_lock:
+        if record_pool is None:
+            record_pool = ThreadPool(multiprocessing.cpu_count())
+    return record_pool
+
+
+def parallel_records(sink, records, work):
+    """
+    Apply work to every record on the shared thread pool (AES releases the
+    GIL) and write the results to sink in order, with a few records per
+    thread in flight.
+    """
+    threads = multiprocessing.cpu_count()
+    pool = None
+    pending = collections.deque()
+    for args in records:
+        if pool is None and not args[-1]:
+            pool = shared_record_pool() # Single chunk objects are done inline.
+        if pool is None:
+            sink.write(work(*args))
+            continue
+        pending.append(pool.apply_async(work, args))
+        while pending and (len(pending) > threads * 2 or pending[0].ready()):
+            sink.write(pending.popleft().get())
+    while pending:
+        sink.write(pending.popleft().get())
+
+
+def aes_encrypt(source, sink, password):
+    """
+    Versioned AES-256-GCM format: a header (magic, version, PBKDF2 iterations,
+    chunk size, salt, nonce prefix) then records of AES_CHUNK_SIZE chunks,
+    each with its own nonce and tag. The last record is flagged, so a
+    truncated object fails to decrypt instead of restoring short.
+    """
+    header = AES_HEADER.pack(AES_MAGIC, AES_VERSION, AES_KDF_ITERATIONS, AES_CHUNK_SIZE, aes_salt, os.urandom(8))
+    key = aes_key(password, aes_salt, AES_KDF_ITERATIONS)
+    sink.write(header)
+
+    def records():
+        chunk = source.read(AES_CHUNK_SIZE)
+        for index in itertools.count():
+            following = source.read(AES_CHUNK_SIZE)
+            yield key, header, index, chunk, not following
+            if not following:
+                return
+            chunk = following
+    parallel_records(sink, records(), aes_seal)
+
+
+def aes_decrypt(source, sink, password):
+    """ Decrypt and check the output of aes_encrypt. """
+    header = source.read(AES_HEADER.size)
+    if len(header) < AES_HEADER.size or not header.startswith(AES_MAGIC):
+        raise IOError("Not an aes encrypted backup")
+    magic, version, iterations, chunk_size, salt, nonce = AES_HEADER.unpack(header)
+    if version != AES_VERSION:
+        raise IOError("Unsupported aes format version {}, upgrade pycloudbackup".format(version))
+    key = aes_key(password, salt, iterations)
+
+    def records():
+        for index in itertools.count():
+            record = source.read(AES_RECORD.size)
+            if len(record) < AES_RECORD.size:
+                raise IOError("Encrypted backup is truncated")
+            last, size = AES_RECORD.unpack(record)
+            data = source.read(size + AES_TAG_SIZE)
+            if len(data) < size + AES_TAG_SIZE:
+                raise IOError("Encrypted backup is truncated")
+            yield key, header, index, data, last
+            if last:
+                return
+    parallel_records(sink, records(), aes_open)
+    if source.read(1):
+        raise IOError("Data after the last encrypted chunk")
+
+
+CIPHERS = dict(
+    beefish=Cipher("beefish", ".enc", encrypt, beefish_decrypt),
+    aes=Cipher("aes", ".aes", aes_encrypt, aes_decrypt, requires=AES is None and "pycryptodome"),
+)
+
+
+def parse_cipher(value):
+    name = value or DEFAULT_ENCRYPTION
+    if name not in CIPHERS:
+        raise ValueError("Unknown encryption {}, use one of {}".format(name, ", ".join(sorted(CIPHERS))))
+    cipher = CIPHERS[name]
+    cipher.check()
+    return cipher
+
+
+def cipher_for_name(keyname):
+    """ The cipher of a stored name, from its suffix, None if it isn't encrypted. """
+    for cipher in CIPHERS.values():
+        if keyname.endswith(cipher.suffix):
+            return cipher
+    return None
+
+
+def is_seekable(keyname):
+    cipher = cipher_for_name(keyname)
+    if cipher:
+        keyname = keyname[:-len(cipher.suffix)]
+    return keyname.endswith(SEEKABLE_SUFFIX)
+
+
+def encode_block(data, codec, level, cipher, password):
+    """ data compressed, then encrypted if cipher, as a block that decodes on its own. """
+    out = StringIO()
+    writer = CompressingWriter(out, codec, level)
+    writer.write(data)
+    writer.close()
+    if cipher:
+        out.seek(0)
+        encrypted = StringIO()
+        cipher.encrypt(out, encrypted, password)
+        out = encrypted
+    return out.getvalue()
+
+
+def decode_block(payload, codec, cipher, password):
+    if cipher:
+        out = StringIO()
+        cipher.decrypt(StringIO(payload), out, password)
+        payload = out.getvalue()
+    return DecompressingReader(StringIO(payload), codec).read()
+
+
+class SeekableWriter(object):
+    """
+    write() end producing a seekable archive in fileobj: a header, then
+    SEEKABLE_BLOCK_SIZE blocks of the data, each compressed and encrypted on
+    its own on a thread pool, and on close() an index frame and a fixed size
+    footer pointing at it. The index lists the blocks (stored offset and
+    length, plain offset and length) and the (name, offset, size) members
+    recorded by tar_add, so a member maps to a few byte ranges.
+    """
+    def __init__(self, fileobj, codec, level, cipher, password, members):
+        if codec.name == "pigz":
+            codec = CODECS["gzip"] # same format, and the blocks are compressed in parallel already
+        self.fileobj = fileobj
+        self.block_args = (codec, level, cipher, password)
+        self.members = members
+        self.threads = multiprocessing.cpu_count()
+        self.pool = ThreadPool(self.threads)
+        self.pending = collections.deque()
+        self.buffer = ""
+        self.plain = 0
+        self.offset = 0
+        self.blocks = []
+        self.footer = (codec.name, cipher.name if cipher else "")
+        header = json.dumps(dict(codec=codec.name, cipher=cipher and cipher.name, block_size=SEEKABLE_BLOCK_SIZE))
+        self.emit(SEEKABLE_HEADER.pack(SEEKABLE_MAGIC, SEEKABLE_VERSION, len(header)) + header)
+
+    def emit(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def frame(self, kind, payload):
+        """ Write a frame, returns where its payload starts. """
+        self.emit(SEEKABLE_FRAME.pack(kind, len(payload)))
+        offset = self.offset
+        self.emit(payload)
+        return offset
+
+    def submit(self, block):
+        self.pending.append((self.plain, len(block), self.pool.apply_async(encode_block, (block,) + self.block_args)))
+        self.plain += len(block)
+
+    def collect(self, wait):
+        while self.pending and (wait or len(self.pending) > self.threads * 2 or self.pending[0][2].ready()):
+            plain, size, result = self.pending.popleft()
+            payload = result.get()
+            self.blocks.append((self.frame(SEEKABLE_BLOCK, payload), len(payload), plain, size))
+
+    def release(self):
+        """ Stop the threads, dropping the blocks still queued, see CompressingWriter.release. """
+        self.pool.terminate()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= SEEKABLE_BLOCK_SIZE:
+            self.submit(self.buffer[:SEEKABLE_BLOCK_SIZE])
+            self.buffer = self.buffer[SEEKABLE_BLOCK_SIZE:]
+        self.collect(False)
+
+    def close(self):
+        try:
+            if self.buffer:
+                self.submit(self.buffer)
+                self.buffer = ""
+            self.collect(True)
+        finally:
+            self.release()
+        index = encode_block(json.dumps(dict(size=self.plain, blocks=self.blocks, members=self.members)),
+                             *self.block_args)
+        offset = self.frame(SEEKABLE_INDEX, index)
+        self.emit(SEEKABLE_FOOTER.pack(offset, len(index), self.footer[0], self.footer[1],
+                                       SEEKABLE_MAGIC, SEEKABLE_VERSION))
+
+
+class SeekableReader(object):
+    """ read() end turning a seekable archive back into the plain data, front to back, so fileobj can be a pipe. """
+    def __init__(self, fileobj, password):
+        self.fileobj = fileobj
+        self.password = password
+        magic, version, length = SEEKABLE_HEADER.unpack(self.read_exactly(SEEKABLE_HEADER.size))
+        if magic != SEEKABLE_MAGIC or version != SEEKABLE_VERSION:
+            raise IOError("Not a seekable archive, or an unsupported version of it")
+        header = json.loads(self.read_exactly(length))
+        self.codec = CODECS[header["codec"]]
+        self.cipher = header["cipher"] and CIPHERS[header["cipher"]]
+        self.buffer = ""
+        self.eof = False
+
+    def read_exactly(self, size):
+        data = self.fileobj.read(size)
+        if len(data) < size:
+            raise IOError("Seekable archive is truncated")
+        return data
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            kind, length = SEEKABLE_FRAME.unpack(self.read_exactly(SEEKABLE_FRAME.size))
+            payload = self.read_exactly(length)
+            if kind == SEEKABLE_INDEX:
+                self.eof = True
+                while self.fileobj.read(PIPE_CHUNK_SIZE): # the footer
+                    pass
+            else:
+                self.buffer += decode_block(payload, self.codec, self.cipher, self.password)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class BlockReader(object):
+    """
+    read() end over an iterator of (plain offset, data) blocks, giving the
+    plain bytes from start to end followed by trailer.
+    """
+    def __init__(self, blocks, start, end, trailer=""):
+        self.blocks = blocks
+        self.start = start
+        self.end = end
+        self.trailer = trailer
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while self.blocks and (size < 0 or len(self.buffer) < size):
+            block = next(self.blocks, None)
+            if block is None:
+                self.blocks = None
+                self.buffer += self.trailer
+                break
+            plain, data = block
+            self.buffer += data[max(self.start - plain, 0):max(self.end - plain, 0)]
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def fetch_blocks(storage_backend, keyname, blocks, codec, cipher, password):
+    """ Yields (plain offset, data) of blocks, reading up to SEEKABLE_RANGE_SIZE of neighbours per ranged read. """
+    blocks = collections.deque(blocks)
+    while blocks:
+        run = [blocks.popleft()]
+        while blocks and blocks[0][0] + blocks[0][1] - run[0][0] <= SEEKABLE_RANGE_SIZE:
+            run.append(blocks.popleft())
+        start = run[0][0]
+        data = storage_backend.read_range(keyname, start, run[-1][0] + run[-1][1] - start)
+        for offset, length, plain, size in run:
+            yield plain, decode_block(data[offset - start:offset - start + length], codec, cipher, password)
+
+
+def restore_member(storage_backend, keyname, member, password):
+    """
+    Extract member of a seekable archive in the current directory reading
+    only the footer, the index and the blocks holding the member.
+    """
+    footer = storage_backend.read_range(keyname, -SEEKABLE_FOOTER.size, SEEKABLE_FOOTER.size)
+    offset, length, codec, cipher, magic, version = SEEKABLE_FOOTER.unpack(footer)
+    if magic != SEEKABLE_MAGIC or version != SEEKABLE_VERSION:
+        raise IOError("{} is not a seekable archive, or an unsupported version of it".format(keyname))
+    codec = CODECS[codec.rstrip("\0")]
+    cipher = CIPHERS[cipher.rstrip("\0")] if cipher.rstrip("\0") else None
+    index = json.loads(decode_block(storage_backend.read_range(keyname, offset, length), codec, cipher, password))
+
+    # The member ends where the next one starts, its header and padding included.
+    members = sorted(index["members"], key=lambda entry: entry[1])
+    wanted = member.lstrip("/")
+    for position, (name, start, size) in enumerate(members):
+        if name.encode("utf-8").lstrip("/") == wanted:
+            break
+    else:
+        raise IOError("{} has no member {}".format(keyname, member))
+    end = members[position + 1][1] if position + 1 < len(members) else index["size"]
+    blocks = [block for block in index["blocks"] if block[2] < end and block[2] + block[3] > start]
+    log.info("Reading {} block(s) of {} for {}".format(len(blocks), keyname, member))
+
+    # The member alone, closed with the two zero blocks marking the end of a tar.
+    reader = BlockReader(fetch_blocks(storage_backend, keyname, blocks, codec, cipher, password), start, end,
+                         tarfile.NUL * tarfile.BLOCKSIZE * 2)
+    tar = tarfile.open(fileobj=reader, mode="r|")
+    tar.extractall(members=extract_members(tar, member))
+    tar.close()
+
+
+def seekable_stage(source, sink, codec, level, cipher, password, members):
+    """ Pipeline stage writing source as a seekable archive, see SeekableWriter. """
+    writer = SeekableWriter(sink, codec, level, cipher, password, members)
+    try:
+        while True:
+            data = source.read(PIPE_CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+        writer.close()
+    finally:
+        writer.release()
+
+
+def unseekable_stage(source, sink, password):
+    """ Pipeline stage decoding a whole seekable archive, see SeekableReader. """
+    reader = SeekableReader(source, password)
+    while True:
+        data = reader.read(PIPE_CHUNK_SIZE)
+        if not data:
+            break
+        sink.write(data)
+
+
+def compress_stage(source, sink, codec, level):
+    """ Pipeline stage compressing source with codec. """
+    writer = CompressingWriter(sink, codec, level)
+    try:
+        while True:
+            data = source.read(PIPE_CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+        writer.close()
+    finally:
+        writer.release()
+
+
+def decompress_stage(source, sink, codec):
+    """ Pipeline stage decompressing source with codec. """
+    reader = DecompressingReader(source, codec)
+    while True:
+        data = reader.read(PIPE_CHUNK_SIZE)
+        if not data:
+            break
+        sink.write(data)
+
+
+def tar_stage(source, sink, filename, arcname, mode="w|", members=None):
+    """ Pipeline stage writing a tar of filename, see compress_stage for compression. """
+    tarz = tarfile.open(fileobj=sink, mode=mode)
+    tar_add(tarz, filename, arcname, members)
+    tarz.close()
+
+
+def tar_add(tarz, filename, arcname, members=None):
+    """
+    Add filename to tarz. A list of files is a pack: each file is stored under
+    its own path and (path, offset, size) appended to members, offset being
+    where its header starts in the uncompressed tar. Files gone since they
+    were listed are left out. Otherwise members, if given, gets the
+    (name, offset, size) of every entry of the tree.
+    """
+    if not isinstance(filename, list):
+        if members is None:
+            tarz.add(filename, arcname=arcname)
+        else:
+            tar_add_tree(tarz, filename, arcname, members)
+        return
+    for path in filename:
+        offset = tarz.offset
+        try:
+            tarz.add(path, recursive=False)
+        except (IOError, OSError) as err:
+            log.warning("Left out of the pack: {}".format(err))
+            continue
+        members.append((path, offset, tarz.members[-1].size))
+
+
+def tar_add_tree(tarz, path, arcname, members):
+    """ tarz.add(path, arcname) one entry at a time, recording where each starts. """
+    offset = tarz.offset
+    tarz.add(path, arcname=arcname, recursive=False)
+    members.append((tarz.members[-1].name, offset, tarz.members[-1].size))
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            tar_add_tree(tarz, os.path.join(path, name), os.path.join(arcname, name), members)
+
+
+def extract_members(tar, member=None):
+    """ The members of tar to extract: all of them, or only the file member of a pack. """
+    for tarinfo in tar:
+        if member is None or tarinfo.name == member.lstrip("/"):
+            yield tarinfo
+
+
+pack_counter = itertools.count()
+
+def pack_name():
+    """ A new pack name, sorting by creation time. """
+    return "{}{}-{}-{:06d}".format(PACK_PREFIX, datetime.utcnow().strftime("%Y%m%d%H%M%S"),
+                                   os.getpid(), next(pack_counter))
+
+
+def encrypt_stage(source, sink, cipher, password):
+    """ Pipeline stage encrypting with cipher, same format as the spooled path. """
+    cipher.encrypt(source, sink, password)
+
+
+class TruncatingWriter(object):
+    """
+    Holds back the last write so beefish.decrypt can strip its padding with
+    seek(-n, 2) + truncate() while the output still goes to a pipe.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pending = ""
+        self.trim = 0
+
+    def write(self, data):
+        if self.pending:
+            self.fileobj.write(self.pending)
+        self.pending = data
+        self.trim = 0
+
+    def seek(self, offset, whence=0):
+        if whence != 2 or -offset > len(self.pending):
+            raise IOError("TruncatingWriter can only seek back into the last write")
+        self.trim = -offset
+
+    def truncate(self):
+        self.pending = self.pending[:len(self.pending) - self.trim]
+
+    def flush(self):
+        self.fileobj.write(self.pending)
+        self.pending = ""
+
+
+def download_stage(source, sink, storage_backend, keyname, progress=None):
+    """ Pipeline stage writing the remote object into the pipe. """
+    download_kwargs = {}
+    if progress:
+        download_kwargs = dict(cb=progress.callback())
+    if storage_backend.download_to(keyname, sink, **download_kwargs) is False:
+        raise ArchiveNotReady("{} is not available for download yet".format(keyname))
+
+
+def download_ranges(storage_backend, keyname):
+    """
+    (object, offset, length) reads covering keyname in order, the segments of
+    a large object being read directly. None if keyname doesn't exist.
+    """
+    parts = storage_backend.parts(keyname)
+    if parts is None:
+        return None
+    reads = []
+    for name, size in parts:
+        for offset in range(0, size, DOWNLOAD_RANGE_SIZE):
+            reads.append((name, offset, min(DOWNLOAD_RANGE_SIZE, size - offset)))
+    return reads
+
+
+def download_range_job(backend_pool, name, offset, length):
+    """ One ranged read on a backend of backend_pool, replayed by the backend on failure (see whole_range). """
+    with backend_pool.session() as storage_backend:
+        return storage_backend.read_range(name, offset, length)
+
+
+def parallel_download_to(backend_pool, keyname, fileobj, concurrency, progress=None):
+    """
+    Write keyname to fileobj with up to concurrency DOWNLOAD_RANGE_SIZE ranged
+    reads in flight, each on its own backend from backend_pool, reassembled in
+    order. progress is told of every range written. Returns False if keyname
+    doesn't exist.
+    """
+    with backend_pool.session() as storage_backend:
+        reads = download_ranges(storage_backend, keyname)
+    if reads is None:
+        return False
+    if progress:
+        progress.total = sum(length for name, offset, length in reads)
+    written = [0]
+
+    def write(data):
+        fileobj.write(data)
+        if progress:
+            progress.add(written[0], len(data))
+        written[0] += 1
+
+    if len(reads) < 2:
+        for read in reads: # Small objects are read inline, a thread pool costs more than it saves.
+            write(download_range_job(backend_pool, *read))
+        return
+    log.info("Downloading {} in {} ranges, {} at a time...".format(keyname, len(reads), concurrency))
+    pool = ThreadPool(concurrency)
+    pending = collections.deque()
+    try:
+        for read in reads:
+            pending.append(pool.apply_async(download_range_job, (backend_pool,) + read))
+            while len(pending) > concurrency or (pending and pending[0].ready()):
+                write(pending.popleft().get())
+        while pending:
+            write(pending.popleft().get())
+    finally:
+        pool.terminate()
+
+
+def parallel_download_stage(source, sink, backend_pool, keyname, concurrency, progress=None):
+    """ Pipeline stage writing the remote object into the pipe, see parallel_download_to. """
+    if parallel_download_to(backend_pool, keyname, sink, concurrency, progress) is False:
+        raise ArchiveNotReady("{} is not available for download".format(keyname))
+
+
+def dedup_restore_stage(source, sink, dedup_store, keyname, password):
+    """ Pipeline stage reassembling a deduplicated backup. """
+    dedup_store.restore_to(keyname, sink, password)
+
+
+def decrypt_stage(source, sink, cipher, password):
+    """ Pipeline stage decrypting with cipher. """
+    cipher.decrypt(source, sink, password)
 
 
 class S3Backend:
@@ -67,6 +2579,7 @@ class S3Backend:
     Backend to handle S3 upload/download
     """
     def __init__(self, conf):
+        self.breaker = circuit_breaker("s3")
         if conf is None:
             try:
                 access_key = config.get("aws", "access_key")
@@ -89,46 +2602,277 @@ class S3Backend:
         con = boto.connect_s3(access_key, secret_key)
         if region_name == DEFAULT_LOCATION:
             region_name = ""
-        self.bucket = con.create_bucket(bucket, location=region_name)
+        self.bucket = self.request("PUT " + bucket, lambda: con.create_bucket(bucket, location=region_name),
+                                   rewind=lambda: None)
         self.container = "S3 Bucket: {}".format(bucket)
 
-    def download(self, keyname):
-        k = Key(self.bucket)
-        k.key = keyname
+    def request(self, what, func, rewind=None):
+        """ Run func, replayed on transient errors, see retry_request. """
+        return retry_request(self.breaker, what, func, rewind)
 
+    def download(self, keyname, cb=None):
         encrypted_out = tempfile.TemporaryFile()
-        k.get_contents_to_file(encrypted_out)
+        self.download_to(keyname, encrypted_out, cb)
         encrypted_out.seek(0)
         
         return encrypted_out
 
+    def download_to(self, keyname, fileobj, cb=None):
+        """
+        Write the object to fileobj as it arrives, fileobj only needs write().
+        cb(transferred, total) is called as it goes, like for uploads.
+        """
+        k = Key(self.bucket)
+        k.key = keyname
+        self.request("GET " + keyname, lambda: k.get_contents_to_file(fileobj, cb=cb, num_cb=PROGRESS_CALLBACKS))
+
     def cb(self, complete, total):
         percent = int(complete * 100.0 / total)
         log.info("Upload completion: {}%".format(percent))
 
     def upload(self, keyname, filename, cb=True):
+        """ cb is a cb(transferred, total) progress callback, True just logs the progress. """
         k = Key(self.bucket)
         k.key = keyname
         upload_kwargs = {}
-        if cb:
+        if cb is True:
             upload_kwargs = dict(cb=self.cb, num_cb=10)
-        k.set_contents_from_file(filename, **upload_kwargs)
-        k.set_acl("private")
+        elif cb:
+            upload_kwargs = dict(cb=cb, num_cb=PROGRESS_CALLBACKS)
+        start = filename.tell()
+        self.request("PUT " + keyname, lambda: k.set_contents_from_file(filename, **upload_kwargs),
+                     rewind=lambda: filename.seek(start))
+        self.request("PUT " + keyname + "?acl", lambda: k.set_acl("private"), rewind=lambda: None)
+        return (k.etag or "").strip('"') or None
+
+    def multipart(self, handle):
+        mp = MultiPartUpload(self.bucket)
+        mp.key_name = handle["keyname"]
+        mp.id = handle["upload_id"]
+        return mp
+
+    def begin_segmented(self, keyname, segment_size):
+        if segment_size < S3_MIN_PART_SIZE:
+            raise ValueError("S3 multipart segments must be at least 5 MB")
+        mp = self.request("POST " + keyname + "?uploads", lambda: self.bucket.initiate_multipart_upload(keyname),
+                          rewind=lambda: None)
+        return dict(keyname=keyname, upload_id=mp.id)
+
+    def upload_segment(self, handle, index, offset, fileobj, cb=None):
+        start = fileobj.tell()
+        self.request("PUT {} part {}".format(handle["keyname"], index + 1),
+                     lambda: self.multipart(handle).upload_part_from_file(fileobj, index + 1, cb=cb,
+                                                                          num_cb=PROGRESS_CALLBACKS),
+                     rewind=lambda: fileobj.seek(start))
+
+    def complete_segmented(self, handle, parts, size):
+        completed = self.request("POST " + handle["keyname"], lambda: self.multipart(handle).complete_upload(),
+                                 rewind=lambda: None)
+        k = Key(self.bucket)
+        k.key = handle["keyname"]
+        self.request("PUT " + handle["keyname"] + "?acl", lambda: k.set_acl("private"), rewind=lambda: None)
+        return (completed.etag or "").strip('"') or None
+
+    def read_range(self, keyname, offset, length):
+        """ length bytes of keyname from offset (from the end if negative), one Range GET. """
+        k = Key(self.bucket)
+        k.key = keyname
+        return self.request("GET " + keyname, lambda: whole_range(k.get_contents_as_string(
+            headers=dict(Range=http_range(offset, length))), offset, length), rewind=lambda: None)
+
+    def parts(self, keyname):
+        """
+        (name, size) of the objects holding keyname's bytes in order, for
+        download_ranges. Multipart uploads are read by ranges of the whole
+        object, S3 serves those from the parts. None if keyname doesn't exist.
+        """
+        info = self.head(keyname)
+        if info is None:
+            return None
+        return [(keyname, info["size"])]
 
-    def ls(self):
-        return [key.name for key in self.bucket.get_all_keys()]
+    def segmented_etag(self, md5s):
+        """ S3's multipart ETag: md5 of the parts' binary md5s, dash, part count. """
+        return "{}-{}".format(hashlib.md5("".join(md5.decode("hex") for md5 in md5s)).hexdigest(), len(md5s))
+
+    def head(self, keyname):
+        """ name/size/hash/last_modified of keyname without downloading it, None if it doesn't exist. """
+        key = self.request("HEAD " + keyname, lambda: self.bucket.get_key(keyname), rewind=lambda: None)
+        if key is None:
+            return None
+        return dict(name=keyname, size=key.size, hash=(key.etag or "").strip('"') or None,
+                    last_modified=key.last_modified)
+
+    def abort_segmented(self, handle):
+        self.request("DELETE " + handle["keyname"], lambda: self.multipart(handle).cancel_upload(),
+                     rewind=lambda: None)
+
+    def ls(self, prefix=None, delimiter=None, limit=None, marker=None):
+        return paged_listing(self.list_page, prefix, delimiter, limit, marker)
+
+    def list_page(self, marker=None, limit=LIST_PAGE_SIZE, prefix=None, delimiter=None):
+        """
+        Up to limit objects after marker, as name/size/hash/last_modified dicts.
+        With a delimiter, common prefixes come back as entries with no size.
+        """
+        keys = self.request("GET " + self.container, lambda: self.bucket.get_all_keys(
+            marker=marker, max_keys=limit, prefix=prefix, delimiter=delimiter), rewind=lambda: None)
+        return [dict(name=key.name, size=getattr(key, "size", None),
+                     hash=(getattr(key, "etag", None) or "").strip('"') or None,
+                     last_modified=getattr(key, "last_modified", None)) for key in keys]
 
     def delete(self, keyname):
         k = Key(self.bucket)
         k.key = keyname
-        self.bucket.delete_key(k)
+        self.request("DELETE " + keyname, lambda: self.bucket.delete_key(k), rewind=lambda: None)
+
+
+
+class GlacierInventory(object):
+    """
+    Local Glacier inventory (archive ids and retrieval jobs by name), kept in
+    SQLite so every change is one row and several processes can share it.
+    Each change is also queued in the deltas table until sync_inventory()
+    pushes it to S3. The old ~/.bakthat.db shelve is imported on first use.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS archives (
+                               name TEXT PRIMARY KEY, archive_id TEXT, updated REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                               name TEXT PRIMARY KEY, job_id TEXT, updated REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS deltas (
+                               seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, name TEXT,
+                               archive_id TEXT, claim TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS meta (
+                               key TEXT PRIMARY KEY, value INTEGER)""")
+        self.db.commit()
+        if self.db.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone() is None:
+            self.migrate_shelve()
+
+    def migrate_shelve(self):
+        """ One time import of the archives and jobs of the old shelve inventory. """
+        with self.lock:
+            # Depending on the dbm module, shelve adds suffixes to the file name.
+            if glob.glob(os.path.expanduser("~/.bakthat.db") + "*"):
+                with glacier_shelve() as d:
+                    archives = d.get("archives", dict())
+                    jobs = d.get("jobs", dict())
+                now = time.time()
+                self.db.executemany("INSERT OR IGNORE INTO archives VALUES (?, ?, ?)",
+                                    [(name, archive_id, now) for name, archive_id in archives.items()])
+                self.db.executemany("INSERT OR IGNORE INTO jobs VALUES (?, ?, ?)",
+                                    [(name, job_id, now) for name, job_id in jobs.items()])
+                log.info("Imported {} archives from the shelve inventory".format(len(archives)))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('migrated', 1)")
+            self.db.commit()
+
+    def get(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT archive_id FROM archives WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, name, archive_id):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?)", (name, archive_id, time.time()))
+            self.db.execute("INSERT INTO deltas (op, name, archive_id) VALUES ('put', ?, ?)", (name, archive_id))
+            self.db.commit()
+
+    def remove(self, name):
+        with self.lock:
+            self.db.execute("DELETE FROM archives WHERE name = ?", (name,))
+            self.db.execute("INSERT INTO deltas (op, name) VALUES ('delete', ?)", (name,))
+            self.db.commit()
+
+    def replace(self, archives):
+        """ Swap the whole inventory for archives (a restored backup), nothing is queued. """
+        now = time.time()
+        with self.lock:
+            self.db.execute("DELETE FROM archives")
+            self.db.executemany("INSERT INTO archives VALUES (?, ?, ?)",
+                                [(name, archive_id, now) for name, archive_id in archives.items()])
+            self.db.commit()
+
+    def names(self, prefix="", marker=None):
+        """ Archive names starting with prefix and sorting after marker, in order. """
+        sql = "SELECT name FROM archives WHERE name >= ?"
+        args = [prefix]
+        if prefix:
+            sql += " AND name < ?"
+            args.append(prefix_upper_bound(prefix))
+        if marker is not None:
+            sql += " AND name > ?"
+            args.append(marker)
+        with self.lock:
+            return [row[0] for row in self.db.execute(sql + " ORDER BY name", args)]
+
+    def get_job(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT job_id FROM jobs WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_job(self, name, job_id):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)", (name, job_id, time.time()))
+            self.db.commit()
+
+    def forget_job(self, name):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE name = ?", (name,))
+            self.db.commit()
+
+    def pending_count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM deltas WHERE claim IS NULL").fetchone()[0]
+
+    def claim_pending(self):
+        """
+        Take the pending changes for one push, (claim, [[op, name, archive_id], ...]).
+        Claiming is one UPDATE, so concurrent pushers never send a change twice.
+        """
+        claim = hashlib.md5(os.urandom(16)).hexdigest()[:12]
+        with self.lock:
+            self.db.execute("UPDATE deltas SET claim = ? WHERE claim IS NULL", (claim,))
+            self.db.commit()
+            rows = self.db.execute("SELECT op, name, archive_id FROM deltas WHERE claim = ? ORDER BY seq",
+                                   (claim,)).fetchall()
+        return claim, [list(row) for row in rows]
+
+    def unclaim(self, claim):
+        with self.lock:
+            self.db.execute("UPDATE deltas SET claim = NULL WHERE claim = ?", (claim,))
+            self.db.commit()
+
+    def pushed(self, claim):
+        with self.lock:
+            self.db.execute("DELETE FROM deltas WHERE claim = ?", (claim,))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('deltas_pushed', ?)", (self.deltas_count() + 1,))
+            self.db.commit()
+
+    def deltas_count(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'deltas_pushed'").fetchone()
+        return row[0] if row else 0
 
+    def deltas_pushed(self):
+        """ Deltas pushed by this host since the last compaction. """
+        with self.lock:
+            return self.deltas_count()
+
+    def compacted(self):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('deltas_pushed', 0)")
+            self.db.commit()
 
 
 class GlacierBackend:
     """
     Backend to handle Glacier upload/download
     """
+    tree_hash_segments = True # iter_segments hashes the parts while spooling them
+
     def __init__(self, conf):
         if conf is None:
             try:
@@ -155,138 +2899,271 @@ class GlacierBackend:
         self.conf = conf
         self.vault = con.create_vault(vault_name)
         self.backup_key = "bakthat_glacier_inventory"
+        self.delta_prefix = self.backup_key + ".deltas/"
         self.container = "Glacier vault: {}".format(vault_name)
+        self.inventory = GlacierInventory(os.path.expanduser(
+            get_setting(conf, "glacier", "glacier_inventory", DEFAULT_GLACIER_INVENTORY)))
+        self.inventory_batch = int(get_setting(conf, "glacier", "inventory_batch", DEFAULT_INVENTORY_BATCH))
+        self.s3_bucket = None
 
-    def backup_inventory(self):
+    def get_s3_bucket(self):
+        if self.s3_bucket is None:
+            self.s3_bucket = S3Backend(self.conf).bucket
+        return self.s3_bucket
+
+    def sync_inventory(self, force=False):
         """
-        Backup the local inventory from shelve as a json string to S3
+        Push the pending inventory changes to S3 as one delta object, once
+        inventory_batch of them are waiting (or right away if force). Every
+        INVENTORY_COMPACT_DELTAS deltas, they are folded into the snapshot.
         """
-        with glacier_shelve() as d:
-            if not d.has_key("archives"):
-                d["archives"] = dict()
+        if not force and self.inventory.pending_count() < self.inventory_batch:
+            return
+        claim, changes = self.inventory.claim_pending()
+        if changes:
+            try:
+                k = Key(self.get_s3_bucket())
+                k.key = "{}{:017.6f}-{}".format(self.delta_prefix, time.time(), claim)
+                k.set_contents_from_string(json.dumps(changes))
+                k.set_acl("private")
+            except:
+                self.inventory.unclaim(claim)
+                raise
+            self.inventory.pushed(claim)
+        if force or self.inventory.deltas_pushed() >= INVENTORY_COMPACT_DELTAS:
+            self.compact_inventory()
 
-            archives = d["archives"]
+    def load_remote_inventory(self):
+        """ The S3 snapshot with every delta replayed, and the delta keys. """
+        bucket = self.get_s3_bucket()
+        k = bucket.get_key(self.backup_key)
+        archives = json.loads(k.get_contents_as_string()) if k else dict()
+        deltas = [key.name for key in bucket.list(prefix=self.delta_prefix)]
+        for delta in deltas:
+            for op, keyname, archive_id in json.loads(bucket.get_key(delta).get_contents_as_string()):
+                if op == "put":
+                    archives[keyname] = archive_id
+                else:
+                    archives.pop(keyname, None)
+        return archives, deltas
 
-        s3_bucket = S3Backend(self.conf).bucket
-        k = Key(s3_bucket)
+    def compact_inventory(self):
+        """ Rewrite the snapshot with all the deltas applied, then drop them. """
+        archives, deltas = self.load_remote_inventory()
+        k = Key(self.get_s3_bucket())
         k.key = self.backup_key
-
         k.set_contents_from_string(json.dumps(archives))
-
         k.set_acl("private")
+        if deltas:
+            self.get_s3_bucket().delete_keys(deltas)
+        self.inventory.compacted()
 
+    def backup_inventory(self):
+        """
+        Push every pending change and compact the inventory backup on S3.
+        """
+        self.sync_inventory(force=True)
 
     def restore_inventory(self):
         """
-        Restore inventory from S3 to local shelve
+        Restore inventory from S3 (snapshot plus deltas) to the local store
         """
-        s3_bucket = S3Backend(self.conf).bucket
-        k = Key(s3_bucket)
-        k.key = self.backup_key
+        archives, deltas = self.load_remote_inventory()
+        self.inventory.replace(archives)
 
-        loaded_archives = json.loads(k.get_contents_as_string())
 
-        with glacier_shelve() as d:
-            if not d.has_key("archives"):
-                d["archives"] = dict()
+    def upload(self, keyname, filename, cb=None):
+        if cb:
+            filename = ProgressReader(filename, cb)
+        archive_id = self.vault.create_archive_from_file(file_obj=filename)
+        self.store_archive_id(keyname, archive_id)
+
+    def begin_segmented(self, keyname, segment_size):
+        """
+        Glacier multipart upload, parts must be a power of two MB (and an
+        archive can't have more than 10000 of them).
+        """
+        chunks = segment_size // TREE_HASH_CHUNK
+        if segment_size % TREE_HASH_CHUNK or chunks & (chunks - 1):
+            raise ValueError("Glacier part size must be a power of two MB")
+        response = self.vault.layer1.initiate_multipart_upload(self.vault.name, segment_size, keyname)
+        return dict(keyname=keyname, upload_id=response["UploadId"])
 
-            archives = loaded_archives
-            d["archives"] = archives
+    def upload_segment(self, handle, index, offset, fileobj, cb=None):
+        """ Upload one part, its hashes were taken by iter_segments. """
+        data = fileobj.read()
+        part_hash = boto.glacier.utils.bytes_to_hex(boto.glacier.utils.tree_hash(fileobj.chunk_hashes))
+        self.vault.layer1.upload_part(self.vault.name, handle["upload_id"], fileobj.linear_hash,
+                                      part_hash, (offset, offset + len(data) - 1), data)
+        if cb:
+            cb(len(data), len(data))
+        return fileobj.chunk_hashes
 
+    def complete_segmented(self, handle, parts, size):
+        """ The archive tree hash is built from the 1 MB chunk hashes of every part. """
+        archive_hash = boto.glacier.utils.tree_hash([h for chunk_hashes in parts for h in chunk_hashes])
+        response = self.vault.layer1.complete_multipart_upload(self.vault.name, handle["upload_id"],
+                                                               boto.glacier.utils.bytes_to_hex(archive_hash), size)
+        self.store_archive_id(handle["keyname"], response["ArchiveId"])
 
-    def upload(self, keyname, filename):
-        archive_id = self.vault.create_archive_from_file(file_obj=filename)
+    def abort_segmented(self, handle):
+        self.vault.layer1.abort_multipart_upload(self.vault.name, handle["upload_id"])
 
-        # Storing the filename => archive_id data.
-        with glacier_shelve() as d:
-            if not d.has_key("archives"):
-                d["archives"] = dict()
+    def store_archive_id(self, keyname, archive_id):
+        """
+        Store the filename => archive_id data and backup the inventory.
+        """
+        self.inventory.put(keyname, archive_id)
+        self.sync_inventory()
 
-            archives = d["archives"]
-            archives[keyname] = archive_id
-            d["archives"] = archives
+    def get_archive_id(self, filename):
+        """
+        Get the archive_id corresponding to the filename
+        """
+        return self.inventory.get(filename)
 
-        self.backup_inventory()
+    def download(self, keyname, cb=None):
+        """
+        Initiate a Job, check its status, and download the archive if it's completed.
+        """
+        encrypted_out = tempfile.TemporaryFile()
+        if not self.download_to(keyname, encrypted_out, cb):
+            return None
+        encrypted_out.seek(0)
+        return encrypted_out
 
-    def get_archive_id(self, filename):
+    def download_to(self, keyname, fileobj, cb=None):
         """
-        Get the archive_id corresponding to the filename
+        Same as download() but writes to fileobj, returns False if the
+        retrieval job is not completed yet.
         """
-        with glacier_shelve() as d:
-            if not d.has_key("archives"):
-                d["archives"] = dict()
-
-            archives = d["archives"]
-
-            if filename in archives:
-                return archives[filename]
+        job = self.start_retrieval(keyname)
+        if job is None or not self.job_ready(keyname, job):
+            log.info("Not completed yet")
+            return False
 
-        return None
+        log.info("Downloading...")
+        if cb:
+            fileobj = ProgressWriter(fileobj, cb, job.archive_size)
+        self.write_job_output(job, fileobj)
+        return True
 
-    def download(self, keyname):
+    def start_retrieval(self, keyname):
         """
-        Initiate a Job, check its status, and download the archive if it's completed.
+        The retrieval job of keyname, the one in the inventory if Glacier still
+        has it, else a new one. None if the archive is unknown.
         """
         archive_id = self.get_archive_id(keyname)
         if not archive_id:
-            return
-        
-        with glacier_shelve() as d:
-            if not d.has_key("jobs"):
-                d["jobs"] = dict()
+            log.error("No archive id for {}".format(keyname))
+            return None
+
+        job = None
+        job_id = self.inventory.get_job(keyname)
+        if job_id:
+            # The job is already in the inventory
+            try:
+                job = self.vault.get_job(job_id)
+            except UnexpectedHTTPResponseError: # Return a 404 if the job is no more available
+                self.inventory.forget_job(keyname)
 
-            jobs = d["jobs"]
-            job = None
+        if not job:
+            # Job initialization
+            job = self.vault.retrieve_archive(archive_id)
+            self.inventory.set_job(keyname, job.id)
 
-            if keyname in jobs:
-                # The job is already in shelve
-                job_id = jobs[keyname]
-                try:
-                    job = self.vault.get_job(job_id)
-                except UnexpectedHTTPResponseError: # Return a 404 if the job is no more available
-                    del job[keyname]
+        log.info("Job {action}: {status_code} ({creation_date}/{completion_date})".format(**job.__dict__))
+        return job
 
-            if not job:
-                # Job initialization
-                job = self.vault.retrieve_archive(archive_id)
-                jobs[keyname] = job.id
-                job_id = job.id
+    def job_ready(self, keyname, job):
+        """ True once job succeeded. A failed job is forgotten so the next try starts a new one. """
+        if job.completed and job.status_code == "Failed":
+            self.inventory.forget_job(keyname)
+            raise IOError("Retrieval job of {} failed: {}".format(keyname, job.status_message))
+        return job.completed
 
-            # Commiting changes in shelve
-            d["jobs"] = jobs
+    def write_job_output(self, job, fileobj):
+        """
+        Stream the output of a completed job to fileobj 1 MB at a time, with
+        one ranged request per GLACIER_RANGE_SIZE bytes of big archives. The
+        tree hash of every range is checked against Glacier's.
+        """
+        size = job.archive_size
+        ranges = [None]
+        if size > GLACIER_RANGE_SIZE:
+            ranges = [(start, min(start + GLACIER_RANGE_SIZE, size) - 1)
+                      for start in range(0, size, GLACIER_RANGE_SIZE)]
+        for byte_range in ranges:
+            response = job.get_output(byte_range=byte_range)
+            hashes = []
+            while True:
+                data = response.read(TREE_HASH_CHUNK)
+                if not data:
+                    break
+                hashes.append(hashlib.sha256(data).digest())
+                fileobj.write(data)
+            expected = response.get("TreeHash")
+            if expected and hashes and boto.glacier.utils.bytes_to_hex(boto.glacier.utils.tree_hash(hashes)) != expected:
+                raise IOError("Tree hash mismatch in range {} of archive {}".format(byte_range, job.archive_id))
 
-        log.info("Job {action}: {status_code} ({creation_date}/{completion_date})".format(**job.__dict__))
+    def retrieve(self, keynames, on_ready, wait=True):
+        """
+        Retrieval scheduler: start (or pick up) the jobs of every archive in
+        one go, then poll them all from one loop and call on_ready(keyname) as
+        each one completes. The poll interval backs off from GLACIER_POLL_SECS
+        to GLACIER_POLL_MAX_SECS. Without wait, jobs are checked once. Returns
+        the names still pending.
+        """
+        pending = dict()
+        for keyname in keynames:
+            job = self.start_retrieval(keyname)
+            if job is not None:
+                pending[keyname] = job
 
-        if job.completed:
-            log.info("Downloading...")
-            encrypted_out = tempfile.TemporaryFile()
-            encrypted_out.write(job.get_output().read())
-            encrypted_out.seek(0)
-            return encrypted_out
-        else:
-            log.info("Not completed yet")
-            return None
+        interval = GLACIER_POLL_SECS
+        while pending:
+            for keyname in sorted(pending):
+                try:
+                    ready = self.job_ready(keyname, pending[keyname])
+                except IOError as err:
+                    log.error(str(err))
+                    del pending[keyname]
+                    continue
+                if ready:
+                    on_ready(keyname)
+                    del pending[keyname]
+            if not pending or not wait:
+                break
+            log.info("{} retrieval job(s) pending, next check in {}s".format(len(pending), interval))
+            time.sleep(interval)
+            interval = min(interval * 2, GLACIER_POLL_MAX_SECS)
+            for keyname in pending:
+                pending[keyname] = self.vault.get_job(pending[keyname].id)
+        return sorted(pending)
 
-    def ls(self):
-        with glacier_shelve() as d:
-            if not d.has_key("archives"):
-                d["archives"] = dict()
+    def ls(self, prefix=None, delimiter=None, limit=None, marker=None):
+        return paged_listing(self.list_page, prefix, delimiter, limit, marker)
 
-            return d["archives"].keys()
+    def list_page(self, marker=None, limit=LIST_PAGE_SIZE, prefix=None, delimiter=None):
+        """ Same as S3Backend.list_page, from the local inventory (no sizes). """
+        prefix = prefix or ""
+        page = []
+        for name in self.inventory.names(prefix, marker):
+            if delimiter and delimiter in name[len(prefix):]:
+                name = name[:name.index(delimiter, len(prefix)) + len(delimiter)]
+                if (marker is not None and name <= marker) or (page and page[-1] == name):
+                    continue
+            page.append(name)
+            if len(page) >= limit:
+                break
+        return [dict(name=name, size=None, hash=None, last_modified=None) for name in page]
 
     def delete(self, keyname):
         archive_id = self.get_archive_id(keyname)
         if archive_id:
             self.vault.delete_archive(archive_id)
-            with glacier_shelve() as d:
-                archives = d["archives"]
-
-                if keyname in archives:
-                    del archives[keyname]
-
-                d["archives"] = archives
-
-            self.backup_inventory()
+            self.inventory.remove(keyname)
+            self.sync_inventory()
 
 class CloudfilesBackend:
     """
@@ -295,6 +3172,7 @@ class CloudfilesBackend:
     """
     def __init__(self, conf):
         # DONE, CLOUDFILES COMPLIANT
+        self.breaker = circuit_breaker("cloudfiles")
         if conf is None:
             try:
                 auth_user = config.get("cf", "apiuser")
@@ -315,108 +3193,807 @@ class CloudfilesBackend:
             self.container = conf.get("container")
             region_name = conf.get("region_name", DEFAULT_RACKSPACE_LOCATION)
             
+        self.auth_user = auth_user
+        self.auth_key = auth_key
+        self.region_name = region_name
+        retry_request(self.breaker, "Cloudfiles auth", self.connect, rewind=lambda: None)
 
-        if  region_name == "dfw" or region_name == "ord":
-            self.con = cloudfiles.get_connection(auth_user, auth_key,
+    def connect(self):
+        """
+        Authenticate and open the keep-alive connection, called again when
+        the auth token has expired.
+        """
+        if  self.region_name == "dfw" or self.region_name == "ord":
+            self.con = cloudfiles.get_connection(self.auth_user, self.auth_key,
                                                  authurl = "https://identity.api.rackspacecloud.com/v1.0/")
         else:
-            self.con = cloudfiles.get_connection(auth_user, auth_key, 
+            self.con = cloudfiles.get_connection(self.auth_user, self.auth_key, 
                                                  authurl = "https://lon.identity.api.rackspacecloud.com/v1.0/")
+        self.cf_container = None
+
+    def get_container(self):
+        """ The container is created/looked up once per connection. """
+        if self.cf_container is None:
+            self.cf_container = self.con.create_container(self.container)
+        return self.cf_container
+
+    def reauth_on_401(self, func, *args, **kwargs):
+        """
+        Run func, re-authenticating and running it once more if the token has
+        expired. Requests going through con.make_request already do this,
+        object PUTs don't. rewind is called before replaying the request, if
+        it is None the request can't be replayed and the error is raised.
+        """
+        rewind = kwargs.pop("rewind", None)
+        try:
+            return func(*args)
+        except ResponseError as err:
+            if err.status != 401:
+                raise
+            log.info("Cloudfiles auth token expired, re-authenticating...")
+            self.connect()
+            if rewind is None:
+                raise
+            rewind()
+            return func(*args)
+
+    def request(self, what, func, *args, **kwargs):
+        """
+        Run func through reauth_on_401, replayed on transient errors by
+        retry_request (same rewind) over a fresh HTTP connection: object PUTs
+        write to it directly, one that died midway leaves it unusable.
+        """
+        rewind = kwargs.pop("rewind", None)
+
+        def replay():
+            self.con.http_connect()
+            rewind()
 
-    def download(self, keyname):
+        return retry_request(self.breaker, what, lambda: self.reauth_on_401(func, *args, rewind=rewind),
+                             replay if rewind else None)
+
+    def download(self, keyname, cb=None):
         """ Refactor complete! """
-        container = self.con.create_container(self.container)
-        obj = container.get_object(keyname)
-        
         encrypted_out = tempfile.TemporaryFile()
-        obj.read(buffer=encrypted_out)
+        self.download_to(keyname, encrypted_out, cb)
 
         encrypted_out.seek(0)
         return encrypted_out
 
-
-#    def cb(self, complete, total):
-        #?????????????
-#        percent = int(complete * 100.0 / total)
-#        log.info("Upload completion: {}%".format(percent))
-#        print "unimplimented"
+    def download_to(self, keyname, fileobj, cb=None):
+        """
+        Write the object to fileobj as it arrives, fileobj only needs write().
+        cb(transferred, total) is called as it goes, like for uploads.
+        """
+        obj = self.request("HEAD " + keyname, lambda: self.get_container().get_object(keyname),
+                           rewind=lambda: None)
+        self.request("GET " + keyname, lambda: obj.read(buffer=fileobj, callback=cb)) # fileobj can't be rewound
 
     def upload(self, keyname, filename, cb=False):
-        """ Refactor complete! """
-        container = self.con.create_container(self.container)
+        """ cb is a cb(transferred, total) progress callback. """
+        start = filename.tell()
+        if isinstance(filename, file):
+            def put():
+                o = self.get_container().create_object(keyname)
+                # Unverified, o.etag is then the server's, not Object.write's own md5 of what it sent.
+                o.write(filename, verify=False, callback=cb or None)
+                return o.etag
+        else:
+            # Spooled/in-memory files, Object.write only sizes real files.
+            filename.seek(0, 2)
+            size = filename.tell() - start
+            filename.seek(start)
+
+            def put():
+                o = self.get_container().create_object(keyname)
+                o.content_type = "application/octet-stream"
+                o.size = size
+                o.send(ProgressReader(filename, cb, size) if cb else filename)
+                return o.etag
+
+        return (self.request("PUT " + keyname, put, rewind=lambda: filename.seek(start)) or "").strip('"') or None
+
+    def upload_stream(self, keyname, stream, cb=None):
+        """
+        Upload from a non-seekable stream, using chunked transfer encoding
+        since the size is not known up front.
+        """
+        def put():
+            o = self.get_container().create_object(keyname)
+            o.content_type = "application/octet-stream"
+            o.send(ProgressReader(stream, cb) if cb else stream)
+            return o.etag
+
+        return (self.request("PUT " + keyname, put) or "").strip('"') or None
+
+    def begin_segmented(self, keyname, segment_size):
+        """
+        Segments go to .segments/<keyname>/<timestamp>/ so they never match
+        restore/delete prefix lookups and never mix with an older upload.
+        """
+        prefix = "{}{}/{}/".format(SEGMENT_PREFIX, keyname, datetime.now().strftime("%Y%m%d%H%M%S"))
+        return dict(keyname=keyname, prefix=prefix)
+
+    def upload_segment(self, handle, index, offset, fileobj, cb=None):
+        self.upload("{}{:08d}".format(handle["prefix"], index), fileobj, cb)
+
+    def complete_segmented(self, handle, parts, size):
+        """ Join the segments with a dynamic large object manifest. """
+        def put():
+            o = self.get_container().create_object(handle["keyname"])
+            o.content_type = "application/octet-stream"
+            o.manifest = "{}/{}".format(self.container, handle["prefix"])
+            o.sync_manifest()
+
+        self.request("PUT " + handle["keyname"], put, rewind=lambda: None)
+        # The manifest PUT answers with its own (empty) ETag, the joined one comes from a HEAD.
+        return self.head(handle["keyname"])["hash"]
+
+    def read_range(self, keyname, offset, length):
+        """ Same as S3Backend.read_range. """
+        def get():
+            response = self.con.make_request("GET", [self.container, keyname],
+                                             hdrs=dict(Range=http_range(offset, length)))
+            data = response.read()
+            if response.status not in (200, 206):
+                raise ResponseError(response.status, response.reason)
+            return whole_range(data, offset, length)
+
+        return self.request("GET " + keyname, get, rewind=lambda: None)
+
+    def segmented_etag(self, md5s):
+        """ A dynamic large object's ETag: md5 of its segments' hex md5s. """
+        return hashlib.md5("".join(md5s)).hexdigest()
 
-        o = container.create_object(keyname)
-        o.write(filename)
+    def head(self, keyname):
+        """ Same as S3Backend.head, one HEAD request. """
+        try:
+            obj = self.request("HEAD " + keyname, lambda: self.get_container().get_object(keyname),
+                               rewind=lambda: None)
+        except NoSuchObject:
+            return None
+        return dict(name=keyname, size=obj.size, hash=(obj.etag or "").strip('"') or None,
+                    last_modified=obj.last_modified, manifest=obj.manifest)
+
+    def parts(self, keyname):
+        """
+        Same as S3Backend.parts. A large object in this container is its
+        segments, read directly instead of through the manifest.
+        """
+        info = self.head(keyname)
+        if info is None:
+            return None
+        if info["manifest"] and info["manifest"].startswith(self.container + "/"):
+            prefix = info["manifest"][len(self.container) + 1:]
+            segments, marker = [], None
+            while True:
+                page = self.list_page(marker, prefix=prefix)
+                if not page:
+                    break
+                segments.extend((entry["name"], entry["size"]) for entry in page)
+                marker = page[-1]["name"]
+            # A listing lagging behind the manifest falls back to the joined object.
+            if sum(size for name, size in segments) == info["size"]:
+                return segments
+        return [(keyname, info["size"])]
+
+    def abort_segmented(self, handle):
+        for name in self.segment_names(handle["prefix"]):
+            self.delete_object(name)
 
-    def ls(self):
+    def segment_names(self, prefix):
+        return list(self.ls(prefix=prefix))
+
+    def ls(self, prefix=None, delimiter=None, limit=None, marker=None):
         """ Refactor complete! """
+        return paged_listing(self.list_page, prefix, delimiter, limit, marker)
+
+    def list_page(self, marker=None, limit=LIST_PAGE_SIZE, prefix=None, delimiter=None):
+        """ Same as S3Backend.list_page, one listing request. """
         #{u'bytes': 25605, u'last_modified': u'2012-11-29T14:47:32.365100',
         # u'hash': u'3feb7b99ab4033e378a387d4c530d7aa',\
         # u'name': u'bakthat20121129084730.tgz', u'content_type': u'application/octet-stream'}
-
-        return [key['name'] for key in self.con[self.container].list_objects_info(limit=10000)] 
+        # With a delimiter, pseudo directories come back as {u'subdir': u'logs/'}.
+        objects = self.request("GET " + self.container, lambda: self.get_container().list_objects_info(
+            limit=limit, marker=marker, prefix=prefix, delimiter=delimiter), rewind=lambda: None)
+        return [dict(name=obj.get("name", obj.get("subdir")), size=obj.get("bytes"),
+                     hash=obj.get("hash"), last_modified=obj.get("last_modified")) for obj in objects]
 
     def md5(self, keyname):
-        """ Refactor complete! """
-        container = self.con.create_container(self.container)
-        obj = container.compute_md5sum(keyname)
-        
-        encrypted_out = tempfile.TemporaryFile()
-        obj.read(buffer=encrypted_out)
+        """ The md5 (ETag) the server has for keyname, nothing is downloaded. """
+        info = self.head(keyname)
+        return info and info["hash"]
+
+    def delete(self, keyname):
+        obj = self.request("HEAD " + keyname, lambda: self.get_container().get_object(keyname),
+                           rewind=lambda: None)
+        if obj.manifest:
+            # Large object, its segments live under the manifest prefix.
+            prefix = obj.manifest.split("/", 1)[1]
+            for name in self.segment_names(prefix):
+                self.delete_object(name)
+        self.delete_object(keyname)
+
+    def delete_object(self, keyname):
+        """ One DELETE, gone already counts as deleted when it is a replay. """
+        replayed = []
+
+        def delete():
+            try:
+                self.get_container().delete_object(keyname)
+            except ResponseError as err:
+                if err.status != 404 or not replayed:
+                    raise
+
+        self.request("DELETE " + keyname, delete, rewind=lambda: replayed.append(True))
+
+class SimulatedBackend:
+    """
+    Base of the local and memory backends: the same contract as the cloud
+    ones (uploads return the ETag, segmented uploads, ranged reads, paged
+    listings) over a store the subclass provides, with latency_ms added to
+    every request and transfers held to bandwidth_mbps (megabits per second,
+    per connection) if set. Meant for tests and benchmark.py, not for backups.
+    """
+    def __init__(self, conf, destination):
+        self.latency = float(get_setting(conf, destination, "latency_ms", 0)) / 1000
+        bandwidth = float(get_setting(conf, destination, "bandwidth_mbps", 0))
+        self.byte_time = 8.0 / (bandwidth * 1000 * 1000) if bandwidth else 0
+
+    def request(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def transfer(self, data):
+        if self.byte_time:
+            time.sleep(len(data) * self.byte_time)
+        return data
+
+    def chunks(self, fileobj, cb=None):
+        transferred = 0
+        while True:
+            data = fileobj.read(PIPE_CHUNK_SIZE)
+            if not data:
+                break
+            yield self.transfer(data)
+            transferred += len(data)
+            if cb:
+                cb(transferred, None)
 
+    def upload(self, keyname, filename, cb=False):
+        self.request()
+        return self.write_object(keyname, self.chunks(filename, cb))
+
+    def upload_stream(self, keyname, stream, cb=None):
+        return self.upload(keyname, stream, cb)
+
+    def download(self, keyname, cb=None):
+        encrypted_out = tempfile.TemporaryFile()
+        self.download_to(keyname, encrypted_out, cb)
         encrypted_out.seek(0)
         return encrypted_out
 
+    def download_to(self, keyname, fileobj, cb=None):
+        """ Write the object to fileobj as it arrives, fileobj only needs write(). """
+        self.request()
+        obj = self.open_object(keyname)
+        try:
+            for data in self.chunks(obj, cb):
+                fileobj.write(data)
+        finally:
+            obj.close()
+
+    def read_range(self, keyname, offset, length):
+        """ Same as S3Backend.read_range. """
+        self.request()
+        obj = self.open_object(keyname)
+        try:
+            if offset < 0:
+                obj.seek(0, 2)
+                offset = max(obj.tell() - length, 0)
+            obj.seek(offset)
+            return self.transfer(obj.read(length))
+        finally:
+            obj.close()
+
+    def begin_segmented(self, keyname, segment_size):
+        """ Segments are stored like Cloud Files ones, and joined by complete_segmented like S3 parts. """
+        prefix = "{}{}/{}/".format(SEGMENT_PREFIX, keyname, datetime.now().strftime("%Y%m%d%H%M%S%f"))
+        return dict(keyname=keyname, prefix=prefix)
+
+    def upload_segment(self, handle, index, offset, fileobj, cb=None):
+        return self.upload("{}{:08d}".format(handle["prefix"], index), fileobj, cb)
+
+    def complete_segmented(self, handle, parts, size):
+        self.request()
+        names = ["{}{:08d}".format(handle["prefix"], index) for index in range(len(parts))]
+
+        def joined():
+            for name in names:
+                obj = self.open_object(name)
+                try:
+                    for data in iter(lambda: obj.read(PIPE_CHUNK_SIZE), ""):
+                        yield data
+                finally:
+                    obj.close()
+
+        etag = self.segmented_etag(parts)
+        self.write_object(handle["keyname"], joined(), etag)
+        self.abort_segmented(handle)
+        return etag
+
+    def segmented_etag(self, md5s):
+        """ Same as S3Backend.segmented_etag. """
+        return "{}-{}".format(hashlib.md5("".join(md5.decode("hex") for md5 in md5s)).hexdigest(), len(md5s))
+
+    def abort_segmented(self, handle):
+        for name in self.segment_names(handle["prefix"]):
+            self.remove_object(name)
+
+    def segment_names(self, prefix):
+        return list(self.ls(prefix=prefix))
+
+    def head(self, keyname):
+        """ Same as S3Backend.head. """
+        self.request()
+        return self.object_info(keyname)
+
+    def parts(self, keyname):
+        """ Same as S3Backend.parts. """
+        info = self.head(keyname)
+        if info is None:
+            return None
+        return [(keyname, info["size"])]
+
+    def md5(self, keyname):
+        info = self.head(keyname)
+        return info and info["hash"]
+
+    def ls(self, prefix=None, delimiter=None, limit=None, marker=None):
+        return paged_listing(self.list_page, prefix, delimiter, limit, marker)
+
+    def list_page(self, marker=None, limit=LIST_PAGE_SIZE, prefix=None, delimiter=None):
+        """ Same as S3Backend.list_page. """
+        self.request()
+        page = []
+        for name in self.object_names():
+            if (marker is not None and name <= marker) or (prefix and not name.startswith(prefix)):
+                continue
+            if delimiter and delimiter in name[len(prefix or ""):]:
+                subdir = name[:name.index(delimiter, len(prefix or "")) + len(delimiter)]
+                if marker is not None and subdir <= marker:
+                    continue
+                if not page or page[-1]["name"] != subdir:
+                    page.append(dict(name=subdir, size=None, hash=None, last_modified=None))
+            else:
+                info = self.object_info(name)
+                if info is None:
+                    continue # Deleted since listed.
+                page.append(info)
+            if len(page) >= limit:
+                break
+        return page
+
     def delete(self, keyname):
-        container = self.con.create_container(self.container)
-        container.delete_object(keyname)
+        self.request()
+        self.remove_object(keyname)
+
+
+class LocalBackend(SimulatedBackend):
+    """
+    Stores objects as files under a directory (the path setting), their ETags
+    beside them under .etags/. Uploads are written to .tmp/ first and renamed
+    in place, so an object is either complete or absent.
+    """
+    def __init__(self, conf):
+        SimulatedBackend.__init__(self, conf, "local")
+        path = get_setting(conf, "local", "path", None)
+        if not path:
+            raise ValueError("The local backend needs a path setting")
+        self.root = os.path.abspath(os.path.expanduser(path))
+        self.container = "Local directory: {}".format(self.root)
+        for subdir in (".etags", ".tmp"):
+            if not os.path.isdir(os.path.join(self.root, subdir)):
+                try:
+                    os.makedirs(os.path.join(self.root, subdir))
+                except OSError:
+                    if not os.path.isdir(os.path.join(self.root, subdir)):
+                        raise
+
+    def path(self, keyname, base=""):
+        path = os.path.normpath(os.path.join(self.root, base, keyname))
+        if not path.startswith(os.path.join(self.root, base, "")) or keyname.startswith("/"):
+            raise ValueError("Invalid object name: {}".format(keyname))
+        return path
+
+    def place(self, tmp, path):
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        os.rename(tmp, path)
+
+    def write_object(self, keyname, chunks, etag=None):
+        path = self.path(keyname)
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, ".tmp"))
+        try:
+            digest = hashlib.md5()
+            with os.fdopen(fd, "wb") as out:
+                for data in chunks:
+                    out.write(data)
+                    digest.update(data)
+            etag = etag or digest.hexdigest()
+            self.place(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, ".tmp"))
+        with os.fdopen(fd, "w") as out:
+            out.write(etag)
+        self.place(tmp, self.path(keyname, ".etags"))
+        return etag
+
+    def open_object(self, keyname):
+        try:
+            return open(self.path(keyname), "rb")
+        except IOError:
+            raise IOError("No such object: {}".format(keyname))
+
+    def object_info(self, keyname):
+        try:
+            st = os.stat(self.path(keyname))
+            with open(self.path(keyname, ".etags")) as f:
+                etag = f.read()
+        except (IOError, OSError):
+            return None
+        return dict(name=keyname, size=st.st_size, hash=etag,
+                    last_modified=datetime.utcfromtimestamp(st.st_mtime).isoformat())
+
+    def object_names(self):
+        names = []
+        for top, dirs, files in os.walk(self.root):
+            if top == self.root:
+                dirs[:] = [d for d in dirs if d not in (".etags", ".tmp")]
+            names.extend(os.path.relpath(os.path.join(top, f), self.root) for f in files)
+        return sorted(names)
+
+    def remove_object(self, keyname):
+        for path in (self.path(keyname), self.path(keyname, ".etags")):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class MemoryBackend(SimulatedBackend):
+    """
+    Keeps objects in a dict shared by every instance of the process, one per
+    container setting, so a BackendPool's workers see each other's uploads.
+    Nothing survives the process.
+    """
+    containers = {}
+    lock = threading.Lock()
+
+    def __init__(self, conf):
+        SimulatedBackend.__init__(self, conf, "memory")
+        name = get_setting(conf, "memory", "container", "default")
+        self.container = "Memory: {}".format(name)
+        with self.lock:
+            self.objects = self.containers.setdefault(name, {})
+
+    def write_object(self, keyname, chunks, etag=None):
+        data = "".join(chunks)
+        etag = etag or hashlib.md5(data).hexdigest()
+        with self.lock:
+            self.objects[keyname] = (data, etag, datetime.utcnow().isoformat())
+        return etag
+
+    def open_object(self, keyname):
+        with self.lock:
+            if keyname not in self.objects:
+                raise IOError("No such object: {}".format(keyname))
+            return StringIO(self.objects[keyname][0])
+
+    def object_info(self, keyname):
+        with self.lock:
+            if keyname not in self.objects:
+                return None
+            data, etag, last_modified = self.objects[keyname]
+        return dict(name=keyname, size=len(data), hash=etag, last_modified=last_modified)
+
+    def object_names(self):
+        with self.lock:
+            return sorted(self.objects)
 
-storage_backends = dict(s3=S3Backend, glacier=GlacierBackend, cloudfiles=CloudfilesBackend)
+    def remove_object(self, keyname):
+        with self.lock:
+            self.objects.pop(keyname, None)
+
+
+storage_backends = dict(s3=S3Backend, glacier=GlacierBackend, cloudfiles=CloudfilesBackend,
+                        local=LocalBackend, memory=MemoryBackend)
 
 @app.cmd(help="Backup a file or a directory, backup the current directory if no arg is provided.")
 @app.cmd_arg('-f', '--filename', type=str, default=os.getcwd())
-@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|glacier|cloudfiles")
+@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|glacier|cloudfiles|local|memory")
 @app.cmd_arg('-p', '--password', type=str, default=None, help="Provide password non interactively.") # jonk nov 29 2012
+@app.cmd_arg('-s', '--stream', action="store_true", default=False, help="Tar, compress, encrypt and upload concurrently without temporary files.")
+@app.cmd_arg('--dedup', action="store_true", default=False, help="Store as deduplicated content-defined chunks.")
+@app.cmd_arg('--compression', type=str, default=None, help="none|gzip[:level]|bz2[:level]|xz[:level]|zstd[:level]|lz4[:level]|auto")
+@app.cmd_arg('--encryption', type=str, default=None, help="aes (default with pycryptodome)|beefish")
+@app.cmd_arg('--seekable', action="store_true", default=False, help="Store as independent blocks with a member index, for restore --member.")
+@app.cmd_arg('--progress', action="store_true", default=False, help="Log the upload progress and ETA.")
+@app.cmd_arg('--metrics-json', type=str, default=None, help="Write per-stage timings and sizes to this file as JSON.")
+@app.cmd_arg('--metrics-textfile', type=str, default=None, help="Same, as a Prometheus textfile collector file.")
 def backup(filename, destination="cloudfiles", **kwargs):
     conf = kwargs.get("conf", None)
-    storage_backend = storage_backends[destination](conf)
+    # Reuse the caller's authenticated backends when backing up many files.
+    backend_pool = kwargs.get("backend_pool")
+    if backend_pool is None:
+        backend_pool = BackendPool(destination, conf)
+
+    segment_size = int(get_setting(conf, destination, "segment_size_mb", DEFAULT_SEGMENT_SIZE_MB)) * 1024 * 1024
+    segment_concurrency = int(get_setting(conf, destination, "segment_concurrency", DEFAULT_SEGMENT_CONCURRENCY))
+    # Segment uploads use their own connections, never the ones held by callers.
+    segment_pool = kwargs.get("segment_pool")
+    if segment_pool is None:
+        segment_pool = BackendPool(destination, conf, size=segment_concurrency)
 
 
-    arcname = filename.split("/")[-1]
+    # The codec is recorded in the name suffix, restore picks it from there.
+    compression = choose_codec(filename, kwargs.get("compression") or
+                               get_setting(conf, destination, "compression", DEFAULT_COMPRESSION))
+
+    # Seekable archives keep the codec in their header, see SeekableWriter.
+    seekable = kwargs.get("seekable") or str(get_setting(conf, destination, "seekable", False)) == "True"
+
+    # A list of files is stored as one pack, each file under its own path.
+    pack = isinstance(filename, list)
+    members = [] if pack or seekable else None
+    arcname = pack_name() if pack else filename.split("/")[-1]
     #stored_filename = arcname + datetime.now().strftime("%Y%m%d%H%M%S") + ".tgz"
     # filename file name date
-    stored_filename = arcname + ".tgz"
-    log.info("Backup started localname=" + filename + " remotename=" + str(stored_filename))
+    stored_filename = arcname + (SEEKABLE_SUFFIX if seekable else compression[0].suffix)
+    if pack:
+        log.info("Backup started files={} remotename={}".format(len(filename), stored_filename))
+    else:
+        log.info("Backup started localname=" + filename + " remotename=" + str(stored_filename))
     password = kwargs.get("password")
+    stream = kwargs.get("stream", False)
+    dedup = kwargs.get("dedup", False)
 
     if conf is not None: # If the conf has been populated by using this as a module, set the password.
-	    password = conf.get("crypto_password")
+        password = conf.get("crypto_password")
+        stream = str(conf.get("stream", stream)) == "True"
+        dedup = str(conf.get("dedup", dedup)) == "True"
     else:
         if not password:
             password = getpass("Password (blank to disable encryption): ")
 
+    if password == "None" or password == "none":
+        password = None
+
+    # Like the codec, the cipher goes in the name suffix.
+    cipher = None
+    if password:
+        cipher = parse_cipher(kwargs.get("encryption") or
+                              get_setting(conf, destination, "encryption", DEFAULT_ENCRYPTION))
+
+    # Optional callback(state), told when the archive is compressed.
+    on_state = kwargs.get("on_state")
+    # Optional callback(progress dict) for the upload, see Progress.
+    on_progress = kwargs.get("on_progress")
+    if on_progress is None and (kwargs.get("progress") or str(get_setting(conf, destination, "progress", False)) == "True"):
+        on_progress = log_progress
+    metrics = Metrics(stored_filename)
+
+    if dedup:
+        # Callers backing up many files pass their store so chunks are listed once.
+        dedup_store = kwargs.get("dedup_store")
+        if dedup_store is None:
+            dedup_store = DedupStore(backend_pool, segment_pool, segment_concurrency)
+        result = backup_dedup(dedup_store, filename, arcname, password, cipher, members, metrics)
+    elif stream:
+        with backend_pool.session() as storage_backend:
+            result = backup_stream(storage_backend, filename, arcname, stored_filename, password, cipher,
+                                   segment_pool, segment_size, segment_concurrency, compression, members,
+                                   seekable, metrics, on_progress)
+    else:
+        result = backup_tempfile(backend_pool, filename, arcname, stored_filename, password, cipher, on_state,
+                                 segment_pool, segment_size, segment_concurrency, compression, members,
+                                 seekable, metrics, on_progress)
+
+    remote_catalog = backend_pool.catalog()
+    remote_catalog.add(result["name"], result["size"], result["etag"])
+    remote_catalog.record_upload(result["name"], result["size"], result["md5"], result["sha256"], result["etag"])
+    if pack:
+        store_pack_index(backend_pool, result["name"], members)
+        result["members"] = [path for path, offset, size in members]
+
+    metrics.name = result["name"]
+    result["metrics"] = metrics.finish().as_dict()
+    report_metrics(metrics, conf, destination, kwargs)
+    return result
+
+
+def report_metrics(metrics, conf, destination, kwargs):
+    """
+    Add metrics to the caller's RunMetrics (the run_metrics argument), or write
+    them out as a run of their own if metrics_json/metrics_textfile are set.
+    """
+    run_metrics = kwargs.get("run_metrics")
+    if run_metrics is not None:
+        run_metrics.add(metrics)
+        return
+    json_path = kwargs.get("metrics_json") or get_setting(conf, destination, "metrics_json", None)
+    textfile_path = kwargs.get("metrics_textfile") or get_setting(conf, destination, "metrics_textfile", None)
+    if json_path or textfile_path:
+        run_metrics = RunMetrics(metrics.operation)
+        run_metrics.start = metrics.start
+        run_metrics.add(metrics)
+        run_metrics.write(json_path, textfile_path)
+
+
+def store_pack_index(backend_pool, pack, members):
+    """
+    Upload the sidecar index of pack, <pack>.idx, and record its members in
+    the catalog. The pack is only committed once its index is stored.
+    """
+    pack_index = json.dumps(dict(pack=pack, members=members))
+    md5 = hashlib.md5(pack_index).hexdigest()
+    with backend_pool.session() as storage_backend:
+        check_etag(pack + PACK_INDEX_SUFFIX, storage_backend.upload(pack + PACK_INDEX_SUFFIX, StringIO(pack_index)), md5)
+    remote_catalog = backend_pool.catalog()
+    remote_catalog.add(pack + PACK_INDEX_SUFFIX, len(pack_index), md5)
+    remote_catalog.record_upload(pack + PACK_INDEX_SUFFIX, len(pack_index), md5,
+                                 hashlib.sha256(pack_index).hexdigest(), md5)
+    remote_catalog.add_members(pack, members)
+
+
+def backup_tempfile(backend_pool, filename, arcname, stored_filename, password, cipher, on_state,
+                    segment_pool, segment_size, segment_concurrency, compression, members=None,
+                    seekable=False, metrics=None, on_progress=None):
+    """
+    Classic backup: tar and compress to a temporary file, encrypt it to a
+    second one, then upload. Seekable archives are encrypted block by block
+    while they are written, in the one temporary file.
+    """
+    metrics = metrics or Metrics(stored_filename)
     log.info("Compressing...")
+    start = time.time()
     out = tempfile.TemporaryFile()
 #    with tarfile.open(fileobj=out, mode="w:gz") as tar:
 #        tar.add(filename, arcname=arcname)
 
-    tarz = tarfile.open(fileobj=out, mode="w:gz")
-    tarz.add(filename, arcname=arcname)
-    tarz.close()
-
-    if password == "None" or password == "none":
-        password = None
+    # The checksum is taken while the final output is written, no extra pass.
+    hashed = HashingFile(out)
+    if seekable:
+        writer = SeekableWriter(hashed, compression[0], compression[1], cipher, password, members)
+    else:
+        writer = CompressingWriter(out if password else hashed, *compression)
+    # tar and compression take turns, the time spent compressing is told apart by TimedWriter.
+    compressed = TimedWriter(writer)
+    try:
+        tarz = tarfile.open(fileobj=compressed, mode="w|")
+        tar_add(tarz, filename, arcname, members)
+        tarz.close()
+        compressed.close()
+    finally:
+        writer.release()
+    metrics.record("tar", time.time() - start - compressed.seconds, bytes_out=compressed.size)
+    metrics.record("seekable" if seekable else "compress", compressed.seconds, compressed.size, out.tell())
 
-    if password:
+    if password and seekable:
+        stored_filename += cipher.suffix
+    elif password:
         log.info("Encrypting...")
-        encrypted_out = tempfile.TemporaryFile()
-        encrypt(out, encrypted_out, password)
-        stored_filename += ".enc"
+        with metrics.timed("encrypt") as counts:
+            counts["bytes_in"] = out.tell()
+            encrypted_out = tempfile.TemporaryFile()
+            hashed = HashingFile(encrypted_out)
+            out.seek(0)
+            cipher.encrypt(out, hashed, password)
+            counts["bytes_out"] = hashed.size
+        stored_filename += cipher.suffix
         out = encrypted_out
 
+    if on_state:
+        on_state("compressed")
+
     log.info("Uploading...")
     out.seek(0)
-    storage_backend.upload(stored_filename, out)
+    progress = new_progress(stored_filename, hashed.size, on_progress)
+    with metrics.timed("upload") as counts:
+        with backend_pool.session() as storage_backend:
+            etag, expected = upload_object(storage_backend, segment_pool, stored_filename, out,
+                                           segment_size, segment_concurrency, progress)
+        counts["bytes_in"] = counts["bytes_out"] = hashed.size
+    if progress:
+        progress.finish()
+    expected = expected or hashed.md5.hexdigest()
+    check_etag(stored_filename, etag, expected)
+    return dict(name=stored_filename, etag=expected, **hashed.checksums())
+
+
+def backup_dedup(dedup_store, filename, arcname, password, cipher, members=None, metrics=None):
+    """
+    Deduplicated backup: the plain tar stream goes through the DedupStore,
+    only chunks it doesn't have yet are uploaded.
+    """
+    keyname = arcname + CDC_MANIFEST_SUFFIX
+    if password:
+        keyname += cipher.suffix
+    metrics = metrics or Metrics(keyname)
+
+    pipeline = Pipeline()
+    log.info("Chunking...")
+    pipeline.add(tar_stage, filename, arcname, "w|", members)
+    start = time.time()
+    try:
+        result = dedup_store.store(keyname, pipeline.output, password)
+    except Exception as err:
+        pipeline.abort(err)
+        raise
+    pipeline.join()
+    pipeline.record(metrics)
+    metrics.record("dedup", time.time() - start, pipeline.output.bytes, result["stored"], pipeline.output.get_wait)
+    return result
+
+
+def is_dedup_manifest(keyname):
+    cipher = cipher_for_name(keyname)
+    if cipher:
+        keyname = keyname[:-len(cipher.suffix)]
+    return keyname.endswith(CDC_MANIFEST_SUFFIX)
+
+
+def backup_stream(storage_backend, filename, arcname, stored_filename, password, cipher,
+                  segment_pool, segment_size, segment_concurrency, compression, members=None,
+                  seekable=False, metrics=None, on_progress=None):
+    """
+    Single pass backup: tar, compress, encrypt and upload run as concurrent
+    stages, the upload starts right away and no scratch disk is used.
+    """
+    pipeline = Pipeline()
+    log.info("Compressing...")
+    pipeline.add(tar_stage, filename, arcname, "w|", members)
+    if seekable:
+        # The index is written last, once the tar stage has recorded every member.
+        pipeline.add(seekable_stage, compression[0], compression[1], cipher, password, members)
+        if password:
+            stored_filename += cipher.suffix
+    else:
+        if compression[0].compressor:
+            pipeline.add(compress_stage, *compression)
+
+        if password:
+            log.info("Encrypting...")
+            pipeline.add(encrypt_stage, cipher, password)
+            stored_filename += cipher.suffix
+
+    log.info("Uploading...")
+    metrics = metrics or Metrics(stored_filename)
+    progress = new_progress(stored_filename, None, on_progress) # The size is only known at the end.
+    hashed = HashingFile(pipeline.output)
+    start = time.time()
+    try:
+        etag, expected = upload_object(storage_backend, segment_pool, stored_filename, hashed,
+                                       segment_size, segment_concurrency, progress)
+    except Exception as err:
+        pipeline.abort(err)
+        raise
+    pipeline.join()
+    pipeline.record(metrics)
+    metrics.record("upload", time.time() - start, hashed.size, hashed.size, pipeline.output.get_wait)
+    if progress:
+        progress.total = hashed.size
+        progress.finish()
+    expected = expected or hashed.md5.hexdigest()
+    check_etag(stored_filename, etag, expected)
+    return dict(name=stored_filename, etag=expected, **hashed.checksums())
 
 
 
@@ -451,8 +4028,14 @@ def configure():
 
 @app.cmd(help="Restore backup in the current directory.")
 @app.cmd_arg('-f', '--filename', type=str, default="")
-@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|glacier|cloudfiles")
+@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|glacier|cloudfiles|local|memory")
 @app.cmd_arg('-p', '--password', type=str, default=None, help="Provide password non interactively.") # jonk nov 29 2012
+@app.cmd_arg('-s', '--stream', action="store_true", default=False, help="Download, decrypt and extract concurrently without temporary files.")
+@app.cmd_arg('--member', type=str, default=None, help="Only extract this path, seekable archives are read with ranged requests.")
+@app.cmd_arg('--download-concurrency', type=int, default=None, help="Ranged reads in flight, 1 for a single GET.")
+@app.cmd_arg('--progress', action="store_true", default=False, help="Log the download progress and ETA.")
+@app.cmd_arg('--metrics-json', type=str, default=None, help="Write per-stage timings and sizes to this file as JSON.")
+@app.cmd_arg('--metrics-textfile', type=str, default=None, help="Same, as a Prometheus textfile collector file.")
 def restore(filename, destination="cloudfiles", **kwargs):
     conf = kwargs.get("conf", None)
 
@@ -462,43 +4045,201 @@ def restore(filename, destination="cloudfiles", **kwargs):
         log.error("No file to restore, use -f to specify one.")
         return
 
-    keys = [name for name in storage_backend.ls() if name.startswith(filename)]
-    if not keys:
-        log.error("No file matched.")
+    # filename is either the start of a stored name or the path of a packed file.
+    remote_catalog = open_catalog(storage_backend, destination, conf)
+    member = kwargs.get("member")
+    key_name = None if member else remote_catalog.find_member(filename)
+    if key_name:
+        member = filename
+    elif member:
+        key_name = find_backup(remote_catalog, storage_backend, filename)
+    else:
+        key_name = find_backup(remote_catalog, storage_backend, filename)
+        if not key_name:
+            key_name = find_packed(remote_catalog, storage_backend, filename)
+            member = filename
+    if not key_name:
+        log.error("No file matched, try sync-catalog --full if it was stored from another host.")
         return
 
-    key_name = sorted(keys, reverse=True)[0]
-    log.info("Restoring " + key_name)
+    if member:
+        log.info("Restoring " + member + " out of " + key_name)
+    else:
+        log.info("Restoring " + key_name)
 
     # Asking password before actually download to avoid waiting
-    if key_name and key_name.endswith(".enc"):
+    password = None
+    cipher = cipher_for_name(key_name)
+    if cipher:
+        cipher.check()
         password = kwargs.get("password")
         if not password:
             password = getpass()
         elif password == "None":
             password = None
 
+    stream = kwargs.get("stream", False)
+    if conf is not None:
+        stream = str(conf.get("stream", stream)) == "True"
+
+    # Optional callback(progress dict) for the download, see Progress.
+    on_progress = kwargs.get("on_progress")
+    if on_progress is None and (kwargs.get("progress") or str(get_setting(conf, destination, "progress", False)) == "True"):
+        on_progress = log_progress
+    metrics = Metrics(key_name, "restore")
+
+    # Big objects are fetched as parallel ranges (segments for large objects).
+    download_pool = None
+    concurrency = int(kwargs.get("download_concurrency") or
+                      get_setting(conf, destination, "download_concurrency", DEFAULT_DOWNLOAD_CONCURRENCY))
+    if concurrency > 1 and hasattr(storage_backend, "parts"):
+        download_pool = BackendPool(destination, conf, size=concurrency)
+
+    if is_dedup_manifest(key_name):
+        restore_dedup(DedupStore(BackendPool(destination, conf)), key_name, password, member, metrics)
+    elif member and is_seekable(key_name) and hasattr(storage_backend, "read_range"):
+        with metrics.timed("member"):
+            restore_member(storage_backend, key_name, member, password)
+    elif stream:
+        restore_stream(storage_backend, key_name, password, member, download_pool, metrics,
+                       new_progress(key_name, None, on_progress))
+    else:
+        restore_tempfile(storage_backend, key_name, password, member, download_pool, metrics,
+                         new_progress(key_name, None, on_progress))
+
+    report_metrics(metrics.finish(), conf, destination, kwargs)
+    return metrics.as_dict()
+
+
+def restore_tempfile(storage_backend, key_name, password, member=None, download_pool=None, metrics=None,
+                     progress=None):
+    """ Classic restore: download to a temporary file, decrypt it to a second one, then extract. """
+    metrics = metrics or Metrics(key_name, "restore")
     log.info("Downloading...")
-    out = storage_backend.download(key_name)
+    with metrics.timed("download") as counts:
+        if download_pool:
+            out = tempfile.TemporaryFile()
+            if parallel_download_to(download_pool, key_name, out, download_pool.size, progress) is False:
+                out = None
+        else:
+            download_kwargs = {}
+            if progress:
+                download_kwargs = dict(cb=progress.callback())
+            out = storage_backend.download(key_name, **download_kwargs)
+        if out:
+            out.seek(0, 2)
+            counts["bytes_out"] = out.tell()
+            out.seek(0)
+    if progress:
+        progress.finish()
+    if not out:
+        return
+
+    if is_seekable(key_name):
+        log.info("Uncompressing...")
+        with metrics.timed("extract") as counts:
+            counts["bytes_in"] = metrics.stages["download"]["bytes_out"]
+            tar = tarfile.open(fileobj=SeekableReader(out, password), mode="r|")
+            tar.extractall(members=extract_members(tar, member))
+            tar.close()
+        return
 
-    if out and key_name.endswith(".enc"):
+    cipher = cipher_for_name(key_name)
+    if cipher:
         log.info("Decrypting...")
-        decrypted_out = tempfile.TemporaryFile()
-        decrypt(out, decrypted_out, password)
-        out = decrypted_out
+        with metrics.timed("decrypt") as counts:
+            decrypted_out = tempfile.TemporaryFile()
+            cipher.decrypt(out, decrypted_out, password)
+            out = decrypted_out
+            counts["bytes_in"] = metrics.stages["download"]["bytes_out"]
+            counts["bytes_out"] = out.tell()
         log.info( "Decrypt Filehandler " + str(out))
 
-    if out:
-        log.info("Uncompressing...")
+    log.info("Uncompressing...")
+    with metrics.timed("extract") as counts:
+        counts["bytes_in"] = out.tell()
         out.seek(0)
-        tar = tarfile.open(fileobj=out)
-        tar.extractall()
+        tar = tarfile.open(fileobj=DecompressingReader(out, codec_for_name(key_name)), mode="r|")
+        tar.extractall(members=extract_members(tar, member))
+        tar.close()
+
+
+def restore_stream(storage_backend, key_name, password, member=None, download_pool=None, metrics=None,
+                   progress=None):
+    """
+    Pipelined restore: decrypt and extract as the bytes arrive, so the restore
+    takes about as long as the download and needs no scratch disk. With a
+    download_pool the object arrives as parallel ranges, see parallel_download_to.
+    """
+    pipeline = Pipeline()
+    log.info("Downloading...")
+    if download_pool:
+        pipeline.add(parallel_download_stage, download_pool, key_name, download_pool.size, progress)
+    else:
+        pipeline.add(download_stage, storage_backend, key_name, progress)
+
+    if is_seekable(key_name):
+        pipeline.add(unseekable_stage, password)
+    else:
+        cipher = cipher_for_name(key_name)
+        if cipher:
+            log.info("Decrypting...")
+            pipeline.add(decrypt_stage, cipher, password)
+
+        codec = codec_for_name(key_name)
+        if codec.decompressor:
+            pipeline.add(decompress_stage, codec)
+    extract_stream(pipeline, "r|", member, metrics)
+    if progress:
+        progress.finish()
+
+
+def restore_dedup(dedup_store, key_name, password, member=None, metrics=None):
+    """ Reassemble the chunks of a deduplicated backup and extract them. """
+    pipeline = Pipeline()
+    log.info("Downloading chunks...")
+    pipeline.add(dedup_restore_stage, dedup_store, key_name, password)
+    extract_stream(pipeline, "r|", member, metrics)
+
+
+def extract_stream(pipeline, mode, member=None, metrics=None):
+    """
+    Extract the tar coming out of pipeline in the current directory, only
+    member if given. The timings of every stage are added to metrics.
+    """
+    log.info("Uncompressing...")
+    start = time.time()
+    try:
+        tar = tarfile.open(fileobj=pipeline.output, mode=mode)
+        tar.extractall(members=extract_members(tar, member))
         tar.close()
+        # Drain the tar padding so the upstream stages can finish.
+        while pipeline.output.read(PIPE_CHUNK_SIZE):
+            pass
+    except ArchiveNotReady as err:
+        log.info(str(err))
+        return
+    except Exception as err:
+        pipeline.abort(err)
+        raise
+    pipeline.join()
+    if metrics:
+        pipeline.record(metrics)
+        metrics.record("extract", time.time() - start, pipeline.output.bytes, waited=pipeline.output.get_wait)
+
+
+@app.cmd(name="dedup-gc", help="Delete deduplicated chunks no backup references anymore.")
+@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|glacier|cloudfiles|local|memory")
+@app.cmd_arg('--grace-hours', type=float, default=DEDUP_GC_GRACE_HOURS,
+             help="Keep chunks younger than this, they may belong to a backup still running.")
+def dedup_gc(destination="cloudfiles", grace_hours=DEDUP_GC_GRACE_HOURS, **kwargs):
+    conf = kwargs.get("conf", None)
+    DedupStore(BackendPool(destination, conf)).garbage_collect(grace_hours)
 
 
 @app.cmd(help="Delete a backup.")
 @app.cmd_arg('-f', '--filename', type=str, default="")
-@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|glacier|cloudfiles")
+@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|glacier|cloudfiles|local|memory")
 def delete(filename, destination="cloudfiles", **kwargs):
     conf = kwargs.get("conf", None)
     storage_backend = storage_backends[destination](conf)
@@ -507,44 +4248,140 @@ def delete(filename, destination="cloudfiles", **kwargs):
         log.error("No file to delete, use -f to specify one.")
         return
 
-    keys = [name for name in storage_backend.ls() if name.startswith(filename)]
-    if not keys:
-        log.error("No file matched.")
+    remote_catalog = open_catalog(storage_backend, destination, conf)
+    key_name = find_backup(remote_catalog, storage_backend, filename)
+    if not key_name:
+        log.error("No file matched, try sync-catalog --full if it was stored from another host.")
         return
 
-    key_name = sorted(keys, reverse=True)[0]
     log.info("Deleting " + key_name)
 
     storage_backend.delete(key_name)
+    remote_catalog.remove(key_name)
+    if key_name.startswith(PACK_PREFIX) and remote_catalog.latest(key_name + PACK_INDEX_SUFFIX):
+        storage_backend.delete(key_name + PACK_INDEX_SUFFIX)
+        remote_catalog.remove(key_name + PACK_INDEX_SUFFIX)
+
+
+@app.cmd(name="sync-catalog", help="Refresh the local catalog of stored backups from the remote listing.")
+@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|glacier|cloudfiles|local|memory")
+@app.cmd_arg('--full', action="store_true", default=False, help="Relist everything and forget objects deleted from elsewhere.")
+def sync_catalog(destination="cloudfiles", full=False, **kwargs):
+    conf = kwargs.get("conf", None)
+    storage_backend = storage_backends[destination](conf)
+    remote_catalog = open_catalog(storage_backend, destination, conf)
+    remote_catalog.sync(storage_backend, full)
+    remote_catalog.load_pack_indexes(storage_backend)
 
 
 @app.cmd(help="List stored backups.")
-@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|glacier|cloudfiles")
-def ls(destination="cloudfiles", **kwargs):
+@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|glacier|cloudfiles|local|memory")
+@app.cmd_arg('--prefix', type=str, default=None, help="Only list names starting with prefix.")
+@app.cmd_arg('--limit', type=int, default=None, help="List at most limit names.")
+def ls(destination="cloudfiles", prefix=None, limit=None, **kwargs):
     conf = kwargs.get("conf", None)
     storage_backend = storage_backends[destination](conf)
     
     log.info(storage_backend.container)
 
-    for filename in storage_backend.ls():
+    # Names are logged page by page as they arrive, the listing is never held in memory.
+    for filename in storage_backend.ls(prefix=prefix, limit=limit):
         log.info(filename)
 
 @app.cmd(help="Get an md5 of backup.")
 @app.cmd_arg('-f', '--filename', type=str, default="")
-@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="cloudfiles")
+@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|cloudfiles")
 def md5(filename, destination="cloudfiles", **kwargs):
-    # Only supports cloudfiles, sorry AWS! I dunno how!
+    # The server's ETag, from a HEAD request. Glacier has no such thing.
     conf = kwargs.get("conf", None)
     storage_backend = storage_backends[destination](conf)
 
     if not filename:
         log.error("No file to md5, use -f to specify one.")
         return
+    if not hasattr(storage_backend, "head"):
+        log.error("{} doesn't report checksums.".format(destination))
+        return
+
+    key_name = find_backup(open_catalog(storage_backend, destination, conf), storage_backend, filename)
+    info = key_name and storage_backend.head(key_name)
+    if not info:
+        log.error("No file matched, try sync-catalog --full if it was stored from another host.")
+        return
 
-    md5=storage_backend.md5()
-    log.info( str(filename) + " : " + str(md5))
+    md5 = info["hash"]
+    log.info( str(key_name) + " : " + str(md5))
     return md5
 
+
+@app.cmd(help="Check stored backups against the checksums recorded when they were uploaded, without downloading them.")
+@app.cmd_arg('-f', '--filename', type=str, default="", help="Only check names starting with filename.")
+@app.cmd_arg('-d', '--destination', type=str, default="cloudfiles", help="s3|cloudfiles")
+@app.cmd_arg('--head', action="store_true", default=False, help="HEAD every object instead of trusting the listing.")
+def verify(filename="", destination="cloudfiles", head=False, **kwargs):
+    """
+    Sizes and ETags come from the listing, a page of names per request. A
+    mismatch is confirmed with a HEAD before it is reported: listings show
+    Cloud Files large objects by their (empty) manifest.
+    """
+    conf = kwargs.get("conf", None)
+    storage_backend = storage_backends[destination](conf)
+    if not hasattr(storage_backend, "head"):
+        log.error("{} doesn't report checksums.".format(destination))
+        return
+
+    expected = open_catalog(storage_backend, destination, conf).checksums(filename)
+    failed = []
+    checked = 0
+    marker = None
+    while expected:
+        page = storage_backend.list_page(marker, LIST_PAGE_SIZE, filename or None)
+        if not page:
+            break
+        marker = page[-1]["name"]
+        for entry in page:
+            name = entry["name"]
+            if name not in expected:
+                continue # Not uploaded from here, nothing to compare with.
+            size, md5, sha256, etag = expected.pop(name)
+            if head or (entry["size"], entry["hash"]) != (size, etag):
+                entry = storage_backend.head(name) or dict(size=None, hash=None)
+            checked += 1
+            if (entry["size"], entry["hash"]) != (size, etag):
+                log.error("{} doesn't match: size {} ETag {}, uploaded as size {} ETag {}".format(
+                    name, entry["size"], entry["hash"], size, etag))
+                failed.append(name)
+
+    for name in sorted(expected):
+        log.error("{} is missing".format(name))
+        failed.append(name)
+    log.info("{} object(s) verified, {} failed".format(checked + len(expected), len(failed)))
+    return failed
+
+@app.cmd(name="glacier-restore", help="Retrieve every Glacier backup starting with --filename and restore them in the current directory as their jobs complete.")
+@app.cmd_arg('-f', '--filename', type=str, default="")
+@app.cmd_arg('-p', '--password', type=str, default=None, help="Provide password non interactively.")
+@app.cmd_arg('--wait', action="store_true", default=False, help="Keep polling until every job completed instead of checking once.")
+def glacier_restore(filename, wait=False, **kwargs):
+    conf = kwargs.get("conf", None)
+    glacier_backend = GlacierBackend(conf)
+
+    keynames = list(glacier_backend.ls(prefix=filename))
+    if not keynames:
+        log.error("No file matched.")
+        return
+
+    password = kwargs.get("password")
+    if not password and [name for name in keynames if cipher_for_name(name)]:
+        password = getpass()
+    if password == "None":
+        password = None
+
+    pending = glacier_backend.retrieve(keynames, lambda keyname: restore_stream(glacier_backend, keyname, password), wait)
+    if pending:
+        log.info("{} archive(s) not retrieved yet, run again later: {}".format(len(pending), ", ".join(pending)))
+
+
 @app.cmd(help="Backup Glacier inventory to S3")
 def backup_glacier_inventory(**kwargs):
     conf = kwargs.get("conf", None)
@@ -10,7 +10,7 @@
                     and looks for files matching an expression.
                     
                     If files match, they are then uploaded to the cloud either using compression
-                    or compression+encryption using blowfish (supported by the beefish+pycrypto libraries)
+                    or compression+encryption using AES-GCM (pycryptodome) or blowfish (beefish+pycrypto)
 
                     Post-upload to the cloud, a post_backup_action is performed. The first action
                     justdelete, will trash a file immediately , the second option purgatory
@@ -30,7 +30,7 @@ if sys.version_info < (2,6):
 if sys.version_info > (3,0):
     raise SystemExit('Sorry, does not support the great syntax change of Python 3.')
 
-import os, glob, time, os.path
+import os, stat, time, os.path
 import pycloudbackup    # For backup_file()
 import aaargh           # For parsing args everywhere.
 import ConfigParser     # For parsing configs everywhere.
@@ -48,11 +48,18 @@ if not log.handlers:
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 
 config = ConfigParser.SafeConfigParser()
+backend_pool = None # authenticated cloudfiles connections, shared by the workers
+segment_pool = None # connections for the segments of large files, shared by the workers
+dedup_store = None  # known dedup chunks, listed once per run
+journal = None      # crash-safe run journal, lets a restarted run resume
+index = None        # file-state index for incremental backups
+run_metrics = None  # per-stage timings of the run, see metrics_json/metrics_textfile
 app = aaargh.App(description="Handles backups, including local backup retention.")
 
 @app.cmd(help="Starts backup/archiving process.")
 @app.cmd_arg('-c', '--configfile', type=str)
 def backup(configfile):
+    global backend_pool, segment_pool, dedup_store, journal, index, run_metrics
     if not configfile:
         log.error("Configuration not found. Use --config arg to define config file.")
         return
@@ -63,23 +70,57 @@ def backup(configfile):
     matches          = config.get("backupSettings", "backup_files_matching")
     post_backup_action = config.get("backupSettings", "post_backup_action")
     purge_isenabled  = config.get("backupSettings", "purge_isenabled")
+    exclude = None
+    if config.has_option("backupSettings", "backup_files_excluding"):
+        exclude = config.get("backupSettings", "backup_files_excluding")
+    matcher = pycloudbackup.FileMatcher(pycloudbackup.parse_rules(matches), pycloudbackup.parse_rules(exclude))
+    if purge_isenabled == "True":
+        purge_aftersecs  = config.get("backupSettings", "purge_after_secs")
+        purge_location   = config.get("backupSettings", "purgatory_location")
+
+    workers = pycloudbackup.DEFAULT_WORKERS
+    if config.has_option("backupSettings", "workers"):
+        workers = int(config.get("backupSettings", "workers"))
+    max_inflight_mb = pycloudbackup.DEFAULT_MAX_INFLIGHT_MB
+    if config.has_option("backupSettings", "max_inflight_mb"):
+        max_inflight_mb = int(config.get("backupSettings", "max_inflight_mb"))
+
+    # The run journal lives beside the config unless told otherwise.
+    journal_path = os.path.expanduser(configfile) + ".journal"
+    if config.has_option("backupSettings", "journal"):
+        journal_path = os.path.expanduser(config.get("backupSettings", "journal"))
+
+    # Incremental mode only uploads files that changed since they were last backed up.
+    if config.has_option("backupSettings", "incremental") and config.get("backupSettings", "incremental") == "True":
+        index_path = os.path.expanduser(configfile) + ".index"
+        if config.has_option("backupSettings", "index"):
+            index_path = os.path.expanduser(config.get("backupSettings", "index"))
+        index = pycloudbackup.FileIndex(index_path)
 
-    
     if backup_isenabled == "True" and is_directory(backup_location):
         log.debug("DEBUG: Considering objects that fit this criterion for backup: " + str(backup_location) + str(matches) )
-        for file in glob.glob(os.path.join(backup_location, matches)): # Iterates through backup dir
-            backup_file(file)
-            if post_backup_action == "purgatory":
-                if purge_isenabled == "True":
-                    purge_aftersecs  = config.get("backupSettings", "purge_after_secs")
-                    purge_location   = config.get("backupSettings", "purgatory_location")
-                    purge_file(file,purge_location)
-                else:
-                    log.info("Purge disabled or purge directory not found.")
-            elif post_backup_action == "justdelete":
-                delete_file(file)
-            else:
-                log.warn("No post-backup actions [purgatory,justdelete] found. I dunno what to do!!!!!!!!!!!")
+        journal = pycloudbackup.RunJournal(journal_path)
+        backend_pool = pycloudbackup.BackendPool("cloudfiles", get_backup_constants(), size=workers)
+        segment_pool = pycloudbackup.BackendPool("cloudfiles", get_backup_constants(),
+                                                 size=workers * segment_concurrency())
+        # Only used with dedup = True, chunks go up on the segment pool like large file segments.
+        dedup_store = pycloudbackup.DedupStore(backend_pool, segment_pool, segment_concurrency())
+        pool = pycloudbackup.WorkerPool(workers, max_inflight_mb * 1024 * 1024)
+        run_metrics = pycloudbackup.RunMetrics()
+        for file, st in match_files(backup_location, matcher): # Iterates through backup dir
+            if index and index.unchanged(file, st):
+                # Same size, mtime and inode as last backed up, not even read. The post-backup
+                # action still runs, in case a crash came between the upload and the action.
+                pool.submit(post_action, 0, file, post_backup_action, purge_isenabled)
+                continue
+            pool.submit(backup_and_post_action, st.st_size, file, post_backup_action, purge_isenabled)
+        failures = pool.join()
+        run_metrics.fail(len(failures))
+        write_metrics(run_metrics)
+        if failures:
+            log.error(str(len(failures)) + " file(s) failed to back up, no post-backup action was taken on them.")
+        else:
+            journal.finish()
     else:
         log.warn("Backups are disabled or backup directory not existant.")
 
@@ -87,6 +128,64 @@ def backup(configfile):
     if purge_isenabled == "True":
         purge_deletePurgedItems(purge_location,purge_aftersecs)
 
+def write_metrics(run_metrics):
+    """ Per-stage timings and sizes of the run, as JSON and/or a Prometheus textfile if configured. """
+    metrics_json = metrics_textfile = None
+    if config.has_option("backupSettings", "metrics_json"):
+        metrics_json = config.get("backupSettings", "metrics_json")
+    if config.has_option("backupSettings", "metrics_textfile"):
+        metrics_textfile = config.get("backupSettings", "metrics_textfile")
+    run_metrics.write(metrics_json, metrics_textfile)
+
+def match_files(location, matcher):
+    """ Yields (path, stat) for the files directly in location that matcher selects. """
+    for name in sorted(os.listdir(location)):
+        file = os.path.join(location, name)
+        try:
+            st = os.stat(file)
+        except OSError as err:
+            log.warn(str(err))
+            continue
+        if stat.S_ISREG(st.st_mode) and matcher.wants_file(name, st):
+            yield file, st
+
+def backup_and_post_action(file, post_backup_action, purge_isenabled):
+    """ Worker job: backs up a file, the post-backup action only runs if the upload succeeded.
+        Files the journal shows as uploaded by an interrupted run are not sent again. """
+    st = os.stat(file)
+    digest = remote_name = None
+    if index:
+        digest = index.content_changed(file, st)
+        if digest is None: # Touched but same content as last backed up, only the action is left.
+            post_action(file, post_backup_action, purge_isenabled)
+            return
+    if journal.lookup(file, st) == "uploaded":
+        log.info("Already uploaded by the interrupted run: " + file)
+    else:
+        journal.record(file, "queued", st)
+        result = backup_file(file, on_state=lambda state: journal.record(file, state))
+        journal.record(file, "uploaded", remote_name=result["name"], checksum=result["md5"])
+        remote_name = result["name"]
+    post_action(file, post_backup_action, purge_isenabled)
+    # Indexed last: a file indexed as backed up must also have been moved or deleted.
+    if index:
+        index.update(file, st, digest, remote_name)
+
+def post_action(file, post_backup_action, purge_isenabled):
+    """ Worker job: moves a safely stored file to purgatory or deletes it, as configured. """
+    if post_backup_action == "purgatory":
+        if purge_isenabled == "True":
+            purge_location   = config.get("backupSettings", "purgatory_location")
+            purge_file(file,purge_location)
+            journal.record(file, "deleted")
+        else:
+            log.info("Purge disabled or purge directory not found.")
+    elif post_backup_action == "justdelete":
+        delete_file(file)
+        journal.record(file, "deleted")
+    else:
+        log.warn("No post-backup actions [purgatory,justdelete] found. I dunno what to do!!!!!!!!!!!")
+
 @app.cmd(help="Lists currently configured container.")
 @app.cmd_arg('-c', '--configfile', type=str) # doesnt work quite right yet
 def ls(configfile):
@@ -106,7 +205,7 @@ def ls(configfile):
                         "region_name": region_name,
                         "crypto_password": crypto_password }
 
-    pycloudbackup.ls(destination="cloudfiles")
+    pycloudbackup.ls(destination="cloudfiles", conf=backup_constants)
 
 @app.cmd(help="Starts restore process.")
 @app.cmd_arg('-c', '--configfile', type=str)
@@ -131,18 +230,7 @@ def restore(configfile,filename=None,cryptopass=None):
     print filename + " restored to CWD."
 
 def restore_file(file,crytopass):
-    apiuser     = config.get("cloudfilesSettings", "apiuser")
-    apikey      = config.get("cloudfilesSettings", "apikey")
-    container   = config.get("cloudfilesSettings", "container")
-    region_name = config.get("cloudfilesSettings", "region_name")
-    crypto_password = config.get("backupSettings", "crypto_password")
-    backup_constants = {"apiuser": apiuser,
-                        "apikey": apikey,
-                        "container": container,
-                        "region_name": region_name,
-                        "crypto_password": crypto_password }
-
-    pycloudbackup.restore(file, conf=backup_constants, destination="cloudfiles")
+    pycloudbackup.restore(file, conf=get_backup_constants(), destination="cloudfiles")
 
 def file_older_than(file,required_delta):
     """ Returns true or false if file is older than specified required_delta
@@ -187,13 +275,13 @@ def delete_file(file):
     log.info("Deleting file " + file)
     os.unlink(file) # cya.
 
-def backup_file(file):
+def get_backup_constants():
+    """ Builds the pycloudbackup conf dict out of the config file. """
     apiuser     = config.get("cloudfilesSettings", "apiuser")
     apikey      = config.get("cloudfilesSettings", "apikey")
     container   = config.get("cloudfilesSettings", "container")
     region_name = config.get("cloudfilesSettings", "region_name")
     crypto_password = config.get("backupSettings", "crypto_password")
-    """ Backups a file, accepts 1 arguement: the file you wish to backup """
 
     backup_constants = {"apiuser": apiuser,
                         "apikey": apikey,
@@ -201,7 +289,23 @@ def backup_file(file):
                         "region_name": region_name,
                         "crypto_password": crypto_password }
 
-    pycloudbackup.backup(file, conf=backup_constants, destination="cloudfiles")
+    for option in ("stream", "dedup", "segment_size_mb", "segment_concurrency", "catalog", "compression",
+                   "encryption", "seekable", "download_concurrency", "progress"):
+        if config.has_option("backupSettings", option):
+            backup_constants[option] = config.get("backupSettings", option)
+    return backup_constants
+
+def segment_concurrency():
+    """ Segments uploaded at once per large file, each worker can be uploading one. """
+    if config.has_option("backupSettings", "segment_concurrency"):
+        return int(config.get("backupSettings", "segment_concurrency"))
+    return pycloudbackup.DEFAULT_SEGMENT_CONCURRENCY
+
+def backup_file(file, on_state=None):
+    """ Backups a file, accepts 1 arguement: the file you wish to backup """
+    return pycloudbackup.backup(file, conf=get_backup_constants(), destination="cloudfiles",
+                                backend_pool=backend_pool, segment_pool=segment_pool, dedup_store=dedup_store,
+                                on_state=on_state, run_metrics=run_metrics)
 
 def is_directory(dir):
     return os.path.isdir(dir)
@@ -245,8 +349,12 @@ def makeconfig():
     print("   What filenames should we match? You can use wildcards such as *, ?, and [ ] style ranges.")
     print("   IE: *.sql.tar.?? would match backup396393.sql.tar.gz")
     print("   IE: * would match anything.")
+    print("   Several patterns can be given comma separated, also re:<regex> and size/age bounds like size>1M, age>2d.")
     ans=raw_input("Backup files matching: ")
     config.set("backupSettings", "backup_files_matching", ans)
+    ans=raw_input("Backup files excluding (blank for none): ")
+    if ans:
+        config.set("backupSettings", "backup_files_excluding", ans)
 
     print("===================")
     print("POST-BACKUP ACTIONS")
@@ -280,7 +388,7 @@ def makeconfig():
 
     print("=====================")
     print("CRYPTOGRAPHY SETTINGS")
-    print("   Should we encrypt the file on Cloud Files using blowfish?")
+    print("   Should we encrypt the file on Cloud Files? (AES-GCM with pycryptodome, blowfish otherwise)")
     print("   If you just want it stored plain-text compressed")
     print("     you can answer this with None.")
     config.set("backupSettings", "crypto_password", raw_input("Crypto Password: ") )